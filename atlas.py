@@ -0,0 +1,282 @@
+from typing import Any, Dict, List, Optional, Tuple
+from grid import Tile, ImageCache, imagecache, np
+from tiledata import DATADIR
+from PIL import Image
+import json
+import mmap
+import os
+import tempfile
+import time
+ATLASDIR = os.path.join(DATADIR, 'atlas')
+# Bump when what goes in an atlas changes, so old ones aren't reused.
+ATLAS_FORMAT = 3
+# Superseded data files are only deleted once they're this old, so one
+# another builder has just written isn't deleted before its index is.
+SUPERSEDED_AGE_S = 60
+
+class TileAtlas:
+    '''
+    Every tile of a tileset pre-scaled to tile_px x tile_px and packed back
+    to back as raw RGB in a single file, which is memory-mapped.
+    Getting a tile out is a copy of tile_px*tile_px*3 bytes, with no decoding
+    or resampling.
+
+    RGB can't hold transparency, so tiles that have some are left out and
+    listed in `skipped`; they still count as covered, and get() returns
+    None for them so they come from the image cache.
+    '''
+    def __init__(self, path:str, tile_px:int, slots:Dict[str, int], skipped:Optional[List[str]]=None):
+        self.path = path
+        self.tile_px = tile_px
+        self.slots = slots
+        self.skipped = set(skipped or ())
+        self.tile_nbytes = tile_px * tile_px * 3
+        self._open()
+
+    def _open(self) -> None:
+        with open(self.path, 'rb') as fp:
+            # If every tile was skipped the file is empty, which can't be mapped.
+            self.mm: Optional[mmap.mmap] = None
+            if os.fstat(fp.fileno()).st_size:
+                self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # mmaps don't pickle, so just reopen the file. This is so the atlas can
+    # be handed to worker processes.
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        del state['mm']
+        return state
+
+    def __setstate__(self, state:Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._open()
+
+    def __contains__(self, path:str) -> bool:
+        return path in self.slots
+
+    def covers(self, tiles:List[Tile]) -> bool:
+        return all(t.path in self.slots or t.path in self.skipped for t in tiles)
+
+    def forget(self, path:str) -> None:
+        '''
+        Stop serving path from the atlas, e.g. because its image changed.
+        '''
+        self.slots.pop(path, None)
+        self.skipped.discard(path)
+
+    def _data(self, path:str) -> Optional[bytes]:
+        slot = self.slots.get(path)
+        if slot is None:
+            return None
+        assert self.mm is not None
+        offset = slot * self.tile_nbytes
+        return self.mm[offset:offset+self.tile_nbytes]
+
+    def get(self, path:str) -> Optional[Image.Image]:
+        data = self._data(path)
+        if data is None:
+            return None
+        return Image.frombuffer('RGB', (self.tile_px, self.tile_px), data, 'raw', 'RGB', 0, 1)
+
+    def get_array(self, path:str) -> Optional['np.ndarray']:
+        data = self._data(path)
+        if data is None:
+            return None
+        return np.frombuffer(data, dtype=np.uint8).reshape(self.tile_px, self.tile_px, 3)
+
+    def close(self) -> None:
+        if self.mm is not None:
+            self.mm.close()
+
+def _stat(path:str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+def _index_path(directory:str, tile_px:int) -> str:
+    return os.path.join(directory, 'px{}.json'.format(tile_px))
+
+def _empty_index(tile_px:int) -> Dict[str, Any]:
+    # files: path -> [size, mtime_ns, image key]; keys: image key -> slot,
+    # or -1 if it has transparency and isn't stored
+    return {'format': ATLAS_FORMAT, 'tile_px': tile_px, 'data': None, 'count': 0, 'files': {}, 'keys': {}}
+
+def _read_index(path:str, tile_px:int) -> Dict[str, Any]:
+    try:
+        with open(path) as fp:
+            index = json.load(fp)
+        if index['format'] == ATLAS_FORMAT and index['tile_px'] == tile_px:
+            return index
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return _empty_index(tile_px)
+
+def _write_atomic(directory:str, path:str, write:Any, mode:str='w') -> None:
+    # unique temp names, as other threads or processes may be writing the
+    # same file
+    fd, tmppath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as fp:
+            write(fp)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+def _remove_superseded(directory:str, tile_px:int, current:str) -> None:
+    '''
+    Deletes this size's older data files, and atlases in the format before
+    there was one per size. Files still mapped on Windows can't be deleted;
+    they go next time.
+    '''
+    prefix = 'px{}-'.format(tile_px)
+    cutoff = time.time() - SUPERSEDED_AGE_S
+    for name in os.listdir(directory):
+        base, ext = os.path.splitext(name)
+        old_format = ext in ('.rgb', '.json') and len(base) == 40 and all(c in '0123456789abcdef' for c in base)
+        superseded = name.startswith(prefix) and ext == '.rgb' and name != current
+        if old_format or superseded:
+            path = os.path.join(directory, name)
+            try:
+                if old_format or os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+def _atlas_for(directory:str, index:Dict[str, Any], paths:List[str]) -> Optional[TileAtlas]:
+    files, key_slots = index['files'], index['keys']
+    slots: Dict[str, int] = {}
+    skipped: List[str] = []
+    for path in paths:
+        if path in files:
+            slot = key_slots[files[path][2]]
+            if slot < 0:
+                skipped.append(path)
+            else:
+                slots[path] = slot
+    if not slots and not skipped:
+        return None
+    return TileAtlas(os.path.join(directory, index['data']), index['tile_px'], slots, skipped)
+
+def load_or_build(
+        tiles:List[Tile],
+        tile_px:int,
+        imagecache:ImageCache=imagecache,
+        directory:str=ATLASDIR,
+        ) -> Optional[TileAtlas]:
+    '''
+    Maps the atlas of tiles at this size, with these tiles in it. There is
+    one per size, shared by every tileset, and tiles it doesn't have yet
+    (or whose file's size or mtime changed) are added to it, so only they
+    are decoded. Returns None if there is nothing to put in it.
+
+    Adding tiles writes a new data file, copying the old one, and then the
+    index; older data files are deleted once nothing can be about to use
+    them. Slots no tile uses any more are
+    dropped when they're more than half of the file.
+    '''
+    stats: Dict[str, Tuple[int, int]] = {}
+    keys: Dict[str, str] = {}
+    for t in tiles:
+        if t.path not in stats:
+            st = _stat(t.path)
+            if st is not None:
+                stats[t.path] = st
+                keys[t.path] = t.image_key
+    if not stats:
+        return None
+    paths = sorted(stats)
+    indexpath = _index_path(directory, tile_px)
+    index = _read_index(indexpath, tile_px)
+    files, key_slots = index['files'], index['keys']
+    if index['data'] is not None and all(
+            p in files and tuple(files[p][:2]) == stats[p] and files[p][2] in key_slots for p in paths):
+        try:
+            return _atlas_for(directory, index, paths)
+        except OSError:
+            # the data file went away; start again
+            index = _empty_index(tile_px)
+    try:
+        return _build(tiles, tile_px, imagecache, directory, index, stats, keys)
+    except OSError:
+        if index['data'] is None:
+            raise
+        return _build(tiles, tile_px, imagecache, directory, _empty_index(tile_px), stats, keys)
+
+def _build(
+        tiles:List[Tile],
+        tile_px:int,
+        imagecache:ImageCache,
+        directory:str,
+        index:Dict[str, Any],
+        stats:Dict[str, Tuple[int, int]],
+        keys:Dict[str, str],
+        ) -> Optional[TileAtlas]:
+    os.makedirs(directory, exist_ok=True)
+    tile_nbytes = tile_px * tile_px * 3
+    # Forget files that changed, and ones from other tilesets that are gone.
+    # An image filed under its path rather than a hash has to be decoded
+    # again if it changed.
+    key_slots: Dict[str, int] = dict(index['keys'])
+    for path, entry in index['files'].items():
+        if path in stats and tuple(entry[:2]) != stats[path] and entry[2] == path:
+            key_slots.pop(path, None)
+    files = {
+        path: entry for path, entry in index['files'].items()
+        if (tuple(entry[:2]) == stats[path] if path in stats else os.path.isfile(path))
+        }
+    new: Dict[str, bytes] = {}
+    for path in sorted(stats):
+        if path in files:
+            continue
+        key = keys[path]
+        if key not in key_slots and key not in new:
+            try:
+                img = imagecache.get_scaled(path, (tile_px, tile_px), key=key)
+            except Exception:
+                continue
+            if img.mode != 'RGB':
+                key_slots[key] = -1
+            else:
+                new[key] = img.tobytes()
+        files[path] = list(stats[path]) + [key]
+
+    live = {entry[2] for entry in files.values()}
+    stored = {key: slot for key, slot in key_slots.items() if slot >= 0}
+    dead = [key for key in stored if key not in live]
+    compact = len(dead) * 2 > len(stored)
+    datapath = None if index['data'] is None else os.path.join(directory, index['data'])
+    if new or compact or datapath is None:
+        if compact:
+            kept = sorted((slot, key) for key, slot in stored.items() if key in live)
+        else:
+            kept = sorted((slot, key) for key, slot in stored.items())
+        def write(fp:Any) -> None:
+            # the old tiles are copied, not decoded again
+            if kept:
+                assert datapath is not None
+                with open(datapath, 'rb') as old:
+                    for slot, _ in kept:
+                        old.seek(slot * tile_nbytes)
+                        data = old.read(tile_nbytes)
+                        if len(data) != tile_nbytes:
+                            raise OSError('{} is truncated'.format(datapath))
+                        fp.write(data)
+            for data in new.values():
+                fp.write(data)
+        key_slots = {key: slot for key, slot in key_slots.items() if slot < 0 and key in live}
+        key_slots.update((key, n) for n, (_, key) in enumerate(kept))
+        key_slots.update((key, len(kept) + n) for n, key in enumerate(new))
+        # a new name each time, as the old file may be mapped by others
+        fd, tmppath = tempfile.mkstemp(dir=directory, prefix='px{}-'.format(tile_px), suffix='.rgb')
+        os.close(fd)
+        _write_atomic(directory, tmppath, write, 'wb')
+        datapath = tmppath
+        index = dict(index, data=os.path.basename(datapath), count=len(kept) + len(new))
+    index = dict(index, files=files, keys=key_slots)
+    # The index is written last, so its presence means the data is complete.
+    _write_atomic(directory, _index_path(directory, tile_px), lambda fp: json.dump(index, fp))
+    _remove_superseded(directory, tile_px, index['data'])
+    return _atlas_for(directory, index, sorted(stats))
@@ -0,0 +1,205 @@
+'''
+Benchmarks for the scan, generate, compose and display stages.
+
+Builds synthetic tile libraries, times each stage over the engagement
+ranges and tile sizes, and writes the results as JSON, which can be
+compared against an earlier run with --compare. Doesn't need Tk.
+
+    python bench.py --out after.json --compare before.json
+'''
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from PIL import Image, ImageDraw
+import grid
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    resource = None # type: ignore
+
+# name, side size, middle size, special limit (from jrpg_specs.txt)
+ENGAGEMENT_RANGES = [
+    ('very_short', 3, 1, 1),
+    ('short',      3, 3, 1),
+    ('medium',     6, 3, 1),
+    ('long',       6, 6, 2),
+    ('very_long',  6, 9, 3),
+    ]
+DISPLAY_SIZE = (1380, 600)
+
+def make_library(folder:str, count:int, source_px:int) -> None:
+    '''
+    Writes `count` distinct images laid out like a real tile library, so
+    load_tile gives them a spread of locations, blanks, specials and
+    repeatability.
+    '''
+    rng = random.Random(count * 100003 + source_px)
+    locations = ['Upper', 'Side', 'Middle']
+    weights = ['05_Very_Rare', '10_Rare', '15_Uncommon', '25_Common', '45_Very_Common']
+    for i in range(count):
+        location = locations[i % 3]
+        blank = (i // 3) % 3 == 0
+        special = location == 'Middle' and not blank and i % 7 == 5
+        repeatable = i % 5 != 0
+        path = os.path.join(
+            folder,
+            location,
+            weights[i % len(weights)],
+            'Special' if special else 'Normal',
+            'Repeatable' if repeatable else 'Nonrepeatable',
+            '{}_{}.png'.format('Blank' if blank else 'tile', i),
+            )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        img = Image.new('RGB', (source_px, source_px), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(8):
+            x0, y0 = rng.randrange(source_px), rng.randrange(source_px)
+            x1, y1 = rng.randrange(x0, source_px+1), rng.randrange(y0, source_px+1)
+            draw.rectangle((x0, y0, x1, y1), fill=tuple(rng.randrange(256) for _ in range(3)))
+        img.save(path)
+
+def library(workdir:str, count:int, source_px:int) -> str:
+    '''
+    Path to the synthetic library, building it if it isn't already there.
+    '''
+    folder = os.path.join(workdir, 'lib-{}-{}'.format(count, source_px))
+    marker = os.path.join(folder, '.complete')
+    if not os.path.isfile(marker):
+        make_library(folder, count, source_px)
+        open(marker, 'w').close()
+    return folder
+
+def measure(fn:Callable[[], Any], repeat:int) -> Dict[str, Any]:
+    '''
+    Times fn `repeat` times, then runs it once more under tracemalloc for
+    its peak Python heap usage. Pillow's pixel buffers aren't allocated
+    through Python, so they don't show up in peak_bytes; max_rss_bytes
+    (where available) is the process-wide high water mark.
+    '''
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result = {
+        'n': repeat,
+        'min_s': min(times),
+        'median_s': statistics.median(times),
+        'mean_s': statistics.mean(times),
+        'peak_bytes': peak,
+        }
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        result['max_rss_bytes'] = rss if sys.platform == 'darwin' else rss * 1024
+    return result
+
+def run(
+        workdir:str,
+        counts:List[int],
+        source_pxs:List[int],
+        tile_pxs:List[int],
+        heights:List[int],
+        repeat:int,
+        max_pixels:int,
+        ) -> Iterator[Dict[str, Any]]:
+    for count in counts:
+        for source_px in source_pxs:
+            if count * source_px * source_px > max_pixels:
+                continue
+            folder = library(workdir, count, source_px)
+            params: Dict[str, Any] = {'tiles': count, 'source_px': source_px}
+            yield dict(params, stage='scan', **measure(lambda: grid.tiles_from_folders(folder), repeat))
+            tiles = grid.tiles_from_folders(folder)
+            yield dict(params, stage='plan', **measure(lambda: grid.TilesetPlan(tiles), repeat))
+            plan = grid.TilesetPlan(tiles)
+            for name, side_size, middle_size, special_limit in ENGAGEMENT_RANGES:
+                for height in heights:
+                    params = {'tiles': count, 'source_px': source_px, 'range': name, 'height': height}
+                    def generate() -> grid.Grid:
+                        return grid.make_grid(plan, 30, 30, special_limit, middle_size, side_size, height)
+                    yield dict(params, stage='generate', **measure(generate, repeat))
+                    g = generate()
+                    for tile_px in tile_pxs:
+                        params = dict(params, tile_px=tile_px)
+                        def compose_cold() -> Image.Image:
+                            return grid.make_grid_image(g, grid.ImageCache(), tile_px)
+                        cache = grid.ImageCache()
+                        def compose_warm() -> Image.Image:
+                            return grid.make_grid_image(g, cache, tile_px)
+                        yield dict(params, stage='compose_cold', **measure(compose_cold, repeat))
+                        img = compose_warm()
+                        yield dict(params, stage='compose_warm', **measure(compose_warm, repeat))
+                        yield dict(params, stage='display_resize', **measure(lambda: grid.resize_image(img, *DISPLAY_SIZE), repeat))
+                        yield dict(params, stage='display_pyramid_build', **measure(lambda: grid.make_pyramid(img), repeat))
+                        pyramid = grid.make_pyramid(img)
+                        yield dict(params, stage='display_pyramid', **measure(lambda: grid.resize_from_pyramid(pyramid, *DISPLAY_SIZE), repeat))
+
+def result_key(result:Dict[str, Any]) -> Tuple:
+    return tuple((k, result.get(k)) for k in ('stage', 'tiles', 'source_px', 'range', 'height', 'tile_px'))
+
+def compare(results:List[Dict[str, Any]], baseline:List[Dict[str, Any]]) -> None:
+    '''
+    Prints the ratio of median times (new/old) for each result that is in
+    both runs. Below 1 is faster.
+    '''
+    old = {result_key(r): r for r in baseline}
+    for r in results:
+        b = old.get(result_key(r))
+        if b is None or not b['median_s']:
+            continue
+        label = ' '.join('{}={}'.format(k, v) for k, v in result_key(r) if v is not None)
+        print('{:6.2f}x  {}'.format(r['median_s'] / b['median_s'], label))
+
+def int_list(text:str) -> List[int]:
+    return [int(x) for x in text.split(',') if x]
+
+def main(argv:Optional[List[str]]=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tiles', type=int_list, default=[10, 100, 1000, 10000], help='Library sizes (default: %(default)s).')
+    parser.add_argument('--source-px', type=int_list, default=[64, 256, 1024], help='Source image sizes (default: %(default)s).')
+    parser.add_argument('--tile-px', type=int_list, default=[50, 250, 500], help='Rendered tile sizes (default: %(default)s).')
+    parser.add_argument('--heights', type=int_list, default=[2, 3], help='Grid heights (default: %(default)s).')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-pixels', type=int, default=1100*1000*1000,
+        help='Skip libraries with more source pixels than this in total (default: %(default)s).')
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'jefftiles-bench'),
+        help='Where synthetic libraries are built and kept between runs.')
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--compare', help='Earlier results to compare against.')
+    args = parser.parse_args(argv)
+
+    results = []
+    for result in run(args.workdir, args.tiles, args.source_px, args.tile_px, args.heights, args.repeat, args.max_pixels):
+        results.append(result)
+        label = ' '.join('{}={}'.format(k, v) for k, v in result_key(result) if v is not None)
+        print('{:10.3f}ms  {}'.format(result['median_s']*1000, label), flush=True)
+    meta = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'pillow': Image.__version__,
+        'args': vars(args),
+        }
+    with open(args.out, 'w') as fp:
+        json.dump({'meta': meta, 'results': results}, fp, indent=1)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp)['results'])
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,197 @@
 import enum
-from typing import List, NamedTuple, Optional, Tuple
+from typing import AbstractSet, Any, BinaryIO, Callable, Deque, Dict, Hashable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple, Union, TYPE_CHECKING
+from collections import OrderedDict, deque
+from array import array
 from dataclasses import dataclass
 from PIL import Image
+from instrument import span
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import hashlib
+import heapq
+import json
+import math
 import random
-import glob
 import os
 import re
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+if TYPE_CHECKING:
+    from atlas import TileAtlas
+try:
+    import numpy as np
+except ImportError:
+    np = None # type: ignore
+
+# What get_rng(None) hands out. Process pool initializers reseed it, so
+# forked workers don't all make the same maps.
+_rng = random.Random()
+
+def get_rng(rng:Union[None, int, str, random.Random]=None) -> random.Random:
+    '''
+    None means this module's shared Random, an int or str is a seed for a
+    new Random, and a Random is used as is.
+    '''
+    if rng is None:
+        return _rng
+    if isinstance(rng, random.Random):
+        return rng
+    return random.Random(rng)
 
 class Grid:
-    def __init__(self, width:int, height:int):
-        self.upper:        List[List['Tile']] = [ [] for _ in range(height-1)]
-        self.bottom_left:  List['Tile'] = []
-        self.bottom_right: List['Tile'] = []
-        self.middle:       List['Tile'] = []
+    '''
+    The tiles of a map as one uint16 per cell, row major from the top, each
+    an index into `tiles`. The bottom row is laid out as the left side, the
+    middle and the right side, side_size, width - 2*side_size and side_size
+    cells long.
+
+    `tiles` is usually the tileset the grid was made from and is shared
+    between grids, not copied, so a grid costs little more than its cells.
+    If set_cell puts in a tile that isn't in it, the grid gets its own copy.
+
+    upper, bottom_left, middle and bottom_right are there for older code.
+    They build new lists, so assign to them (or use set_cell) rather than
+    changing them in place.
+    '''
+    __slots__ = ('width', 'height', 'side_size', 'tiles', 'cells')
+    def __init__(
+            self,
+            width:int,
+            height:int,
+            side_size:int,
+            tiles:Optional[List['Tile']]=None,
+            cells:Optional[array]=None,
+            ):
+        if cells is None:
+            cells = array('H', bytes(2 * width * height))
+        if len(cells) != width * height:
+            raise ValueError('Expected {} cells, got {}'.format(width * height, len(cells)))
         self.width  = width
         self.height = height
+        self.side_size = side_size
+        self.tiles: List['Tile'] = [] if tiles is None else tiles
+        self.cells = cells
+
+    def __getstate__(self) -> Tuple:
+        return (self.width, self.height, self.side_size, self.tiles, self.cells)
+
+    def __setstate__(self, state:Tuple) -> None:
+        self.width, self.height, self.side_size, self.tiles, self.cells = state
+
+    @property
+    def middle_size(self) -> int:
+        return self.width - 2 * self.side_size
+
+    def _tiles_at(self, start:int, stop:int) -> List['Tile']:
+        tiles = self.tiles
+        return [tiles[i] for i in self.cells[start:stop]]
+
+    def _put(self, start:int, stop:int, tiles:List['Tile']) -> None:
+        if len(tiles) != stop - start:
+            raise ValueError('Expected {} tiles, got {}'.format(stop - start, len(tiles)))
+        for offset, tile in enumerate(tiles):
+            self.cells[start + offset] = self.intern(tile)
+
+    @property
+    def upper(self) -> List[List['Tile']]:
+        w = self.width
+        return [self._tiles_at(row*w, (row+1)*w) for row in range(self.height-1)]
+
+    @upper.setter
+    def upper(self, rows:List[List['Tile']]) -> None:
+        if len(rows) != self.height - 1:
+            raise ValueError('Expected {} upper rows, got {}'.format(self.height - 1, len(rows)))
+        for row, tiles in enumerate(rows):
+            self._put(row*self.width, (row+1)*self.width, tiles)
+
+    def _bottom_span(self, segment:int) -> Tuple[int, int]:
+        # 0, 1, 2 are the left side, the middle and the right side
+        start = (self.height - 1) * self.width
+        bounds = [start, start + self.side_size, start + self.width - self.side_size, start + self.width]
+        return bounds[segment], bounds[segment+1]
+
+    @property
+    def bottom_left(self) -> List['Tile']:
+        return self._tiles_at(*self._bottom_span(0))
+
+    @bottom_left.setter
+    def bottom_left(self, tiles:List['Tile']) -> None:
+        self._put(*self._bottom_span(0), tiles)
+
+    @property
+    def middle(self) -> List['Tile']:
+        return self._tiles_at(*self._bottom_span(1))
 
-    def shuffle(self):
-        for l in [self.bottom_left, self.bottom_right, self.middle] + self.upper:
-            random.shuffle(l)
+    @middle.setter
+    def middle(self, tiles:List['Tile']) -> None:
+        self._put(*self._bottom_span(1), tiles)
+
+    @property
+    def bottom_right(self) -> List['Tile']:
+        return self._tiles_at(*self._bottom_span(2))
+
+    @bottom_right.setter
+    def bottom_right(self, tiles:List['Tile']) -> None:
+        self._put(*self._bottom_span(2), tiles)
+
+    def rows(self) -> List[List['Tile']]:
+        w = self.width
+        return [self._tiles_at(row*w, (row+1)*w) for row in range(self.height)]
+
+    def intern(self, tile:'Tile') -> int:
+        '''
+        Index of this very Tile object in self.tiles, adding it if need be.
+        '''
+        for i, t in enumerate(self.tiles):
+            if t is tile:
+                return i
+        # don't add to a tileset that other grids (or the caller) share
+        self.tiles = self.tiles + [tile]
+        return len(self.tiles) - 1
+
+    def shuffle(self, rng:Optional[random.Random]=None):
+        rng = get_rng(rng)
+        w = self.width
+        spans = [self._bottom_span(0), self._bottom_span(2), self._bottom_span(1)]
+        spans += [(row*w, (row+1)*w) for row in range(self.height-1)]
+        for start, stop in spans:
+            part = list(self.cells[start:stop])
+            rng.shuffle(part)
+            self.cells[start:stop] = array('H', part)
+
+    def copy(self) -> 'Grid':
+        return Grid(self.width, self.height, self.side_size, self.tiles, array('H', self.cells))
+
+    def cell(self, row:int, col:int) -> 'Tile':
+        return self.tiles[self.cells[row*self.width + col]]
+
+    def set_cell(self, row:int, col:int, tile:'Tile') -> None:
+        self.cells[row*self.width + col] = self.intern(tile)
+
+    def cells_with(self, tile:'Tile') -> List[Tuple[int, int]]:
+        '''
+        (row, col) of every cell holding this very Tile object.
+        '''
+        wanted = {i for i, t in enumerate(self.tiles) if t is tile}
+        return [divmod(n, self.width) for n, i in enumerate(self.cells) if i in wanted]
+
+    def reroll(
+            self,
+            row:int,
+            col:int,
+            tileset:Union[List['Tile'], 'TilesetPlan'],
+            lower_blank_percentage:float,
+            upper_blank_percentage:float,
+            special_limit:int,
+            rng:Union[None, int, str, random.Random]=None,
+            change:bool=False,
+            ) -> 'Tile':
+        return reroll_cell(self, row, col, tileset, lower_blank_percentage, upper_blank_percentage, special_limit, rng, change)
 
 @enum.unique
 class TileLocation(enum.Flag):
@@ -28,6 +201,10 @@ class TileLocation(enum.Flag):
 
 @dataclass
 class Tile:
+    # Slotted rather than frozen, as the tile configurer edits tiles in
+    # place. None of the fields have defaults, which is what lets
+    # __slots__ and @dataclass go together.
+    __slots__ = ('name', 'path', 'repeatable', 'weight', 'middle', 'side', 'upper', 'biome', 'special', 'is_blank', 'digest')
     name: str
     path: str
     repeatable: bool
@@ -38,125 +215,1627 @@ class Tile:
     biome: str
     special: bool
     is_blank: bool
+    # content hash of the image file, '' if it hasn't been hashed
+    digest: str
+
+    @property
+    def image_key(self) -> str:
+        '''
+        What the image caches file this tile's image under: the content
+        hash, so copies of one file in different folders or tilesets share
+        an entry, or the path if there is no hash.
+        '''
+        return self.digest or self.path
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+    def __setstate__(self, state:Any) -> None:
+        # Tiles pickled before they had slots carry their __dict__.
+        if isinstance(state, tuple):
+            state = {k: v for part in state if part for k, v in part.items()}
+        self.digest = ''
+        for attr, value in state.items():
+            setattr(self, attr, value)
+
+class WeightedSampler:
+    '''
+    Walker alias table over a fixed list of weighted tiles, so each draw is
+    O(1) regardless of how many tiles there are.
+    `indices` are the positions of `tiles` in the tileset it was built from.
+    '''
+    def __init__(self, tiles:List[Tile], indices:List[int]):
+        self.tiles = tiles
+        self.indices = indices
+        self.weights = [t.weight for t in tiles]
+        n = len(tiles)
+        total = sum(self.weights)
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        self._arrays: Optional[Tuple['np.ndarray', 'np.ndarray']] = None
+        if total <= 0:
+            return
+        scaled = [w * n / total for w in self.weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # whatever is left over is 1.0 up to rounding error
+
+    def __len__(self) -> int:
+        return len(self.tiles)
+
+    def sample(self, rng:Optional[random.Random]=None) -> int:
+        '''
+        Returns the position in `tiles` of a weighted random choice.
+        '''
+        rng = get_rng(rng)
+        n = len(self.tiles)
+        if not n:
+            raise IndexError('Cannot choose from an empty sequence')
+        i = int(rng.random() * n)
+        if rng.random() < self.prob[i]:
+            return i
+        return self.alias[i]
+
+    def select(self, rng:Optional[random.Random]=None) -> Tile:
+        return self.tiles[self.sample(rng)]
+
+    def draw_indices(self, rng:'np.random.Generator', size:int) -> 'np.ndarray':
+        '''
+        Vectorized version of sample: `size` weighted tileset indices.
+        '''
+        if not size:
+            return np.empty(0, dtype=np.intp)
+        if not self.tiles:
+            raise IndexError('Cannot choose from an empty sequence')
+        if self._arrays is None:
+            self._arrays = (
+                np.cumsum(np.asarray(self.weights, dtype=np.float64)),
+                np.asarray(self.indices, dtype=np.intp),
+                )
+        cum_weights, indices = self._arrays
+        u = rng.random(size) * cum_weights[-1]
+        pos = np.searchsorted(cum_weights, u, side='right')
+        return indices[np.minimum(pos, len(indices)-1)]
+
+class TilesetPlan:
+    '''
+    A tileset split up into the categories make_grid draws from, with a
+    sampler for each. Building one is O(len(tileset)); after that,
+    make_grid only does work proportional to the grid size.
+
+    The plan is a snapshot: rebuild it if tiles are added, removed or
+    edited.
+    '''
+    def __init__(self, tileset:List[Tile]):
+        self.tileset = list(tileset)
+        categories: Dict[str, Tuple[List[Tile], List[int]]] = {
+            name: ([], []) for name in (
+                'upper_blanks', 'upper_nonblanks',
+                'side_blanks', 'side_nonblanks',
+                'middle_blanks', 'middle_nonblanks',
+                'middle_nonspecials',
+                )
+            }
+        def add(name:str, i:int, t:Tile) -> None:
+            tiles, indices = categories[name]
+            tiles.append(t)
+            indices.append(i)
+        for i, t in enumerate(self.tileset):
+            blank = 'blanks' if t.is_blank else 'nonblanks'
+            if t.upper:
+                add('upper_'+blank, i, t)
+            if t.side:
+                add('side_'+blank, i, t)
+            if t.middle:
+                add('middle_'+blank, i, t)
+                if not t.is_blank and not t.special:
+                    add('middle_nonspecials', i, t)
+        self.upper_blanks       = WeightedSampler(*categories['upper_blanks'])
+        self.upper_nonblanks    = WeightedSampler(*categories['upper_nonblanks'])
+        self.side_blanks        = WeightedSampler(*categories['side_blanks'])
+        self.side_nonblanks     = WeightedSampler(*categories['side_nonblanks'])
+        self.middle_blanks      = WeightedSampler(*categories['middle_blanks'])
+        self.middle_nonblanks   = WeightedSampler(*categories['middle_nonblanks'])
+        self.middle_nonspecials = WeightedSampler(*categories['middle_nonspecials'])
+        self.repeatable = [t.repeatable for t in self.tileset]
+        self.special    = [t.special for t in self.tileset]
+        # Tiles count as the same tile, for the no repeats rule, if they
+        # have the same image or the same name, e.g. a pit imported from
+        # both the Side and the Middle folders. same[i] is the lowest
+        # index of a tile that is the same as tile i.
+        self.same = list(range(len(self.tileset)))
+        def find(i:int) -> int:
+            while self.same[i] != i:
+                self.same[i] = self.same[self.same[i]]
+                i = self.same[i]
+            return i
+        firsts: Dict[Tuple[str, str], int] = {}
+        for i, t in enumerate(self.tileset):
+            for key in (('image', t.image_key), ('name', t.name)):
+                j = firsts.setdefault(key, i)
+                a, b = find(i), find(j)
+                if a != b:
+                    self.same[max(a, b)] = min(a, b)
+        self.same = [find(i) for i in range(len(self.tileset))]
+
 
-def select(tiles:List[Tile])->Tile:
-    return random.choices(tiles, weights=[t.weight for t in tiles])[0]
+class GridSolver:
+    '''
+    Assigns a tile to every cell of a grid, where each cell draws from its
+    own weighted domains, subject to:
+      - a non-repeatable tile can't be next to (left, right, above or
+        below) the same tile, where tiles with the same image or name
+        count as the same (see TilesetPlan.same).
+      - at most special_limit specials in the middle of the bottom row.
+
+    Each cell has a preferred domain (e.g. blanks, if the coin said blank)
+    and a fallback (non-blanks), which is only drawn from when nothing in
+    the preferred one fits.
+
+    Cells are visited in a random order. Each one is drawn from its domain,
+    leaving out whatever its assigned neighbours and the special count rule
+    out, and also any tile that would leave a neighbour with nothing to
+    pick. If a cell has nothing left, we back up to the previous cell and
+    try another tile there. Draws are O(1) rejection sampling from the
+    alias tables (falling back to a scan of the domain if that keeps
+    missing), so solving is linear in the number of cells unless the
+    constraints are nearly unsatisfiable.
+    '''
+    MAX_REJECTIONS = 8
+    def __init__(self, plan:TilesetPlan, special_limit:int, side_size:int, middle_size:int, height:int):
+        self.plan = plan
+        self.special_limit = special_limit
+        self.width = side_size * 2 + middle_size
+        self.height = height
+        bottom = (height - 1) * self.width
+        self.middle_cells = set(range(bottom + side_size, bottom + side_size + middle_size))
+
+    def neighbours(self, cell:int) -> List[int]:
+        row, col = divmod(cell, self.width)
+        result = []
+        if col > 0:
+            result.append(cell - 1)
+        if col < self.width - 1:
+            result.append(cell + 1)
+        if row > 0:
+            result.append(cell - self.width)
+        if row < self.height - 1:
+            result.append(cell + self.width)
+        return result
+
+    def solve(self, domains:List[Tuple[WeightedSampler, ...]], rng:Optional[random.Random]=None, max_backtracks:int=10000) -> List[int]:
+        '''
+        domains is the samplers for each cell, row major, preferred first.
+        Returns the tileset index chosen for each cell, row major. Raises
+        ValueError if the constraints can't be satisfied.
+        '''
+        n = self.width * self.height
+        assert len(domains) == n
+        for cell_domains in domains:
+            if not any(cell_domains):
+                raise IndexError('Cannot choose from an empty sequence')
+        rng = get_rng(rng)
+        order = list(range(n))
+        rng.shuffle(order)
+        assignment = [-1] * n
+        # tiles already tried and backtracked out of at each step
+        tried: List[Set[int]] = [set() for _ in range(n)]
+        special_count = 0
+        backtracks = 0
+        step = 0
+        while step < n:
+            cell = order[step]
+            choice = self._choose(cell, domains, assignment, tried[step], special_count, rng)
+            if choice is not None:
+                assignment[cell] = choice
+                if cell in self.middle_cells and self.plan.special[choice]:
+                    special_count += 1
+                step += 1
+                continue
+            tried[step].clear()
+            step -= 1
+            backtracks += 1
+            if step < 0 or backtracks > max_backtracks:
+                raise ValueError('Unable to make a grid that satisfies the constraints')
+            cell = order[step]
+            tried[step].add(assignment[cell])
+            if cell in self.middle_cells and self.plan.special[assignment[cell]]:
+                special_count -= 1
+            assignment[cell] = -1
+        return assignment
+
+    def _choose(
+            self,
+            cell:int,
+            domains:List[Tuple[WeightedSampler, ...]],
+            assignment:List[int],
+            tried:Set[int],
+            special_count:int,
+            rng:random.Random,
+            ) -> Optional[int]:
+        assigned: List[int] = []
+        unassigned: List[Tuple[WeightedSampler, ...]] = []
+        for nb in self.neighbours(cell):
+            t = assignment[nb]
+            if t < 0:
+                unassigned.append(domains[nb])
+            else:
+                assigned.append(t)
+        no_specials = cell in self.middle_cells and special_count >= self.special_limit
+        for domain in domains[cell]:
+            if not domain:
+                continue
+            choice = self._pick(domain, tried, assigned, no_specials, unassigned, rng)
+            if choice is not None:
+                return choice
+        return None
 
+    def _pick(
+            self,
+            domain:WeightedSampler,
+            excluded:Set[int],
+            assigned:List[int],
+            no_specials:bool,
+            unassigned:List[Tuple[WeightedSampler, ...]],
+            rng:random.Random,
+            ) -> Optional[int]:
+        '''
+        A weighted draw from domain of a tile that isn't in excluded, can go
+        next to the tiles in assigned, and isn't the only option left for
+        one of the unassigned neighbours. None if there isn't one.
+        '''
+        plan = self.plan
+        same = plan.same
+        repeatable = plan.repeatable
+        neighbour_tiles = {same[t] for t in assigned}
+        # no tile the same as a non-repeatable neighbour can go here
+        blocked = {same[t] for t in assigned if not repeatable[t]}
+        only_options: Set[int] = set()
+        for domains in unassigned:
+            if sum(len(d) for d in domains) == 1:
+                only_options.update(same[d.indices[0]] for d in domains if d)
+        def allowed(t:int) -> bool:
+            if t in excluded or same[t] in blocked:
+                return False
+            if no_specials and plan.special[t]:
+                return False
+            if not repeatable[t]:
+                if same[t] in neighbour_tiles:
+                    return False
+                # don't take a neighbour's only option
+                if same[t] in only_options:
+                    return False
+            return True
+        for _ in range(self.MAX_REJECTIONS):
+            t = domain.indices[domain.sample(rng)]
+            if allowed(t):
+                return t
+        candidates = [i for i, t in enumerate(domain.indices) if allowed(t) and domain.weights[i] > 0]
+        if not candidates:
+            return None
+        i = rng.choices(candidates, weights=[domain.weights[i] for i in candidates])[0]
+        return domain.indices[i]
 
 def make_grid(
-        tileset:List[Tile],
+        tileset:Union[List[Tile], TilesetPlan],
         lower_blank_percentage:float,
         upper_blank_percentage:float,
         special_limit:int,
         middle_size:int,
         side_size:int,
         height:int,
+        rng:Union[None, int, str, random.Random]=None,
         ) -> Grid:
-    width = side_size * 2 + middle_size
-    grid = Grid(width, height)
-    upper_blanks:List[Tile] = []
-    upper_nonblanks:List[Tile] = []
-    for t in (t for t in tileset if t.upper):
-        if t.is_blank:
-            upper_blanks.append(t)
-        else:
-            upper_nonblanks.append(t)
+    '''
+    Pass a seed or a Random as rng to make the grid reproducible (given the
+    same tileset and settings); by default a module-level Random is used.
+    '''
+    with span('make_grid'):
+        rng = get_rng(rng)
+        plan = tileset if isinstance(tileset, TilesetPlan) else TilesetPlan(tileset)
+        width = side_size * 2 + middle_size
 
-    for i in range(height-1):
-        upper = grid.upper[i]
-        for _ in range(width):
-            if random.random() * 100 < upper_blank_percentage:
-                upper.append(select(upper_blanks))
+        # Decide blank or not for each cell, which picks the domain it draws
+        # from; the solver then picks the actual tiles, taking the other
+        # kind if nothing of that kind fits.
+        domains: List[Tuple[WeightedSampler, ...]] = []
+        for i in range(height-1):
+            for _ in range(width):
+                if rng.random() * 100 < upper_blank_percentage:
+                    domains.append((plan.upper_blanks, plan.upper_nonblanks))
+                else:
+                    domains.append((plan.upper_nonblanks, plan.upper_blanks))
+        for col in range(width):
+            is_side = col < side_size or col >= side_size + middle_size
+            blanks, nonblanks = (plan.side_blanks, plan.side_nonblanks) if is_side else (plan.middle_blanks, plan.middle_nonblanks)
+            if rng.random() * 100 < lower_blank_percentage:
+                domains.append((blanks, nonblanks))
             else:
-                upper.append(select(upper_nonblanks))
+                domains.append((nonblanks, blanks))
 
-    side_blanks:List[Tile] = []
-    side_nonblanks:List[Tile] = []
-    for t in (t for t in tileset if t.side):
-        if t.is_blank:
-            side_blanks.append(t)
-        else:
-            side_nonblanks.append(t)
+        solver = GridSolver(plan, special_limit, side_size, middle_size, height)
+        cells = array('H', solver.solve(domains, rng))
+        return Grid(width, height, side_size, plan.tileset, cells)
 
-    middle_blanks:List[Tile] = []
-    middle_nonblanks:List[Tile] = []
-    for t in (t for t in tileset if t.middle):
-        if t.is_blank:
-            middle_blanks.append(t)
-        else:
-            middle_nonblanks.append(t)
-    # left
-    for _ in range(side_size):
-        if random.random() * 100 < lower_blank_percentage:
-            grid.bottom_left.append(select(side_blanks))
-        else:
-            grid.bottom_left.append(select(side_nonblanks))
-    # middle
-    for _ in range(middle_size):
-        if random.random() * 100 < lower_blank_percentage:
-            grid.middle.append(select(middle_blanks))
+def reroll_choice(
+        grid:Grid,
+        row:int,
+        col:int,
+        tileset:Union[List[Tile], TilesetPlan],
+        lower_blank_percentage:float,
+        upper_blank_percentage:float,
+        special_limit:int,
+        rng:Union[None, int, str, random.Random]=None,
+        change:bool=False,
+        ) -> Tile:
+    '''
+    Draws a new tile for one cell, following the same layer, blank,
+    adjacency and special limit rules as make_grid given the rest of the
+    grid, without putting it in. With change, the tile that is there now
+    (or one with the same image or name) isn't drawn. Raises ValueError if
+    nothing fits.
+    '''
+    rng = get_rng(rng)
+    plan = tileset if isinstance(tileset, TilesetPlan) else TilesetPlan(tileset)
+    side_size = grid.side_size
+    middle_size = grid.middle_size
+    solver = GridSolver(plan, special_limit, side_size, middle_size, grid.height)
+    positions = {id(t): i for i, t in enumerate(plan.tileset)}
+    cell = row * grid.width + col
+    assigned: List[int] = []
+    for nb in solver.neighbours(cell):
+        t = grid.cell(*divmod(nb, grid.width))
+        if id(t) in positions:
+            assigned.append(positions[id(t)])
+    excluded: Set[int] = set()
+    if change:
+        current = grid.cell(row, col)
+        excluded = {
+            i for i, t in enumerate(plan.tileset)
+            if t is current or t.image_key == current.image_key or t.name == current.name
+            }
+    no_specials = False
+    if cell in solver.middle_cells:
+        others = sum(t.special for i, t in enumerate(grid.middle) if i != col - side_size)
+        no_specials = others >= special_limit
+    if row < grid.height - 1:
+        blank = rng.random() * 100 < upper_blank_percentage
+        blanks, nonblanks = plan.upper_blanks, plan.upper_nonblanks
+    else:
+        blank = rng.random() * 100 < lower_blank_percentage
+        if side_size <= col < side_size + middle_size:
+            blanks, nonblanks = plan.middle_blanks, plan.middle_nonblanks
         else:
-            grid.middle.append(select(middle_nonblanks))
-    # right
-    for _ in range(side_size):
-        if random.random() * 100 < lower_blank_percentage:
-            grid.bottom_right.append(select(side_blanks))
+            blanks, nonblanks = plan.side_blanks, plan.side_nonblanks
+    # If nothing of the kind the coin picked fits here, take the other kind
+    # rather than fail.
+    for domain in ((blanks, nonblanks) if blank else (nonblanks, blanks)):
+        if not domain:
+            continue
+        choice = solver._pick(domain, excluded, assigned, no_specials, [], rng)
+        if choice is not None:
+            return plan.tileset[choice]
+    raise ValueError('No tile fits at row {}, column {}'.format(row, col))
+
+def reroll_cell(
+        grid:Grid,
+        row:int,
+        col:int,
+        tileset:Union[List[Tile], TilesetPlan],
+        lower_blank_percentage:float,
+        upper_blank_percentage:float,
+        special_limit:int,
+        rng:Union[None, int, str, random.Random]=None,
+        change:bool=False,
+        ) -> Tile:
+    '''
+    Replaces the tile in one cell with a reroll_choice. Returns the new tile.
+    '''
+    tile = reroll_choice(grid, row, col, tileset, lower_blank_percentage, upper_blank_percentage, special_limit, rng, change)
+    grid.set_cell(row, col, tile)
+    return tile
+
+# A scorer rates a grid from 0 (bad) to 1 (good) by whatever a designer
+# cares about. Any picklable function will do, e.g. one defined at the top
+# level of a module.
+Scorer = Callable[[Grid], float]
+
+def score_blank_balance(grid:Grid) -> float:
+    '''
+    How evenly the blanks are split between the left and right halves.
+    '''
+    blank = [t.is_blank for t in grid.tiles]
+    w = grid.width
+    half = w // 2
+    left = right = 0
+    for n, i in enumerate(grid.cells):
+        if blank[i]:
+            col = n % w
+            if col < half:
+                left += 1
+            elif col >= w - half:
+                right += 1
+    total = left + right
+    return 1.0 - abs(left - right) / total if total else 1.0
+
+def score_specials_centered(grid:Grid) -> float:
+    '''
+    How close the specials are to the middle column, on average. Maps
+    without any score 0.
+    '''
+    special = [t.special for t in grid.tiles]
+    center = (grid.width - 1) / 2
+    closeness = [
+        1.0 - abs(n % grid.width - center) / center if center else 1.0
+        for n, i in enumerate(grid.cells) if special[i]
+        ]
+    return sum(closeness) / len(closeness) if closeness else 0.0
+
+def score_specials_in_middle(grid:Grid) -> float:
+    '''
+    The share of specials that are in the middle of the bottom row rather
+    than on the sides or up above. Maps without any score 0.
+    '''
+    special = [t.special for t in grid.tiles]
+    total = sum(special[i] for i in grid.cells)
+    if not total:
+        return 0.0
+    start, stop = grid._bottom_span(1)
+    return sum(special[i] for i in grid.cells[start:stop]) / total
+
+def score_common(grid:Grid) -> float:
+    '''
+    Mean weight of the non-blank tiles, so maps of common tiles score high.
+    '''
+    weights = [t.weight for t in grid.tiles]
+    blank = [t.is_blank for t in grid.tiles]
+    used = [weights[i] for i in grid.cells if not blank[i]]
+    return min(1.0, sum(used) / len(used) / 100) if used else 0.0
+
+def score_rare(grid:Grid) -> float:
+    return 1.0 - score_common(grid)
+
+def score_variety(grid:Grid) -> float:
+    '''
+    Distinct non-blank images over non-blank cells, so repeats score low.
+    '''
+    blank = [t.is_blank for t in grid.tiles]
+    used = [i for i in grid.cells if not blank[i]]
+    if not used:
+        return 0.0
+    return len({grid.tiles[i].image_key for i in set(used)}) / len(used)
+
+SCORERS: Dict[str, Scorer] = {
+    'blank_balance': score_blank_balance,
+    'specials_centered': score_specials_centered,
+    'specials_in_middle': score_specials_in_middle,
+    'common': score_common,
+    'rare': score_rare,
+    'variety': score_variety,
+    }
+DEFAULT_SCORERS = 'blank_balance,specials_centered,variety'
+
+def parse_scorers(text:str) -> List[Tuple[Scorer, float]]:
+    '''
+    Reads 'name' or 'name:weight' separated by commas, e.g.
+    'blank_balance:2,specials_centered', into (scorer, weight) pairs.
+    '''
+    scorers = []
+    for part in text.split(','):
+        if not part:
+            continue
+        name, _, weight = part.partition(':')
+        if name not in SCORERS:
+            raise ValueError('Unknown scorer {!r} (expected one of {})'.format(name, ', '.join(SCORERS)))
+        try:
+            scorers.append((SCORERS[name], float(weight) if weight else 1.0))
+        except ValueError:
+            raise ValueError('Bad weight for {}: {!r}'.format(name, weight))
+    return scorers
+
+def score_grid(grid:Grid, scorers:List[Tuple[Scorer, float]]) -> float:
+    '''
+    Weighted mean of the scorers, from 0 to 1.
+    '''
+    total = sum(weight for _, weight in scorers)
+    if not total:
+        return 0.0
+    return sum(scorer(grid) * weight for scorer, weight in scorers) / total
+
+class ScoredGrid(NamedTuple):
+    score: float
+    # make_grid with this as rng gives the same grid again
+    seed: str
+    grid: Grid
+
+class _ScoreState(NamedTuple):
+    plan: TilesetPlan
+    settings: Tuple[float, float, int, int, int, int]
+    scorers: List[Tuple[Scorer, float]]
+    seed: int
+    k: int
+
+_score_state: Optional[_ScoreState] = None
+
+def _score_init(state:_ScoreState) -> None:
+    global _score_state
+    _score_state = state
+
+def _candidate_seed(seed:int, n:int) -> str:
+    return '{}:{}'.format(seed, n)
+
+def _score_range(bounds:Tuple[int, int]) -> List[Tuple[float, int]]:
+    '''
+    The best k (score, candidate number) pairs of a run of candidates, best
+    first. Ties go to the earlier candidate. Candidates that can't be laid
+    out are left out.
+    '''
+    assert _score_state is not None
+    plan, settings, scorers, seed, k = _score_state
+    scored = []
+    for n in range(*bounds):
+        try:
+            grid = make_grid(plan, *settings, rng=_candidate_seed(seed, n))
+        except (ValueError, IndexError):
+            # no layout fits (IndexError: some cell has nothing to choose from)
+            continue
+        scored.append((score_grid(grid, scorers), n))
+    return heapq.nsmallest(k, scored, key=lambda sn: (-sn[0], sn[1]))
+
+def best_grids(
+        tileset:Union[List[Tile], TilesetPlan],
+        lower_blank_percentage:float,
+        upper_blank_percentage:float,
+        special_limit:int,
+        middle_size:int,
+        side_size:int,
+        height:int,
+        n:int,
+        k:int=1,
+        scorers:Optional[List[Tuple[Scorer, float]]]=None,
+        seed:Optional[int]=None,
+        workers:Optional[int]=None,
+        ) -> List[ScoredGrid]:
+    '''
+    Lays out n candidate grids (without rendering any), scores them and
+    returns the best k, best first. Takes the same settings as make_grid;
+    scorers default to DEFAULT_SCORERS.
+
+    Candidate i is make_grid with rng '<seed>:<i>', so with a seed the
+    result is reproducible however the work is split up. The candidates
+    are spread over `workers` processes (by default one per CPU; 0 or 1 to
+    do them all here, which is quicker for a few hundred). Only scores come
+    back from the workers; the winners are laid out again here.
+
+    Candidates that can't be laid out are skipped; make_grid's error is only
+    raised if none of them can.
+    '''
+    if n < 1 or k < 1:
+        raise ValueError('n and k should be at least 1')
+    with span('best_grids'):
+        plan = tileset if isinstance(tileset, TilesetPlan) else TilesetPlan(tileset)
+        settings = (lower_blank_percentage, upper_blank_percentage, special_limit, middle_size, side_size, height)
+        if scorers is None:
+            scorers = parse_scorers(DEFAULT_SCORERS)
+        if seed is None:
+            seed = random.getrandbits(31)
+        state = _ScoreState(plan, settings, scorers, seed, k)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        # a few chunks per worker, so one slow chunk doesn't hold up the end
+        chunks = min(n, max(1, workers) * 4)
+        edges = [n * c // chunks for c in range(chunks + 1)]
+        spans = list(zip(edges, edges[1:]))
+        if min(workers, chunks) <= 1:
+            _score_init(state)
+            results = [_score_range(s) for s in spans]
         else:
-            grid.bottom_right.append(select(side_nonblanks))
-
-    # apply constraint - only 1 special
-    special_count = 0
-    for t in grid.middle:
-        if t.special:
-            special_count += 1
-    if special_count > special_limit:
-        specials = [t for t in grid.middle if t.special]
-        nonspecials = [t for t in grid.middle if not t.special]
-        middle_nonspecials = [t for t in middle_nonblanks if not t.special]
-        new_middle: List[Tile] = nonspecials
-        new_middle.append(select(specials))
-        while len(new_middle) < middle_size:
-            new_middle.append(select(middle_nonspecials))
-        grid.middle = new_middle
-    grid.shuffle()
-    return grid
+            with ProcessPoolExecutor(max_workers=min(workers, chunks), initializer=_score_init, initargs=(state,)) as pool:
+                results = list(pool.map(_score_range, spans))
+        best = heapq.nsmallest(k, (sn for result in results for sn in result), key=lambda sn: (-sn[0], sn[1]))
+        if not best:
+            # raises why candidate 0 failed, as they all did
+            make_grid(plan, *settings, rng=_candidate_seed(seed, 0))
+            raise ValueError('None of the {} candidates could be laid out'.format(n))
+        return [
+            ScoredGrid(score, _candidate_seed(seed, c), make_grid(plan, *settings, rng=_candidate_seed(seed, c)))
+            for score, c in best
+            ]
 
+def _draw_layer(
+        rng:'np.random.Generator',
+        out:'np.ndarray',
+        blanks:WeightedSampler,
+        nonblanks:WeightedSampler,
+        blank_percentage:float,
+        ) -> None:
+    is_blank = rng.random(out.shape) * 100 < blank_percentage
+    nblank = int(is_blank.sum())
+    out[is_blank] = blanks.draw_indices(rng, nblank)
+    out[~is_blank] = nonblanks.draw_indices(rng, out.size - nblank)
+
+def make_grid_indices(
+        plan:TilesetPlan,
+        lower_blank_percentage:float,
+        upper_blank_percentage:float,
+        special_limit:int,
+        middle_size:int,
+        side_size:int,
+        height:int,
+        rng:'np.random.Generator',
+        count:Optional[int]=None,
+        ) -> 'np.ndarray':
+    '''
+    NumPy version of make_grid. Draws `count` grids at once and returns
+    them as a uint16 array of shape (count, height, width) of indices into
+    plan.tileset, or (height, width) if count is None. That is 2 bytes a
+    cell, so a million 21x4 layouts take 168MB. Use grid_from_indices to
+    turn one back into a Grid.
+
+    Rows are top to bottom; the last row is the bottom layer laid out as
+    left side, middle, right side. Grids with too many specials keep
+    `special_limit` of them (chosen at random). Unlike make_grid, this does
+    not enforce the non-repeatable adjacency rule.
+    '''
+    width = side_size * 2 + middle_size
+    shape = (1 if count is None else count, height, width)
+    out = np.empty(shape, dtype=np.uint16)
+    _draw_layer(rng, out[:, :-1, :], plan.upper_blanks, plan.upper_nonblanks, upper_blank_percentage)
+    _draw_layer(rng, out[:, -1, :side_size], plan.side_blanks, plan.side_nonblanks, lower_blank_percentage)
+    _draw_layer(rng, out[:, -1, side_size+middle_size:], plan.side_blanks, plan.side_nonblanks, lower_blank_percentage)
+    middle = out[:, -1, side_size:side_size+middle_size]
+    _draw_layer(rng, middle, plan.middle_blanks, plan.middle_nonblanks, lower_blank_percentage)
+
+    # apply constraint - at most special_limit specials in the middle.
+    # Rank the specials in each grid in a random order and replace the ones
+    # past the limit.
+    specials = np.asarray([t.special for t in plan.tileset], dtype=bool)
+    is_special = specials[middle]
+    keys = rng.random(middle.shape)
+    keys[~is_special] = 2.0
+    rank = np.argsort(np.argsort(keys, axis=-1), axis=-1)
+    excess = is_special & (rank >= special_limit)
+    middle[excess] = plan.middle_nonspecials.draw_indices(rng, int(excess.sum()))
+    if count is None:
+        return out[0]
+    return out
+
+def grid_from_indices(tileset:List[Tile], indices:'np.ndarray', side_size:int) -> Grid:
+    '''
+    Turns one (height, width) index matrix from make_grid_indices back into
+    a Grid, e.g. to pass to make_grid_image.
+    '''
+    height, width = indices.shape
+    return Grid(width, height, side_size, tileset, array('H', indices.ravel().tolist()))
+
+
+# what an ImageCache holds
+CacheEntry = Union[Image.Image, 'np.ndarray']
 
 class ImageCache:
-    def __init__(self):
-        self.cache : Dict[str, Image.Image] = {}
+    '''
+    LRU cache of tile images, bounded by (an estimate of) their decoded size
+    in bytes.
 
-    def get(self, path:str) -> Image.Image:
+    Originals are keyed by path and scaled copies by (path, size, resample),
+    so a tile that appears many times on a map is only resampled once.
+    Scaled copies are RGB, or RGBA if they have any transparency.
+    Pass a Tile's image_key as `key` to file the image under its content
+    hash instead, so each distinct image is decoded and scaled once however
+    many paths and tilesets refer to it.
+    Evicted originals are closed so we don't leak file handles.
+
+    Safe to share between threads; misses are decoded and resized under the
+    lock, so an original can't be evicted and closed while it's in use.
+    '''
+    def __init__(self, max_bytes:int=512*1024*1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # originals and scaled copies are Images, get_array's entries arrays
+        self.cache : 'OrderedDict[Hashable, CacheEntry]' = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def _lookup(self, key:Hashable) -> Optional[CacheEntry]:
+        img = self.cache.get(key)
+        if img is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return img
+
+    def _insert(self, key:Hashable, img:CacheEntry) -> None:
+        self.cache[key] = img
+        self.nbytes += entry_nbytes(img)
+        # Always keep the most recent entry, even if it alone is over budget.
+        while self.nbytes > self.max_bytes and len(self.cache) > 1:
+            oldkey, old = self.cache.popitem(last=False)
+            self.nbytes -= entry_nbytes(old)
+            if not isinstance(oldkey, tuple) and isinstance(old, Image.Image):
+                old.close()
+
+    def get(self, path:str, key:Optional[str]=None) -> Image.Image:
         # TODO: can throw FileNotFoundError or OSError (IOError?)
         # we don't really handle that anywhere
-        if path in self.cache:
-            return self.cache[path]
-        img = Image.open(path)
-        self.cache[path] = img
-        return img
+        if key is None:
+            key = path
+        with self.lock:
+            cached = self._lookup(key)
+            if isinstance(cached, Image.Image):
+                return cached
+            img = Image.open(path)
+            self._insert(key, img)
+            return img
+
+    def get_scaled(self, path:str, size:Tuple[int, int], resample:int=Image.Resampling.BICUBIC, key:Optional[str]=None) -> Image.Image:
+        if key is None:
+            key = path
+        scaled_key = (key, size, resample)
+        with self.lock:
+            cached = self._lookup(scaled_key)
+            if isinstance(cached, Image.Image):
+                return cached
+            original = self.get(path, key)
+            with span('imagecache.decode'):
+                original.load()
+            with span('imagecache.resize'):
+                img = tile_layer(original.resize(size, resample))
+            self._insert(scaled_key, img)
+            return img
+
+    def get_array(self, path:str, size:Tuple[int, int], resample:int=Image.Resampling.BICUBIC, key:Optional[str]=None) -> 'np.ndarray':
+        '''
+        get_scaled as a read-only NumPy array, (h, w, 3), or (h, w, 4) if the
+        image has transparency.
+        '''
+        if key is None:
+            key = path
+        array_key = (key, size, resample, 'array')
+        with self.lock:
+            cached = self._lookup(array_key)
+            if isinstance(cached, np.ndarray):
+                return cached
+            arr = np.asarray(self.get_scaled(path, size, resample, key))
+            self._insert(array_key, arr)
+            return arr
+
+    def invalidate(self, key:str) -> None:
+        '''
+        Forgets the original and all scaled copies filed under key (a path
+        or content hash), e.g. after the file was edited.
+        '''
+        with self.lock:
+            for k in [k for k in self.cache if k == key or (isinstance(k, tuple) and k[0] == key)]:
+                entry = self.cache.pop(k)
+                self.nbytes -= entry_nbytes(entry)
+                if not isinstance(k, tuple) and isinstance(entry, Image.Image):
+                    entry.close()
+
+    def clear(self) -> None:
+        with self.lock:
+            for key, entry in self.cache.items():
+                if not isinstance(key, tuple) and isinstance(entry, Image.Image):
+                    entry.close()
+            self.cache.clear()
+            self.nbytes = 0
+
+def image_nbytes(img:Image.Image) -> int:
+    return img.width * img.height * len(img.getbands())
+
+def entry_nbytes(entry:CacheEntry) -> int:
+    if isinstance(entry, Image.Image):
+        return image_nbytes(entry)
+    return entry.nbytes
 
 imagecache = ImageCache()
-def make_grid_image(grid:Grid, imagecache:ImageCache=imagecache, tiledim:int=250) -> Image.Image:
-    TILEWIDTH  = tiledim
-    TILEHEIGHT = tiledim
-    PIXELWIDTH = grid.width * TILEWIDTH
-    PIXELHEIGHT = grid.height * TILEHEIGHT
-    img = Image.new('RGB', (PIXELWIDTH, PIXELHEIGHT))
-    for i in range(grid.height-1):
-        upper = grid.upper[i]
-        for n, t in enumerate(upper):
-            subimg = imagecache.get(t.path)
-            img.paste(subimg.resize((TILEWIDTH, TILEHEIGHT)), (TILEWIDTH*n, TILEHEIGHT*i))
-    for n, t in enumerate(grid.bottom_left + grid.middle + grid.bottom_right):
-        subimg = imagecache.get(t.path)
-        img.paste(subimg.resize((TILEWIDTH, TILEHEIGHT)), (TILEWIDTH*n, (grid.height-1)*TILEHEIGHT))
+def grid_rows(grid:Grid) -> List[List[Tile]]:
+    '''
+    The tiles of the grid as rows from top to bottom.
+    '''
+    return grid.rows()
+
+def tile_layer(img:Image.Image) -> Image.Image:
+    '''
+    img as RGB, or as RGBA if it has any transparency, which is what the
+    compositors expect.
+    '''
+    if img.mode in ('RGBA', 'LA', 'PA', 'RGBa') or 'transparency' in img.info:
+        rgba = img.convert('RGBA')
+        if rgba.getchannel('A').getextrema() != (255, 255):
+            return rgba
+        return rgba.convert('RGB')
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+def _tile_source(imagecache:ImageCache, tiledim:int, atlas:Optional['TileAtlas']) -> Callable[[Tile], Image.Image]:
+    TILESIZE = (tiledim, tiledim)
+    if atlas is not None and atlas.tile_px != tiledim:
+        atlas = None
+    def tile_image(t:Tile) -> Image.Image:
+        if atlas is not None:
+            subimg = atlas.get(t.path)
+            if subimg is not None:
+                return subimg
+        return imagecache.get_scaled(t.path, TILESIZE, key=t.image_key)
+    return tile_image
+
+def _tile_array_source(imagecache:ImageCache, tiledim:int, atlas:Optional['TileAtlas']) -> Callable[[Tile], 'np.ndarray']:
+    TILESIZE = (tiledim, tiledim)
+    if atlas is not None and atlas.tile_px != tiledim:
+        atlas = None
+    def tile_array(t:Tile) -> 'np.ndarray':
+        if atlas is not None:
+            arr = atlas.get_array(t.path)
+            if arr is not None:
+                return arr
+        return imagecache.get_array(t.path, TILESIZE, key=t.image_key)
+    return tile_array
+
+def _paste(img:Image.Image, layer:Image.Image, pos:Tuple[int, int]) -> None:
+    if layer.mode == 'RGBA':
+        img.paste(layer, pos, layer)
+    else:
+        img.paste(layer, pos)
+
+def _blit(canvas:'np.ndarray', tile:'np.ndarray', x:int) -> None:
+    '''
+    Copies a (tiledim, tiledim, 3) tile into a row strip at column x, or
+    lays a (tiledim, tiledim, 4) one over what's there, rounding the same
+    way as Image.paste with a mask.
+    '''
+    dest = canvas[:, x:x+tile.shape[1]]
+    if tile.shape[2] == 3:
+        dest[...] = tile
+        return
+    alpha = tile[..., 3:].astype(np.uint16)
+    tmp = tile[..., :3] * alpha + dest * (255 - alpha) + 128
+    dest[...] = np.right_shift(tmp + np.right_shift(tmp, 8), 8)
+
+def _background_region(background:Image.Image, size:Tuple[int, int], box:Tuple[int, int, int, int]) -> Image.Image:
+    '''
+    The part of an RGB background under box, with the background stretched
+    to size. Only that part is resampled.
+    '''
+    sx = background.width / size[0]
+    sy = background.height / size[1]
+    x0, y0, x1, y1 = box
+    return background.resize((x1-x0, y1-y0), Image.Resampling.BICUBIC, box=(x0*sx, y0*sy, x1*sx, y1*sy))
+
+def _rgb_background(background:Optional[Image.Image]) -> Optional[Image.Image]:
+    if background is None or background.mode == 'RGB':
+        return background
+    return background.convert('RGB')
+
+def make_grid_image(
+        grid:Grid,
+        imagecache:ImageCache=imagecache,
+        tiledim:int=250,
+        atlas:Optional['TileAtlas']=None,
+        background:Optional[Image.Image]=None,
+        ) -> Image.Image:
+    '''
+    Tiles with transparency are laid over the background (stretched to fit
+    the map) if there is one, or black.
+    '''
+    with span('make_grid_image'):
+        return compose_grid(grid, tiledim, _tile_source(imagecache, tiledim, atlas), background)
+
+def compose_grid(
+        grid:Grid,
+        tiledim:int,
+        tile_image:Callable[[Tile], Image.Image],
+        background:Optional[Image.Image]=None,
+        ) -> Image.Image:
+    '''
+    make_grid_image with tiles from tile_image, which must give tiledim
+    square images as from ImageCache.get_scaled.
+    '''
+    size = (grid.width * tiledim, grid.height * tiledim)
+    background = _rgb_background(background)
+    if background is None:
+        img = Image.new('RGB', size)
+    else:
+        img = _background_region(background, size, (0, 0) + size)
+    # Look each distinct tile up once, not once per cell. Image.paste
+    # straight into the image beats blitting into a NumPy buffer here,
+    # as Image.fromarray then has to unpack the whole map again.
+    layers: Dict[int, Image.Image] = {}
+    for n, i in enumerate(grid.cells):
+        layer = layers.get(i)
+        if layer is None:
+            layer = layers[i] = tile_image(grid.tiles[i])
+        row, col = divmod(n, grid.width)
+        _paste(img, layer, (tiledim*col, tiledim*row))
+    return img
+
+def update_grid_image(
+        img:Image.Image,
+        grid:Grid,
+        cells:List[Tuple[int, int]],
+        imagecache:ImageCache=imagecache,
+        atlas:Optional['TileAtlas']=None,
+        background:Optional[Image.Image]=None,
+        ) -> None:
+    '''
+    Repaints just the given (row, col) cells of an image from
+    make_grid_image, in place, after they were changed in the grid. Pass
+    the same background it was made with.
+    '''
+    tiledim = img.height // grid.height
+    tile_image = _tile_source(imagecache, tiledim, atlas)
+    background = _rgb_background(background)
+    with span('update_grid_image'):
+        for row, col in cells:
+            layer = tile_image(grid.cell(row, col))
+            pos = (tiledim*col, tiledim*row)
+            if layer.mode == 'RGBA':
+                box = pos + (pos[0] + tiledim, pos[1] + tiledim)
+                if background is None:
+                    img.paste((0, 0, 0), box)
+                else:
+                    img.paste(_background_region(background, img.size, box), pos)
+            _paste(img, layer, pos)
+
+def make_grid_row_image(
+        grid:Grid,
+        row:int,
+        imagecache:ImageCache=imagecache,
+        tiledim:int=250,
+        atlas:Optional['TileAtlas']=None,
+        background:Optional[Image.Image]=None,
+        ) -> Image.Image:
+    '''
+    One row of tiles of make_grid_image, as a grid.width*tiledim by tiledim
+    strip.
+    '''
+    tile_image = _tile_source(imagecache, tiledim, atlas)
+    size = (grid.width * tiledim, grid.height * tiledim)
+    background = _rgb_background(background)
+    if background is None:
+        img = Image.new('RGB', (size[0], tiledim))
+    else:
+        img = _background_region(background, size, (0, row*tiledim, size[0], (row+1)*tiledim))
+    for n, t in enumerate(grid_rows(grid)[row]):
+        _paste(img, tile_image(t), (tiledim*n, 0))
     return img
 
+def make_grid_row_bytes(
+        grid:Grid,
+        row:int,
+        imagecache:ImageCache=imagecache,
+        tiledim:int=250,
+        atlas:Optional['TileAtlas']=None,
+        background:Optional[Image.Image]=None,
+        ) -> bytes:
+    '''
+    make_grid_row_image(...).tobytes(), but blitting NumPy arrays of the
+    tiles into the strip, which skips building an Image only to pack it
+    back into bytes. Falls back to make_grid_row_image without NumPy.
+    '''
+    if np is None:
+        return make_grid_row_image(grid, row, imagecache, tiledim, atlas, background).tobytes()
+    width = grid.width * tiledim
+    background = _rgb_background(background)
+    if background is None:
+        strip = np.zeros((tiledim, width, 3), dtype=np.uint8)
+    else:
+        region = _background_region(background, (width, grid.height * tiledim), (0, row*tiledim, width, (row+1)*tiledim))
+        strip = np.array(region)
+    tile_array = _tile_array_source(imagecache, tiledim, atlas)
+    arrays: Dict[int, 'np.ndarray'] = {}
+    for col in range(grid.width):
+        i = grid.cells[row*grid.width + col]
+        arr = arrays.get(i)
+        if arr is None:
+            arr = arrays[i] = tile_array(grid.tiles[i])
+        _blit(strip, arr, col*tiledim)
+    return strip.tobytes()
+
+class PNGStreamWriter:
+    '''
+    Writes an 8 bit RGB PNG a few scanlines at a time, so the whole image
+    never has to be in memory. Scanlines are stored unfiltered.
+    '''
+    CHUNK_SIZE = 1 << 16
+    def __init__(self, fp:BinaryIO, width:int, height:int, compress_level:int=6):
+        self.fp = fp
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(compress_level)
+        self.pending: List[bytes] = []
+        self.npending = 0
+        fp.write(b'\x89PNG\r\n\x1a\n')
+        # width, height, bit depth, color type (RGB), compression, filter, interlace
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, tag:bytes, data:bytes) -> None:
+        self.fp.write(struct.pack('>I', len(data)))
+        self.fp.write(tag)
+        self.fp.write(data)
+        self.fp.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag))))
+
+    def _queue(self, data:bytes) -> None:
+        if not data:
+            return
+        self.pending.append(data)
+        self.npending += len(data)
+        if self.npending >= self.CHUNK_SIZE:
+            self._chunk(b'IDAT', b''.join(self.pending))
+            self.pending = []
+            self.npending = 0
+
+    def write_rows(self, data:bytes) -> None:
+        '''
+        data is a whole number of scanlines of packed RGB.
+        '''
+        stride = self.width * 3
+        assert len(data) % stride == 0
+        for offset in range(0, len(data), stride):
+            # filter type 0 (None) for each scanline
+            self._queue(self.compressor.compress(b'\x00'))
+            self._queue(self.compressor.compress(data[offset:offset+stride]))
+        self.rows_written += len(data) // stride
+
+    def close(self) -> None:
+        assert self.rows_written == self.height, 'Wrote {} rows of {}'.format(self.rows_written, self.height)
+        self._queue(self.compressor.flush())
+        if self.pending:
+            self._chunk(b'IDAT', b''.join(self.pending))
+        self._chunk(b'IEND', b'')
+
+def _render_row_bytes(args:Tuple[Grid, int, int, Optional['TileAtlas'], Optional[Image.Image]]) -> bytes:
+    grid, row, tiledim, atlas, background = args
+    return make_grid_row_bytes(grid, row, tiledim=tiledim, atlas=atlas, background=background)
+
+def save_grid_image_streaming(
+        grid:Grid,
+        path:str,
+        imagecache:ImageCache=imagecache,
+        tiledim:int=250,
+        atlas:Optional['TileAtlas']=None,
+        workers:int=0,
+        compress_level:int=6,
+        background:Optional[Image.Image]=None,
+        ) -> None:
+    '''
+    Renders the grid to path one row of tiles at a time, so peak memory is
+    one row rather than the whole map. Writes a PNG, or raw packed RGB if
+    path ends in .raw or .rgb.
+
+    With workers > 0, rows are rendered in that many worker processes, at
+    most `workers` rows ahead of the writer (the imagecache argument is only
+    used in this process).
+    '''
+    raw = os.path.splitext(path)[1].lower() in ('.raw', '.rgb')
+    background = _rgb_background(background)
+    rows: Iterator[bytes]
+    pool: Optional[ProcessPoolExecutor] = None
+    if workers > 0:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        def render_parallel() -> Iterator[bytes]:
+            assert pool is not None
+            pending: Deque['Future[bytes]'] = deque()
+            for row in range(grid.height):
+                pending.append(pool.submit(_render_row_bytes, (grid, row, tiledim, atlas, background)))
+                if len(pending) >= workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        rows = render_parallel()
+    else:
+        rows = (make_grid_row_bytes(grid, row, imagecache, tiledim, atlas, background) for row in range(grid.height))
+    try:
+        with open(path, 'wb') as fp:
+            if raw:
+                for data in rows:
+                    fp.write(data)
+            else:
+                writer = PNGStreamWriter(fp, grid.width*tiledim, grid.height*tiledim, compress_level)
+                for data in rows:
+                    writer.write_rows(data)
+                writer.close()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+class ExportFormat(NamedTuple):
+    ext: str
+    # passed on to Image.save
+    options: Dict[str, Any]
+
+class ExportResult(NamedTuple):
+    path: str
+    tile_px: int
+    width: int
+    height: int
+    nbytes: int
+    encode_s: float
+    # why it wasn't written, if it wasn't
+    error: Optional[str] = None
+
+# Image.save format names
+EXPORT_FORMATS = {'png': 'PNG', 'webp': 'WEBP'}
+# the most pixels a side can have in each format
+EXPORT_MAX_SIDE = {'webp': 16383}
+# rendered tile size of the _thumb export
+THUMB_TILE_PX = 16
+
+def parse_export_format(text:str) -> ExportFormat:
+    '''
+    'png', 'png:N' for zlib level N (0-9), 'webp', 'webp:N' for quality N
+    (0-100) or 'webp:lossless'.
+    '''
+    ext, _, level = text.lower().partition(':')
+    if ext not in EXPORT_FORMATS:
+        raise ValueError('Unknown export format {!r} (expected one of {})'.format(ext, ', '.join(EXPORT_FORMATS)))
+    options: Dict[str, Any] = {}
+    if ext == 'png':
+        options['compress_level'] = int(level) if level else 6
+        if not 0 <= options['compress_level'] <= 9:
+            raise ValueError('PNG compression level must be 0-9')
+    elif level == 'lossless':
+        options.update(lossless=True, quality=80, method=4)
+    else:
+        options.update(quality=int(level) if level else 90, method=4)
+        if not 0 <= options['quality'] <= 100:
+            raise ValueError('WebP quality must be 0-100')
+    return ExportFormat(ext, options)
+
+def export_sizes(tile_px:int, scales:Sequence[int]=(1, 2), thumb_px:int=THUMB_TILE_PX) -> List[Tuple[str, int]]:
+    '''
+    (filename suffix, tile px) for each scale of tile_px, plus a thumbnail
+    unless thumb_px is 0.
+    '''
+    sizes = [('' if scale == 1 else '@{}x'.format(scale), tile_px * scale) for scale in scales]
+    if thumb_px:
+        sizes.append(('_thumb', thumb_px))
+    return sizes
+
+def tile_pyramid(tiles:List[Tile], sizes:List[int], imagecache:ImageCache=imagecache) -> Dict[int, Dict[str, Image.Image]]:
+    '''
+    Each distinct tile image (by image_key) scaled to each of sizes. Only
+    the largest is resampled from the original, which is decoded once; the
+    smaller ones are each scaled down from the size above, which is much
+    cheaper than going back to a big original every time.
+    '''
+    sizes = sorted(set(sizes), reverse=True)
+    pyramid: Dict[int, Dict[str, Image.Image]] = {size: {} for size in sizes}
+    for t in tiles:
+        key = t.image_key
+        if key in pyramid[sizes[0]]:
+            continue
+        img = imagecache.get_scaled(t.path, (sizes[0], sizes[0]), key=key)
+        pyramid[sizes[0]][key] = img
+        for size in sizes[1:]:
+            img = img.resize((size, size), Image.Resampling.BICUBIC)
+            pyramid[size][key] = img
+    return pyramid
+
+def _encode_image(args:Tuple[Image.Image, str, ExportFormat]) -> Tuple[int, float, Optional[str]]:
+    img, path, fmt = args
+    t0 = time.perf_counter()
+    try:
+        img.save(path, EXPORT_FORMATS[fmt.ext], **fmt.options)
+        return os.path.getsize(path), time.perf_counter() - t0, None
+    except (OSError, ValueError) as e:
+        return 0, time.perf_counter() - t0, str(e)
+
+def export_grid(
+        grid:Grid,
+        basepath:str,
+        sizes:List[Tuple[str, int]],
+        formats:List[ExportFormat],
+        imagecache:ImageCache=imagecache,
+        background:Optional[Image.Image]=None,
+        workers:Optional[int]=None,
+        threads:bool=False,
+        ) -> List[ExportResult]:
+    '''
+    Writes the map at each (suffix, tile px) of sizes in each of formats,
+    as basepath (less any extension) + suffix + '.' + format, e.g.
+    map.png, map@2x.webp, map_thumb.png.
+
+    Every size is composed from one tile_pyramid, here; the encoding, which
+    is most of the time, is spread over `workers` processes (by default one
+    per CPU; 0 to encode here, one after another). With threads, they are
+    threads instead: Pillow's encoders let go of the GIL, and nothing has to
+    be pickled or started, which suits an app (or a frozen executable).
+
+    An output that can't be written (too big for its format, say) doesn't
+    stop the others; its result has the reason in `error`.
+    '''
+    exts = [fmt.ext for fmt in formats]
+    if len(set(exts)) != len(exts):
+        raise ValueError('Each format can only be exported once, as they would be written to the same file')
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with span('export_grid'):
+        root, _ = os.path.splitext(basepath)
+        with span('export_grid.compose'):
+            used = [grid.tiles[i] for i in sorted(set(grid.cells))]
+            pyramid = tile_pyramid(used, [px for _, px in sizes], imagecache)
+            images = []
+            for suffix, px in sizes:
+                layers = pyramid[px]
+                images.append((suffix, px, compose_grid(grid, px, lambda t: layers[t.image_key], background)))
+        jobs: List[Tuple[Image.Image, str, ExportFormat]] = []
+        tile_pxs: List[int] = []
+        too_big: Dict[int, str] = {}
+        for suffix, px, img in images:
+            for fmt in formats:
+                limit = EXPORT_MAX_SIDE.get(fmt.ext)
+                if limit is not None and max(img.size) > limit:
+                    too_big[len(jobs)] = 'Too big for {} (at most {} pixels a side)'.format(fmt.ext, limit)
+                jobs.append((img, '{}{}.{}'.format(root, suffix, fmt.ext), fmt))
+                tile_pxs.append(px)
+        todo = [n for n in range(len(jobs)) if n not in too_big]
+        if min(workers, len(todo)) <= 1:
+            done = {n: _encode_image(jobs[n]) for n in todo}
+        else:
+            executor = ThreadPoolExecutor if threads else ProcessPoolExecutor
+            with executor(max_workers=min(workers, len(todo))) as pool:
+                # biggest first, so a big image isn't left running on its own
+                # at the end
+                order = sorted(todo, key=lambda n: -jobs[n][0].width * jobs[n][0].height)
+                futures = {n: pool.submit(_encode_image, jobs[n]) for n in order}
+                done = {n: futures[n].result() for n in todo}
+        encoded: List[Tuple[int, float, Optional[str]]] = [(0, 0.0, too_big[n]) if n in too_big else done[n] for n in range(len(jobs))]
+        return [
+            ExportResult(path, px, img.width, img.height, nbytes, seconds, error)
+            for (img, path, _), px, (nbytes, seconds, error) in zip(jobs, tile_pxs, encoded)
+            ]
+
+def format_export_report(results:List[ExportResult]) -> str:
+    return '\n'.join(
+        '{:>10,} bytes {:8.3f}s  {}x{}  {}'.format(r.nbytes, r.encode_s, r.width, r.height, r.path)
+        if r.error is None else
+        '   skipped           {}x{}  {}: {}'.format(r.width, r.height, r.path, r.error)
+        for r in results)
+
+
+class SpriteSheet(NamedTuple):
+    '''
+    Every distinct tile image of a tileset (by image_key), each once, scaled
+    to tile_px and laid out left to right, top to bottom, `columns` to a
+    row. sprites maps image_key to its position in the sheet.
+    '''
+    image: Image.Image
+    tile_px: int
+    columns: int
+    sprites: Dict[str, int]
+    names: List[List[str]]
+    fingerprint: bytes
+
+SPRITE_SHEET_VERSION = 1
+TILEMAP_MAGIC = b'JTM'
+TILEMAP_FORMAT_VERSION = 1
+# magic, version, sheet fingerprint, width, height, side size. Little
+# endian, unlike serialize_grid, so engines can use the cells as they are.
+_TILEMAP_HEADER = struct.Struct('<3sB16sHHH')
+
+def sheet_fingerprint(keys:List[str], tile_px:int) -> bytes:
+    h = hashlib.blake2b(str(tile_px).encode(), digest_size=16)
+    for key in keys:
+        h.update(b'\0')
+        h.update(key.encode('utf-8'))
+    return h.digest()
+
+def make_sprite_sheet(tiles:List[Tile], tile_px:int, imagecache:ImageCache=imagecache) -> SpriteSheet:
+    '''
+    Builds the sprite sheet for a whole tileset, so one sheet serves every
+    map made from it. Tiles that share an image share a sprite. The sheet
+    only has an alpha channel if some tile needs one.
+    '''
+    keys: List[str] = []
+    sprites: Dict[str, int] = {}
+    names: List[List[str]] = []
+    layers: List[Image.Image] = []
+    for t in tiles:
+        key = t.image_key
+        if key in sprites:
+            if t.name not in names[sprites[key]]:
+                names[sprites[key]].append(t.name)
+            continue
+        layers.append(imagecache.get_scaled(t.path, (tile_px, tile_px), key=key))
+        sprites[key] = len(keys)
+        keys.append(key)
+        names.append([t.name])
+    columns = max(1, math.ceil(math.sqrt(len(keys))))
+    rows = max(1, math.ceil(len(keys) / columns))
+    mode = 'RGBA' if any(layer.mode == 'RGBA' for layer in layers) else 'RGB'
+    image = Image.new(mode, (columns * tile_px, rows * tile_px))
+    for n, layer in enumerate(layers):
+        row, col = divmod(n, columns)
+        # straight copy, keeping the tile's own alpha
+        image.paste(layer.convert(mode), (col * tile_px, row * tile_px))
+    return SpriteSheet(image, tile_px, columns, sprites, names, sheet_fingerprint(keys, tile_px))
+
+def write_sprite_sheet(sheet:SpriteSheet, basepath:str) -> Tuple[str, str]:
+    '''
+    Saves the sheet as basepath.png, with basepath.json describing where
+    each sprite is and which tiles use it. Returns the two paths.
+    '''
+    root, _ = os.path.splitext(basepath)
+    imagepath, indexpath = root + '.png', root + '.json'
+    sheet.image.save(imagepath)
+    px = sheet.tile_px
+    index = {
+        'version': SPRITE_SHEET_VERSION,
+        'image': os.path.basename(imagepath),
+        'tile_px': px,
+        'columns': sheet.columns,
+        'fingerprint': sheet.fingerprint.hex(),
+        'sprites': [
+            {'x': (n % sheet.columns) * px, 'y': (n // sheet.columns) * px, 'names': names}
+            for n, names in enumerate(sheet.names)
+            ],
+        }
+    with open(indexpath, 'w') as fp:
+        json.dump(index, fp, indent=1)
+    return imagepath, indexpath
+
+def tilemap_cells(grid:Grid, sheet:SpriteSheet) -> array:
+    '''
+    The grid's cells as sprite numbers in the sheet, row major from the top.
+    '''
+    try:
+        mapping = [sheet.sprites[t.image_key] for t in grid.tiles]
+    except KeyError:
+        raise ValueError('Grid has tiles that are not in the sprite sheet')
+    return array('H', [mapping[i] for i in grid.cells])
+
+def tilemap_json(grid:Grid, sheet:SpriteSheet) -> Dict[str, Any]:
+    '''
+    The grid as sprite numbers, split up the same way as the grid: the
+    upper rows, then the bottom row's left side, middle and right side.
+    '''
+    cells = tilemap_cells(grid, sheet).tolist()
+    w = grid.width
+    bottom = cells[(grid.height-1)*w:]
+    return {
+        'version': TILEMAP_FORMAT_VERSION,
+        'sheet': sheet.fingerprint.hex(),
+        'tile_px': sheet.tile_px,
+        'width': w,
+        'height': grid.height,
+        'side_size': grid.side_size,
+        'upper': [cells[row*w:(row+1)*w] for row in range(grid.height-1)],
+        'bottom': {
+            'left': bottom[:grid.side_size],
+            'middle': bottom[grid.side_size:w-grid.side_size],
+            'right': bottom[w-grid.side_size:],
+            },
+        }
+
+def tilemap_bytes(grid:Grid, sheet:SpriteSheet) -> bytes:
+    '''
+    The grid as a small header and then a little endian uint16 sprite
+    number per cell, row major from the top; the bottom row's split comes
+    from side_size in the header. 194 bytes for a 21x4 grid.
+    '''
+    cells = tilemap_cells(grid, sheet)
+    if sys.byteorder == 'big':
+        cells.byteswap()
+    header = _TILEMAP_HEADER.pack(TILEMAP_MAGIC, TILEMAP_FORMAT_VERSION, sheet.fingerprint, grid.width, grid.height, grid.side_size)
+    return header + cells.tobytes()
+
+def write_tilemap(grid:Grid, sheet:SpriteSheet, basepath:str, fmt:str='json') -> str:
+    '''
+    Saves the tilemap as basepath.json or basepath.tilemap (for fmt 'bin').
+    Returns the path written.
+    '''
+    root, _ = os.path.splitext(basepath)
+    if fmt == 'json':
+        path = root + '.json'
+        with open(path, 'w') as fp:
+            json.dump(tilemap_json(grid, sheet), fp, separators=(',', ':'))
+    elif fmt == 'bin':
+        path = root + '.tilemap'
+        with open(path, 'wb') as fp:
+            fp.write(tilemap_bytes(grid, sheet))
+    else:
+        raise ValueError('Unknown tilemap format {!r}'.format(fmt))
+    return path
+
+def fit_size(img_width:int, img_height:int, width:int, height:int) -> Tuple[int, int]:
+    rx = width/img_width
+    ry = height/img_height
+    if rx < ry:
+        new_width = width
+        new_height = int(img_height*rx)
+    else:
+        new_width = int(img_width*ry)
+        new_height = height
+    return max(new_width, 1), max(new_height, 1)
+
+def resize_image(img:Image.Image, width:int, height:int) -> Image.Image:
+    return img.resize(fit_size(img.width, img.height, width, height))
+
+def make_pyramid(img:Image.Image, min_size:int=64) -> List[Image.Image]:
+    '''
+    img followed by successive half size copies of it, down to about
+    min_size pixels on the short side.
+    '''
+    levels = [img]
+    while min(levels[-1].size) >= 2*min_size:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+def resize_from_pyramid(pyramid:List[Image.Image], width:int, height:int) -> Image.Image:
+    '''
+    Like resize_image on pyramid[0], but starts from the smallest level that
+    is still at least the target size, so the final resample is cheap.
+    '''
+    size = fit_size(pyramid[0].width, pyramid[0].height, width, height)
+    source = pyramid[0]
+    for level in pyramid[1:]:
+        if level.width < size[0] or level.height < size[1]:
+            break
+        source = level
+    if source.size == size:
+        return source
+    return source.resize(size, Image.Resampling.BILINEAR)
+
+
+GRID_MAGIC = b'JTG'
+GRID_FORMAT_VERSION = 1
+# magic, version, tileset fingerprint, width, height, side size
+_GRID_HEADER = struct.Struct('>3sB16sHHH')
 
+def tileset_fingerprint(tileset:List[Tile]) -> bytes:
+    '''
+    16 byte hash of the tileset's paths, in order. Serialized grids refer to
+    tiles by their position in the tileset, so they can only be read back
+    with a tileset that has the same fingerprint.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    for t in tileset:
+        h.update(t.path.encode('utf-8'))
+        h.update(b'\0')
+    return h.digest()
 
-def load_tile(path:str, imagecache:ImageCache=imagecache) -> Tile:
+def serialize_grid(grid:Grid, tileset:List[Tile]) -> bytes:
+    '''
+    Compact form of the grid: a small header with the tileset fingerprint
+    and dimensions, then a big endian uint16 tileset index per cell in row
+    major order. About 200 bytes for a 21x4 grid.
+    '''
+    if grid.tiles is tileset:
+        indices = array('H', grid.cells)
+    else:
+        positions = {id(t): i for i, t in enumerate(tileset)}
+        mapping = []
+        for t in grid.tiles:
+            i = positions.get(id(t))
+            mapping.append(tileset.index(t) if i is None else i)
+        indices = array('H', [mapping[i] for i in grid.cells])
+    if sys.byteorder == 'little':
+        indices.byteswap()
+    header = _GRID_HEADER.pack(GRID_MAGIC, GRID_FORMAT_VERSION, tileset_fingerprint(tileset), grid.width, grid.height, grid.side_size)
+    return header + indices.tobytes()
+
+def deserialize_grid(data:bytes, tileset:List[Tile]) -> Grid:
+    if len(data) < _GRID_HEADER.size:
+        raise ValueError('Not a serialized grid')
+    magic, version, fingerprint, width, height, side_size = _GRID_HEADER.unpack_from(data)
+    if magic != GRID_MAGIC:
+        raise ValueError('Not a serialized grid')
+    if version != GRID_FORMAT_VERSION:
+        raise ValueError('Unsupported grid format version {}'.format(version))
+    if fingerprint != tileset_fingerprint(tileset):
+        raise ValueError('Grid was made from a different tileset')
+    indices = array('H')
+    indices.frombytes(data[_GRID_HEADER.size:])
+    if sys.byteorder == 'little':
+        indices.byteswap()
+    if len(indices) != width * height:
+        raise ValueError('Expected {} cells, got {}'.format(width * height, len(indices)))
+    if indices and max(indices) >= len(tileset):
+        raise ValueError('Grid refers to tiles past the end of the tileset')
+    return Grid(width, height, side_size, tileset, indices)
+
+class RenderCache:
+    '''
+    Rendered maps stored as PNGs in a directory, content addressed by the
+    serialized grid and tile size, so a layout is only rendered once.
+
+    The key covers the tile paths but not the image contents: clear the
+    cache if images are edited in place.
+    '''
+    def __init__(self, directory:str):
+        self.directory = directory
+
+    def path(self, serialized:bytes, tiledim:int) -> str:
+        key = hashlib.sha256(serialized + struct.pack('>H', tiledim)).hexdigest()
+        return os.path.join(self.directory, key[:2], key+'.png')
+
+    def get(self, serialized:bytes, tiledim:int) -> Optional[str]:
+        path = self.path(serialized, tiledim)
+        return path if os.path.isfile(path) else None
+
+    def render(
+            self,
+            serialized:bytes,
+            tileset:List[Tile],
+            tiledim:int,
+            imagecache:ImageCache=imagecache,
+            atlas:Optional['TileAtlas']=None,
+            ) -> str:
+        '''
+        Returns the path of the rendered map, rendering it first if needed.
+        '''
+        path = self.path(serialized, tiledim)
+        if os.path.isfile(path):
+            return path
+        grid = deserialize_grid(serialized, tileset)
+        img = make_grid_image(grid, imagecache, tiledim, atlas)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # a unique temp name, as other threads and processes may be rendering
+        # the same layout
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                img.save(fp, format='PNG')
+            os.replace(tmppath, path)
+        except BaseException:
+            os.remove(tmppath)
+            raise
+        return path
+
+    def clear(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def validate_image(path:str) -> None:
+    '''
+    Raises if path isn't an image PIL can open. Only reads the header; the
+    image isn't decoded until ImageCache needs it.
+    '''
+    with Image.open(path):
+        pass
+
+def file_digest(path:str) -> str:
+    '''
+    Content hash of a file, so the same image under different paths can be
+    recognised.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_tile(path:str, validate:bool=True) -> Tile:
+    '''
+    Makes a tile for an image, guessing its settings from the folder names
+    along its path. With validate, also checks the image opens and hashes
+    its contents.
+    '''
     name, _ = os.path.splitext(os.path.basename(path))
-    _ = imagecache.get(path)
+    digest = ''
+    if validate:
+        with span('load_tile.validate'):
+            validate_image(path)
+        with span('load_tile.hash'):
+            digest = file_digest(path)
     repeatable = 'Repeatable' in path
     try:
         weight = int(re.search(r'\d\d', path).group()) # type: ignore
@@ -178,48 +1857,547 @@ def load_tile(path:str, imagecache:ImageCache=imagecache) -> Tile:
         upper=upper,
         biome=biome,
         special=special,
-        is_blank=is_blank
+        is_blank=is_blank,
+        digest=digest,
         )
 
 
-def tiles_from_folders(folderpath:str) -> List[Tile]:
-    extensions = [
-            'png',
-            'PNG',
-            'jpg',
-            'jpeg',
-            'JPG',
-            'JPEG',
-            'bmp',
-            'BMP',
-            'gif',
-            'GIF',
-            'webp',
-            'WEBP',
-            ]
-    paths: List[str] = []
-    for ext in extensions:
-        globpath = os.path.join(folderpath, '**/*.'+ext)
-        paths.extend(glob.glob(globpath, recursive=True))
-    paths = sorted(set(paths))
-    tileset : List[Tile] = []
-    for path in paths:
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp'}
+
+def scan_images(folderpath:str) -> Dict[str, Tuple[int, int]]:
+    '''
+    Single recursive scandir walk for files with an image extension (any
+    case), giving each one's (size, mtime_ns). Like glob, skips hidden files
+    and folders. Nothing is opened.
+    '''
+    found: Dict[str, Tuple[int, int]] = {}
+    stack = [folderpath]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir():
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                        st = entry.stat()
+                        found[entry.path] = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue
+    return found
+
+def find_images(folderpath:str) -> List[str]:
+    return sorted(scan_images(folderpath))
+
+def _try_load_tile(path:str) -> Optional[Tile]:
+    try:
+        return load_tile(path)
+    except:
+        return None
+
+def tiles_from_folders(folderpath:str, workers:int=16) -> List[Tile]:
+    '''
+    Tiles for all the images under folderpath. If the folder has a
+    manifest that lists exactly the images there, with the same sizes and
+    mtimes, it is used without opening any of them; if it is out of date,
+    only the images it doesn't describe are opened (see sync_folder).
+    '''
+    with span('tiles_from_folders'):
+        manifest = read_manifest(folderpath)
+        if manifest is not None:
+            found = scan_images(os.path.abspath(folderpath))
+            listed = {path: (m.file_entry.size, m.file_entry.mtime_ns) for path, m in manifest.items()}
+            if listed == found:
+                return [m.tile for m in manifest.values()]
+            return sync_folder(folderpath, workers=workers).tiles
+        paths = find_images(folderpath)
+        # Validating and hashing are mostly IO (especially on network drives),
+        # and hashlib lets go of the GIL for big buffers, so threads are fine.
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            tiles = pool.map(_try_load_tile, paths)
+            return [t for t in tiles if t is not None]
+
+class IndexEntry(NamedTuple):
+    size: int
+    mtime_ns: int
+    digest: str
+
+class SyncResult(NamedTuple):
+    # every image under the folder, for merge_tiles
+    tiles: List[Tile]
+    # the index to pass to the next sync_folder
+    file_index: Dict[str, IndexEntry]
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+
+# A manifest in a tile folder describes its images, so importing it doesn't
+# depend on folder names and doesn't have to open any of them.
+MANIFEST_NAME = 'tileset.json'
+MANIFEST_VERSION = 1
+MANIFEST_FIELDS = ('name', 'repeatable', 'weight', 'middle', 'side', 'upper', 'biome', 'special', 'is_blank')
+
+class ManifestEntry(NamedTuple):
+    tile: Tile
+    file_entry: IndexEntry
+    width: int
+    height: int
+
+def read_manifest(folderpath:str) -> Optional[Dict[str, ManifestEntry]]:
+    '''
+    The images described by the folder's manifest, by absolute path, or
+    None if it has no (usable) manifest. Just reads the one file.
+    '''
+    root = os.path.abspath(folderpath)
+    try:
+        with open(os.path.join(root, MANIFEST_NAME), encoding='utf-8') as fp:
+            data = json.load(fp)
+        if data['version'] != MANIFEST_VERSION:
+            return None
+        entries: Dict[str, ManifestEntry] = {}
+        for item in data['tiles']:
+            path = os.path.join(root, *item['path'].split('/'))
+            tile = Tile(path=path, digest=item['digest'], **{f: item[f] for f in MANIFEST_FIELDS})
+            entries[path] = ManifestEntry(tile, IndexEntry(item['size'], item['mtime_ns'], item['digest']), item['width'], item['height'])
+        return entries
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def write_manifest(folderpath:str, tiles:List[Tile], index:Optional[Dict[str, IndexEntry]]=None) -> int:
+    '''
+    Writes the manifest for the tiles under folderpath (others are ignored)
+    and returns how many went in. Tiles whose files are missing are left
+    out. Sizes, mtimes and hashes are taken from index, if it has them and
+    they match the file, and dimensions from the old manifest, so only new
+    or changed images get opened (and then only their headers).
+    '''
+    root = os.path.abspath(folderpath)
+    prefix = os.path.join(root, '')
+    old = read_manifest(root) or {}
+    index = index or {}
+    items = []
+    for t in tiles:
+        if not t.path.startswith(prefix):
+            continue
         try:
-            tileset.append(load_tile(path))
-        except:
+            st = os.stat(t.path)
+        except OSError:
             continue
-    return tileset
+        entry = index.get(t.path) or (old[t.path].file_entry if t.path in old else None)
+        if entry is None or (entry.size, entry.mtime_ns) != (st.st_size, st.st_mtime_ns):
+            entry = IndexEntry(st.st_size, st.st_mtime_ns, file_digest(t.path))
+        prev = old.get(t.path)
+        if prev is not None and prev.file_entry.digest == entry.digest:
+            width, height = prev.width, prev.height
+        else:
+            try:
+                with Image.open(t.path) as img:
+                    width, height = img.size
+            except Exception:
+                continue
+        item: Dict[str, Any] = {'path': '/'.join(os.path.relpath(t.path, root).split(os.sep))}
+        item.update((f, getattr(t, f)) for f in MANIFEST_FIELDS)
+        item.update(width=width, height=height, size=entry.size, mtime_ns=entry.mtime_ns, digest=entry.digest)
+        items.append(item)
+    path = os.path.join(root, MANIFEST_NAME)
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w', encoding='utf-8') as fp:
+        json.dump({'version': MANIFEST_VERSION, 'tiles': items}, fp, indent=1)
+    os.replace(tmppath, path)
+    return len(items)
+
+def sync_folder(folderpath:str, index:Optional[Dict[str, IndexEntry]]=None, workers:int=16) -> SyncResult:
+    '''
+    Like tiles_from_folders, but given the index from the last sync of this
+    folder only opens and hashes files that are new or whose size or mtime
+    changed. Images that fail to load are left out, as with
+    tiles_from_folders.
+
+    If the folder has a manifest, tiles take their settings from it rather
+    than from their paths, and what it says about files we have no index
+    for is believed, so a first sync of a folder with an up to date
+    manifest opens nothing.
+    '''
+    with span('sync_folder'):
+        index = index or {}
+        manifest = read_manifest(folderpath) or {}
+        found = scan_images(os.path.abspath(folderpath))
+        added: List[str] = []
+        changed: List[str] = []
+        tiles: Dict[str, Tile] = {}
+        new_index: Dict[str, IndexEntry] = {}
+        def settings(path:str, digest:str) -> Tile:
+            m = manifest.get(path)
+            tile = load_tile(path, validate=False) if m is None else m.tile
+            tile.digest = digest
+            return tile
+        for path, (size, mtime_ns) in sorted(found.items()):
+            entry = index.get(path)
+            if entry is None and path in manifest:
+                entry = manifest[path].file_entry
+            if entry is None:
+                added.append(path)
+            elif (entry.size, entry.mtime_ns) != (size, mtime_ns):
+                changed.append(path)
+            else:
+                tiles[path] = settings(path, entry.digest)
+                new_index[path] = entry
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for path, tile in zip(added + changed, pool.map(_try_load_tile, added + changed)):
+                if tile is not None:
+                    tiles[path] = settings(path, tile.digest) if path in manifest else tile
+                    new_index[path] = IndexEntry(*found[path], tile.digest)
+        removed = sorted(set(index) - set(found))
+        return SyncResult([tiles[p] for p in sorted(tiles)], new_index, added, changed, removed)
+
+def missing_tiles(tiles:List[Tile]) -> List[Tile]:
+    '''
+    Tiles whose image file isn't there (any more). Only stats the files.
+    '''
+    return [t for t in tiles if not os.path.isfile(t.path)]
+
+def merge_tiles(old:List[Tile], new:List[Tile], folderpath:Optional[str]=None, removed:AbstractSet[str]=frozenset()) -> List[Tile]:
+    '''
+    Folds a fresh scan of a folder into an existing tileset instead of
+    replacing it, so settings made in the tile configurer survive a
+    re-import. Tiles from `old` are kept, and updated in place, wherever
+    they can be.
+
+    A new tile matches the old tile with the same path, or failing that an
+    old tile with the same contents whose file wasn't found (it was moved or
+    renamed). Matched tiles take the new path, name and hash; unmatched ones
+    are added at the end. Old tiles from under folderpath that weren't found
+    are dropped, but ones from elsewhere (added one at a time, say) are
+    kept. New tiles whose paths are in `removed` (taken out of the tileset
+    by hand) are left out.
+    '''
+    new = [t for t in new if t.path not in removed]
+    found = {t.path for t in new}
+    root = None if folderpath is None else os.path.join(os.path.abspath(folderpath), '')
+    def gone(t:Tile) -> bool:
+        return t.path not in found and (root is None or t.path.startswith(root))
+    by_path = {t.path: t for t in old}
+    moved: Dict[str, Deque[Tile]] = {}
+    for t in old:
+        if t.digest and gone(t):
+            moved.setdefault(t.digest, deque()).append(t)
+    merged = [t for t in old if not gone(t)]
+    for t in new:
+        match = by_path.get(t.path)
+        if match is not None:
+            # the contents may have changed
+            match.digest = t.digest
+            continue
+        candidates = moved.get(t.digest) if t.digest else None
+        if candidates:
+            match = candidates.popleft()
+            match.path, match.name, match.digest = t.path, t.name, t.digest
+            merged.append(match)
+        else:
+            merged.append(t)
+    return merged
+
+class GeneratorConfig:
+    defaults = [
+        ('lower_blank_percentage', 30),
+        ('upper_blank_percentage', 30),
+        ('special_limit',           1),
+        ('middle_size',             3),
+        ('side_size',               3),
+        ('tile_px',               250),
+        ('height',                  2),
+        ]
+    lower_blank_percentage:float
+    upper_blank_percentage:float
+    special_limit:int
+    middle_size:int
+    side_size:int
+    tile_px:int
+    height:int
+    def __init__(self):
+        for attrname, val in self.defaults:
+            setattr(self, attrname, val)
+    # this is for backwards compat
+    def reinit(self):
+        for attrname, val in self.defaults:
+            if not hasattr(self, attrname):
+                setattr(self, attrname, val)
+
+    def make_grid(self, tiles:Union[List[Tile], TilesetPlan], rng:Union[None, int, str, random.Random]=None) -> Grid:
+        return make_grid(
+                tiles,
+                lower_blank_percentage = self.lower_blank_percentage,
+                upper_blank_percentage = self.upper_blank_percentage,
+                special_limit          = self.special_limit,
+                middle_size            = self.middle_size,
+                side_size              = self.side_size,
+                height                 = self.height,
+                rng                    = rng,
+                )
+    def best_grids(
+            self,
+            tiles:Union[List[Tile], TilesetPlan],
+            n:int,
+            k:int=1,
+            scorers:Optional[List[Tuple[Scorer, float]]]=None,
+            seed:Optional[int]=None,
+            workers:Optional[int]=None,
+            ) -> List[ScoredGrid]:
+        return best_grids(
+                tiles,
+                lower_blank_percentage = self.lower_blank_percentage,
+                upper_blank_percentage = self.upper_blank_percentage,
+                special_limit          = self.special_limit,
+                middle_size            = self.middle_size,
+                side_size              = self.side_size,
+                height                 = self.height,
+                n = n, k = k, scorers = scorers, seed = seed, workers = workers,
+                )
+    def make_grid_image(self, grid:Grid, atlas:Optional['TileAtlas']=None, background:Optional[Image.Image]=None) -> Image.Image:
+        return make_grid_image(grid, tiledim = self.tile_px, atlas = atlas, background = background)
+
+
+class _BatchState(NamedTuple):
+    plan: TilesetPlan
+    config: GeneratorConfig
+    outdir: str
+    atlas: Optional['TileAtlas']
+    stream: bool
+    seed: Optional[int]
+    save_grids: bool
+    background: Optional[str]
+    sheet: Optional[SpriteSheet]
+    tilemap: Optional[str]
+    preview: bool
+    render_cache: Optional[str]
+
+_batch_state: Optional[_BatchState] = None
+_batch_background: Optional[Image.Image] = None
+
+def _batch_init(state:_BatchState) -> None:
+    global _batch_state, _batch_background
+    _batch_state = state
+    if state.background is not None:
+        _batch_background = Image.open(state.background).convert('RGB')
+    _rng.seed()
+
+def _batch_render(n:int) -> str:
+    assert _batch_state is not None
+    plan, config, outdir, atlas, stream, seed, save_grids, _, sheet, tilemap, preview, render_cache = _batch_state
+    background = _batch_background
+    # each map gets its own seed so the output doesn't depend on how maps
+    # were divided up between workers
+    grid = config.make_grid(plan, None if seed is None else '{}:{}'.format(seed, n))
+    path = os.path.join(outdir, '{:05d}.png'.format(n))
+    if save_grids:
+        with open(os.path.join(outdir, '{:05d}.grid'.format(n)), 'wb') as fp:
+            fp.write(serialize_grid(grid, plan.tileset))
+    if sheet is not None and tilemap is not None:
+        tilemap_path = write_tilemap(grid, sheet, os.path.join(outdir, '{:05d}'.format(n)), tilemap)
+        if not preview:
+            return tilemap_path
+    if render_cache is not None:
+        cached = RenderCache(render_cache).render(serialize_grid(grid, plan.tileset), plan.tileset, config.tile_px, atlas=atlas)
+        shutil.copyfile(cached, path)
+    elif stream:
+        save_grid_image_streaming(grid, path, tiledim=config.tile_px, atlas=atlas, background=background)
+    else:
+        img = config.make_grid_image(grid, atlas, background)
+        img.save(path)
+    return path
+
+def batch(
+        tiles:List[Tile],
+        config:GeneratorConfig,
+        count:int,
+        outdir:str,
+        workers:Optional[int]=None,
+        atlas:Optional['TileAtlas']=None,
+        stream:bool=False,
+        seed:Optional[int]=None,
+        save_grids:bool=False,
+        background:Optional[str]=None,
+        tilemap:Optional[str]=None,
+        preview:bool=True,
+        render_cache:Optional[str]=None,
+        ) -> List[str]:
+    '''
+    Generates and renders `count` maps across a process pool, writing them
+    to outdir as numbered PNGs. Returns the written paths in order.
+    With tilemap ('json' or 'bin'), each map is also written as a tilemap
+    (see write_tilemap) against one sprite sheet, sprites.png/.json in
+    outdir; with preview False the PNGs are skipped and the tilemap paths
+    are returned instead.
+    If given, tiles are read from the atlas instead of being decoded and
+    scaled in every worker. With stream, maps are written a row at a time
+    (see save_grid_image_streaming). With a seed, map n is always the same
+    for the same tiles and config. With save_grids, each map's
+    serialize_grid is saved next to it as a .grid file. background is the
+    path of an image to lay tiles with transparency over. With render_cache,
+    the directory of a RenderCache, a layout that has been rendered before
+    (by any run) is copied from there instead of rendered again; it can't
+    be combined with background.
+    '''
+    if render_cache is not None and background is not None:
+        raise ValueError("The render cache doesn't know about backgrounds")
+    os.makedirs(outdir, exist_ok=True)
+    sheet = None
+    if tilemap is not None:
+        sheet = make_sprite_sheet(tiles, config.tile_px)
+        write_sprite_sheet(sheet, os.path.join(outdir, 'sprites'))
+    chunksize = max(1, count // ((workers or os.cpu_count() or 1) * 4))
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_batch_init,
+            initargs=(_BatchState(TilesetPlan(tiles), config, outdir, atlas, stream, seed, save_grids, background, sheet, tilemap, preview, render_cache),),
+            ) as pool:
+        return list(pool.map(_batch_render, range(count), chunksize=chunksize))
+
+def _add_tile_source_args(parser:argparse.ArgumentParser) -> None:
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--folder', help='Import tiles from this folder instead of the saved tile data.')
+    source.add_argument('--tileset', help='Name of a saved tileset (default: the first one).')
+    parser.add_argument('--tiledata', help='Path to the saved tile data (default: the GUI\'s).')
+    for attrname, _ in GeneratorConfig.defaults:
+        parser.add_argument('--'+attrname.replace('_', '-'), dest=attrname, type=float if 'percentage' in attrname else int)
+
+def _load_tile_source(parser:argparse.ArgumentParser, args:argparse.Namespace) -> Tuple[List[Tile], GeneratorConfig]:
+    if args.folder:
+        tiles = tiles_from_folders(args.folder)
+        config = GeneratorConfig()
+    else:
+        import tiledata
+        if args.tiledata:
+            store = tiledata.TileStore(args.tiledata)
+        else:
+            store = tiledata.TileStore(tiledata.DATAPATH, tiledata.LEGACY_DATAPATH)
+        names = store.tileset_names()
+        if not names:
+            parser.error('No saved tilesets')
+        tileset_name = args.tileset or names[0]
+        if tileset_name not in names:
+            parser.error('No tileset named {!r}'.format(tileset_name))
+        tiles = store.load_tileset(tileset_name)
+        config = store.load_config()
+        store.close()
+    if not tiles:
+        parser.error('Tileset is empty')
+    for attrname, _ in GeneratorConfig.defaults:
+        val = getattr(args, attrname)
+        if val is not None:
+            setattr(config, attrname, val)
+    return tiles, config
+
+def _int_list(text:str) -> List[int]:
+    return [int(x) for x in text.split(',') if x]
+
+def main(argv:Optional[List[str]]=None) -> None:
+    parser = argparse.ArgumentParser(prog='grid', description='Headless map generation.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    batch_parser = subparsers.add_parser('batch', help='Render many maps as numbered PNGs.')
+    _add_tile_source_args(batch_parser)
+    batch_parser.add_argument('-n', '--count', type=int, default=100)
+    batch_parser.add_argument('-o', '--outdir', default='maps')
+    batch_parser.add_argument('-j', '--workers', type=int, default=None)
+    batch_parser.add_argument('--no-atlas', action='store_true', help='Don\'t use or build the on-disk tile atlas.')
+    batch_parser.add_argument('--stream', action='store_true', help='Render a row at a time to bound memory on huge maps.')
+    batch_parser.add_argument('--seed', type=int, default=None, help='Make the output reproducible.')
+    batch_parser.add_argument('--grids', action='store_true', help='Also write each map\'s compact serialized grid.')
+    batch_parser.add_argument('--background', help='Image to show through tiles with transparency (stretched to fit).')
+    batch_parser.add_argument('--tilemap', choices=['json', 'bin'], help='Also write each map as a tilemap, with one shared sprite sheet.')
+    batch_parser.add_argument('--no-preview', action='store_true', help='With --tilemap, don\'t render the PNGs.')
+    batch_parser.add_argument('--render-cache', metavar='DIR', help='Reuse renders of layouts seen before, kept in DIR.')
+    export_parser = subparsers.add_parser('export', help='Write saved grids (from batch --grids) at several sizes and formats.')
+    _add_tile_source_args(export_parser)
+    export_parser.add_argument('grids', nargs='+', metavar='GRID')
+    export_parser.add_argument('-o', '--outdir', help='Where to write (default: next to each grid).')
+    export_parser.add_argument('--formats', default='png,webp',
+        help='Comma separated png, png:LEVEL, webp, webp:QUALITY or webp:lossless (default: %(default)s).')
+    export_parser.add_argument('--scales', type=_int_list, default=[1, 2], help='Multiples of the tile size (default: 1,2).')
+    export_parser.add_argument('--thumb-px', type=int, default=THUMB_TILE_PX, help='Tile size of the thumbnail, 0 for none (default: %(default)s).')
+    export_parser.add_argument('-j', '--workers', type=int, default=None)
+    export_parser.add_argument('--background', help='Image to show through tiles with transparency (stretched to fit).')
+    best_parser = subparsers.add_parser('best', help='Lay out many maps and render only the best scoring few.')
+    _add_tile_source_args(best_parser)
+    best_parser.add_argument('-n', '--count', type=int, default=1000, help='Candidates to lay out (default: %(default)s).')
+    best_parser.add_argument('-k', '--keep', type=int, default=3, help='How many of the best to render (default: %(default)s).')
+    best_parser.add_argument('--scorers', default=DEFAULT_SCORERS,
+        help='Comma separated, each name or name:weight, from {} (default: %(default)s).'.format(', '.join(SCORERS)))
+    best_parser.add_argument('-o', '--outdir', default='best')
+    best_parser.add_argument('-j', '--workers', type=int, default=None)
+    best_parser.add_argument('--seed', type=int, default=None, help='Make the output reproducible.')
+    best_parser.add_argument('--no-atlas', action='store_true', help='Don\'t use or build the on-disk tile atlas.')
+    best_parser.add_argument('--background', help='Image to show through tiles with transparency (stretched to fit).')
+    manifest_parser = subparsers.add_parser('manifest', help='Write (or refresh) a tile folder\'s {}.'.format(MANIFEST_NAME))
+    manifest_parser.add_argument('folder')
+    args = parser.parse_args(argv)
+
+    if args.command == 'manifest':
+        result = sync_folder(args.folder)
+        count = write_manifest(args.folder, result.tiles, result.file_index)
+        print('Wrote {} tiles to {}'.format(count, os.path.join(args.folder, MANIFEST_NAME)))
+        return
+
+    tiles, config = _load_tile_source(parser, args)
+    if args.command == 'export':
+        try:
+            formats = [parse_export_format(f) for f in args.formats.split(',') if f]
+        except ValueError as e:
+            parser.error(str(e))
+        sizes = export_sizes(config.tile_px, args.scales, args.thumb_px)
+        background = Image.open(args.background) if args.background else None
+        for gridpath in args.grids:
+            with open(gridpath, 'rb') as fp:
+                grid = deserialize_grid(fp.read(), tiles)
+            basepath = os.path.splitext(gridpath)[0]
+            if args.outdir:
+                os.makedirs(args.outdir, exist_ok=True)
+                basepath = os.path.join(args.outdir, os.path.basename(basepath))
+            print(format_export_report(export_grid(grid, basepath, sizes, formats, background=background, workers=args.workers)))
+        return
+    if args.command == 'best':
+        try:
+            scorers = parse_scorers(args.scorers)
+        except ValueError as e:
+            parser.error(str(e))
+        t0 = time.perf_counter()
+        best = config.best_grids(TilesetPlan(tiles), args.count, args.keep, scorers, args.seed, args.workers)
+        layout_s = time.perf_counter() - t0
+        atlas = None
+        if not args.no_atlas:
+            import atlas as atlas_
+            atlas = atlas_.load_or_build(tiles, config.tile_px)
+        background = Image.open(args.background) if args.background else None
+        os.makedirs(args.outdir, exist_ok=True)
+        for rank, scored in enumerate(best, 1):
+            path = os.path.join(args.outdir, 'best-{:02d}.png'.format(rank))
+            config.make_grid_image(scored.grid, atlas, background).save(path)
+            print('{:.4f}  {}  {}'.format(scored.score, scored.seed, path))
+        print('Scored {} layouts in {:.2f}s, rendered {} in {:.2f}s'.format(
+            args.count, layout_s, len(best), time.perf_counter() - t0 - layout_s))
+        return
+
+    t0 = time.perf_counter()
+    if args.no_preview and not args.tilemap:
+        parser.error('--no-preview needs --tilemap')
+    if args.render_cache and args.background:
+        parser.error('--render-cache can\'t be used with --background')
+    atlas = None
+    if not args.no_atlas and not args.no_preview:
+        import atlas as atlas_
+        atlas = atlas_.load_or_build(tiles, config.tile_px)
+    paths = batch(tiles, config, args.count, args.outdir, args.workers, atlas, args.stream, args.seed, args.grids, args.background, args.tilemap, not args.no_preview, args.render_cache)
+    elapsed = time.perf_counter() - t0
+    print('Wrote {} maps to {} in {:.2f}s ({:.1f} maps/s)'.format(
+        len(paths), args.outdir, elapsed, len(paths)/elapsed if elapsed else 0.0))
 
 if __name__ == '__main__':
-    tileset = tiles_from_folders('.')
-    grid = make_grid(
-            tileset,
-            lower_blank_percentage=30,
-            upper_blank_percentage=20,
-            special_limit=1,
-            middle_size=3,
-            side_size=3,
-            height=2,
-            )
-    imagecache = ImageCache()
-    img = make_grid_image(grid, imagecache)
+    # Run the imported copy of this module so that we use the same classes
+    # as tiledata and atlas, which `import grid`.
+    import grid
+    grid.main()
@@ -1,29 +1,151 @@
-from appdirs import user_data_dir
-from typing import Callable, List, Optional, Any, Dict, Tuple
-from grid import tiles_from_folders, make_grid, make_grid_image, Tile, Grid, imagecache, load_tile
-import pickle
+from typing import Callable, Deque, List, Optional, Any, Dict, Set, Tuple
+from grid import sync_folder, reroll_choice, missing_tiles, write_manifest, IndexEntry, SyncResult, GeneratorConfig, Tile, TilesetPlan, Grid, imagecache, load_tile, fit_size, make_pyramid, resize_from_pyramid, update_grid_image, merge_tiles, ExportFormat, export_grid, export_sizes, parse_export_format, DEFAULT_SCORERS, parse_scorers
+from tiledata import DATAPATH, LEGACY_DATAPATH, TileStore
+from atlas import TileAtlas, load_or_build
+from tilebrowser import TileBrowser
+from instrument import span
+import instrument
 import tkinter as tk
 import tkinter.filedialog
 import tkinter.messagebox
 from PIL import ImageTk, Image
+from collections import deque
+import copy
+import multiprocessing
 import os
+import queue
+import threading
 import atexit
-DATADIR = user_data_dir(appname='JeffTiles', appauthor='David')
-DATAPATH = os.path.join(DATADIR, 'tiledata.pickle')
-root = tk.Tk()
-root.title("make grid")
-root.geometry('1400x700')
-
-def resize_image(img:Image.Image, width:int, height:int) -> Image.Image:
-    rx = width/img.width
-    ry = height/img.height
-    if rx < ry:
-        new_width = width
-        new_height = int(img.height*rx)
-    else:
-        new_width = int(img.width*ry)
-        new_height = height
-    return img.resize((new_width, new_height))
+# How long to wait for the window to stop resizing before redrawing.
+DISPLAY_DEBOUNCE_MS = 60
+# (span name, label, whether to show the last time or the running total)
+# Decode and resize happen per tile, so a total makes more sense for them.
+STATUS_SPANS = [
+    ('sync_folder',        'import',  'last'),
+    ('make_grid',          'layout',  'last'),
+    ('make_grid_image',    'compose', 'last'),
+    ('imagecache.decode',  'decode',  'total'),
+    ('imagecache.resize',  'resize',  'total'),
+    ('display.photoimage', 'display', 'last'),
+    ('export_grid',        'export',  'last'),
+    ]
+WORKER_POLL_MS = 30
+# How many maps to keep rendered ahead for New Map.
+PREFETCH_COUNT = 3
+# Settings are edited a keystroke at a time, so wait for them to settle
+# before rendering maps for them.
+PREFETCH_DELAY_MS = 300
+# How often Watch Folders rescans the open tileset's folders.
+WATCH_POLL_MS = 5000
+# Wait for edits to settle before writing them back to the folders'
+# manifests.
+MANIFEST_DELAY_MS = 2000
+# What Save Map writes, each at 1x and 2x the tile size plus a thumbnail.
+EXPORT_FORMATS = [parse_export_format(f) for f in ('png', 'webp:90')]
+# How many layouts Best of N scores, and what it scores them on.
+BEST_OF_N = 200
+BEST_SCORERS = parse_scorers(DEFAULT_SCORERS)
+
+def write_manifests(jobs:List[Tuple[str, List[Tile], Dict[str, IndexEntry]]]) -> None:
+    for folder, tiles, index in jobs:
+        try:
+            write_manifest(folder, tiles, index)
+        except OSError:
+            # e.g. a read only shared library
+            pass
+
+class MapWorker:
+    '''
+    Makes and renders maps, imports (syncs) tile folders, looks for
+    missing tile images and writes manifests, on a background thread. Results are put on self.results for the Tk thread to poll.
+
+    Map jobs are tagged with the generation they were submitted in, and
+    cancel() bumps the generation: queued jobs from older generations are
+    skipped, and a job that is already running is abandoned between
+    stages (the Tk thread drops anything stale that still gets through).
+    Imports and exports aren't cancelled.
+    '''
+    def __init__(self) -> None:
+        self.jobs: 'queue.Queue[Tuple]' = queue.Queue()
+        self.results: 'queue.Queue[Tuple]' = queue.Queue()
+        self.generation = 0
+        self.atlas:Optional[TileAtlas] = None
+        self.thread = threading.Thread(target=self.run, name='MapWorker', daemon=True)
+        self.thread.start()
+
+    def cancel(self) -> None:
+        self.generation += 1
+
+    def submit_map(self, tiles:List[Tile], config:GeneratorConfig) -> None:
+        # snapshot, as the Tk thread keeps editing these
+        self.jobs.put(('map', self.generation, list(tiles), copy.copy(config)))
+
+    def submit_import(self, tileset_name:str, folder:str, index:Dict[str, IndexEntry], explicit:bool) -> None:
+        self.jobs.put(('import', None, tileset_name, folder, dict(index), explicit))
+
+    def submit_missing(self, tileset_name:str, tiles:List[Tile], folders:List[str], watch:bool) -> None:
+        self.jobs.put(('missing', None, tileset_name, list(tiles), list(folders), watch))
+
+    def submit_best(self, tiles:List[Tile], config:GeneratorConfig, n:int) -> None:
+        self.jobs.put(('best', self.generation, list(tiles), copy.copy(config), n))
+
+    def submit_export(self, grid:Grid, basepath:str, tile_px:int, formats:List[ExportFormat]) -> None:
+        self.jobs.put(('export', None, grid.copy(), basepath, tile_px, list(formats)))
+
+    def submit_manifests(self, jobs:List[Tuple[str, List[Tile], Dict[str, IndexEntry]]]) -> None:
+        self.jobs.put(('manifests', None, jobs))
+
+    def run(self) -> None:
+        while True:
+            job = self.jobs.get()
+            kind, generation = job[0], job[1]
+            if generation is not None and generation != self.generation:
+                continue
+            try:
+                if kind == 'map':
+                    result: Any = self.make_map(generation, job[2], job[3])
+                    if result is None:
+                        continue
+                elif kind == 'best':
+                    result = self.make_best(generation, job[2], job[3], job[4])
+                    if result is None:
+                        continue
+                elif kind == 'export':
+                    result = export_grid(job[2], job[3], export_sizes(job[4]), job[5], threads=True)
+                elif kind == 'manifests':
+                    write_manifests(job[2])
+                    result = None
+                elif kind == 'missing':
+                    # stats every tile, which is slow on network drives
+                    result = ({t.path for t in missing_tiles(job[3])}, [f for f in job[4] if os.path.isdir(f)])
+                else:
+                    result = sync_folder(job[3], job[4])
+            except Exception as e:
+                result = e
+            self.results.put((kind, generation, job, result))
+
+    def make_map(self, generation:int, tiles:List[Tile], config:GeneratorConfig) -> Optional[Tuple[Grid, Image.Image]]:
+        grid = config.make_grid(TilesetPlan(tiles))
+        if generation != self.generation:
+            return None
+        im = config.make_grid_image(grid, self.current_atlas(tiles, config.tile_px))
+        return grid, im
+
+    def make_best(self, generation:int, tiles:List[Tile], config:GeneratorConfig, n:int) -> Optional[Tuple[Grid, Image.Image, float]]:
+        # A few hundred layouts take milliseconds, less than starting a
+        # process pool would, so score them on this thread.
+        (best,) = config.best_grids(TilesetPlan(tiles), n, 1, BEST_SCORERS, workers=1)
+        if generation != self.generation:
+            return None
+        return best.grid, config.make_grid_image(best.grid, self.current_atlas(tiles, config.tile_px)), best.score
+
+    def current_atlas(self, tiles:List[Tile], px:int) -> Optional[TileAtlas]:
+        if self.atlas is None or self.atlas.tile_px != px or not self.atlas.covers(tiles):
+            try:
+                self.atlas = load_or_build(tiles, px)
+            except OSError:
+                self.atlas = None
+        return self.atlas
 
 class Constrained:
     def __init__(self, type_:type, min_, max_):
@@ -41,46 +163,7 @@ class Constrained:
         return val
 
 
-class GeneratorConfig:
-    defaults = [
-        ('lower_blank_percentage', 30),
-        ('upper_blank_percentage', 30),
-        ('special_limit',           1),
-        ('middle_size',             3),
-        ('side_size',               3),
-        ('tile_px',               250),
-        ('height',                  2),
-        ]
-    lower_blank_percentage:float
-    upper_blank_percentage:float
-    special_limit:int
-    middle_size:int
-    side_size:int
-    tile_px:int
-    height:int
-    def __init__(self):
-        for attrname, val in self.defaults:
-            setattr(self, attrname, val)
-    # this is for backwards compat
-    def reinit(self):
-        for attrname, val in self.defaults:
-            if not hasattr(self, attrname):
-                setattr(self, attrname, val)
-
-    def make_grid(self, tiles:List[Tile]) -> Grid:
-        return make_grid(
-                tiles,
-                lower_blank_percentage = self.lower_blank_percentage,
-                upper_blank_percentage = self.upper_blank_percentage,
-                special_limit          = self.special_limit,
-                middle_size            = self.middle_size,
-                side_size              = self.side_size,
-                height                 = self.height,
-                )
-    def make_grid_image(self, grid:Grid) -> Image:
-        return make_grid_image(grid, tiledim = self.tile_px)
-
-def setter(thing:Any, attr:str, type_:Constrained, sv, entry) -> Callable:
+def setter(thing:Any, attr:str, type_:Constrained, sv, entry, on_change:Optional[Callable]=None) -> Callable:
     def set_val(*args, **kwargs):
         text = sv.get()
         try:
@@ -91,59 +174,152 @@ def setter(thing:Any, attr:str, type_:Constrained, sv, entry) -> Callable:
         else:
             entry.configure(bg='white')
         setattr(thing, attr, val)
+        if on_change is not None:
+            on_change()
     return set_val
 
-def boolsetter(thing:Any, attr:str, bv) -> Callable:
+def boolsetter(thing:Any, attr:str, bv, on_change:Optional[Callable]=None) -> Callable:
     def set_val(*args, **kwargs):
         val = bv.get()
         setattr(thing, attr, val)
+        if on_change is not None:
+            on_change()
     return set_val
 
 
 class App:
     def __init__(self, master) -> None:
-        self.photo:Optional[ImageTk] = None
-        self.im:Optional[Image] = None
+        self.photo:Optional[ImageTk.PhotoImage] = None
+        self.im:Optional[Image.Image] = None
+        self.pyramid:Optional[List[Image.Image]] = None
+        self.displayed_size:Optional[Tuple[int, int]] = None
+        # the resized image behind self.photo, kept so single cells can be
+        # patched into it
+        self.displayed:Optional[Image.Image] = None
+        self.display_after_id:Optional[str] = None
+        self.canvas_image:Optional[int] = None
         self.grid:Optional[Grid] = None
+        self.worker = MapWorker()
+        self.prefetched: Deque[Tuple[Grid, Image.Image]] = deque()
+        self.pending_maps = 0
+        self.waiting_for_map = False
+        self.prefetch_failed = False
+        self.prefetch_after_id:Optional[str] = None
+        self.manifest_after_id:Optional[str] = None
+        self.manifests_pending: Set[str] = set()
         self.tiles:List[Tile] = []
+        # tilesets are only read from the store once they're selected
         self.all_tiles : Dict[str, List[Tile]] = {}
         self.tileset_names: List[str] = []
+        self.tileset_name:Optional[str] = None
+        self.dirty_tilesets: Set[str] = set()
+        # (tileset, folder) -> what the folder looked like when last synced
+        self.file_indexes: Dict[Tuple[str, str], Dict[str, IndexEntry]] = {}
+        # (tileset, folder) -> paths taken out of the tileset by hand, which
+        # syncing leaves out
+        self.removed_paths: Dict[Tuple[str, str], Set[str]] = {}
+        self.dirty_indexes: Set[Tuple[str, str]] = set()
+        self.syncing: Set[str] = set()
+        # paths of the open tileset's tiles whose files are missing
+        self.missing: Set[str] = set()
+        self.store:Optional[TileStore] = None
         self.config = GeneratorConfig()
         self.maybe_load_tile_data()
         self.master = master
+        self.status_sv = tk.StringVar()
+        self.status = tk.Label(textvariable=self.status_sv, anchor='w', relief=tk.SUNKEN)
+        self.status.pack(side='bottom', fill='x')
         self.canvas = tk.Canvas()
         self.canvas.pack(side='bottom', fill='both', expand='yes')
-        self.canvas.bind('<Configure>', self.display_grid)
+        self.canvas.bind('<Configure>', self.schedule_display)
+        self.canvas.bind('<Button-1>', self.reroll_at)
+        self.master.after(WORKER_POLL_MS, self.poll_worker)
+        self.master.after(WATCH_POLL_MS, self.watch_folders)
         self.make_buttons()
         self.make_inputs()
         self.make_tile_configurer()
         if self.tileset_names:
             for name in self.tileset_names:
                 self.tileset_lb.insert(tk.END, name)
-            self.tiles = self.all_tiles[self.tileset_names[0]]
+            self.tileset_name = self.tileset_names[0]
+            self.tiles = self.get_tileset(self.tileset_name)
             self.tileset_lb.select_set(0)
             self.tileset_lb.event_generate("<<ListboxSelect>>")
         if self.tiles:
             self.fill_tile_configurer()
-            self.tile_list_lb.select_set(0)
-            self.tile_list_lb.event_generate("<<ListboxSelect>>")
+            self.tile_browser.select(0)
 
     def maybe_load_tile_data(self) -> None:
         try:
-            with open(DATAPATH, 'rb') as fp:
-                data, config = pickle.load(fp)
-            self.all_tiles = data
-            self.config = config
-            self.config.reinit()
-            self.tileset_names = sorted(self.all_tiles.keys())
+            self.store = TileStore(DATAPATH, LEGACY_DATAPATH)
+            self.config = self.store.load_config()
+            self.tileset_names = self.store.tileset_names()
         except Exception as e:
+            # Leave self.store as None so we don't save over data we
+            # couldn't read.
+            tkinter.messagebox.showerror(title='Unable to load tile data', message='Unable to load tile data: {}'.format(e))
             return
 
+    def get_tileset(self, name:str) -> List[Tile]:
+        if name not in self.all_tiles:
+            self.all_tiles[name] = self.store.load_tileset(name) if self.store else []
+        return self.all_tiles[name]
+
+    def mark_dirty(self, name:Optional[str]=None) -> None:
+        if name is None:
+            name = self.tileset_name
+        if name is not None:
+            self.dirty_tilesets.add(name)
+            self.manifests_pending.add(name)
+            if self.manifest_after_id is not None:
+                self.master.after_cancel(self.manifest_after_id)
+            self.manifest_after_id = self.master.after(MANIFEST_DELAY_MS, self.write_manifests)
+        self.invalidate_maps()
+
+    def manifest_jobs(self) -> List[Tuple[str, List[Tile], Dict[str, IndexEntry]]]:
+        '''
+        The manifests to write for the edited tilesets, with copies of
+        their tiles and indexes, as the Tk thread keeps editing those.
+        '''
+        jobs = []
+        for name in sorted(self.manifests_pending):
+            if name not in self.tileset_names:
+                continue
+            tiles = [copy.copy(t) for t in self.get_tileset(name)]
+            for folder in self.synced_folders(name):
+                jobs.append((folder, tiles, dict(self.file_index(name, folder))))
+        self.manifests_pending.clear()
+        return jobs
+
+    def write_manifests(self) -> None:
+        '''
+        Has the worker write edited tilesets back to the manifests of the
+        folders they were imported from, so the next import of those
+        folders (here or by someone else) gets the same settings without
+        opening any images.
+        '''
+        self.manifest_after_id = None
+        jobs = self.manifest_jobs()
+        if jobs:
+            self.worker.submit_manifests(jobs)
+
     def save_tile_data(self) -> None:
-        if not os.path.isdir(DATADIR):
-            os.makedirs(DATADIR)
-        with open(DATAPATH, 'wb') as fp:
-            pickle.dump((self.all_tiles, self.config), fp)
+        # This runs at exit, when Tk may be gone, so don't try to cancel the
+        # pending write; it would find nothing to do anyway. The worker is
+        # going away too, so write them here.
+        write_manifests(self.manifest_jobs())
+        if self.store is None:
+            return
+        for name in sorted(self.dirty_tilesets):
+            if name in self.all_tiles:
+                self.store.save_tileset(name, self.all_tiles[name])
+        self.dirty_tilesets.clear()
+        # after the tiles, so an index never describes tiles we didn't save
+        for name, folder in sorted(self.dirty_indexes):
+            if name in self.tileset_names:
+                self.store.save_file_index(name, folder, self.file_index(name, folder), self.removed(name, folder))
+        self.dirty_indexes.clear()
+        self.store.save_config(self.config)
 
     def make_tile_configurer(self) -> None:
         self.tile_labels = [
@@ -157,35 +333,35 @@ class App:
             ]
         frm_tileconf = tk.Frame()
         frm_tileconf.pack(side='left', padx=10)
-        self.preview_tile = None
-        def lb_callback(*args, **kwargs):
-            lb_sel = self.tile_list_lb.curselection()
-            if not lb_sel:
-                return
-            tile = self.tiles[lb_sel[0]]
-            img = imagecache.get(tile.path)
-            self.preview_tile=ImageTk.PhotoImage(img)
-            self.tile_list_canvas.create_image(0, 0, image=self.preview_tile, anchor='nw')
+        self.preview_tile:Optional[ImageTk.PhotoImage] = None
+        self.preview_item:Optional[int] = None
+        def lb_callback(index:int) -> None:
+            tile = self.tiles[index]
+            self.show_preview(tile)
             for (text, attrname, typ) in self.tile_labels:
                 if isinstance(typ, Constrained):
                     entry, sv = self.tile_input_controls[attrname]
                     if attrname in self.tile_input_controls_cbname:
                         sv.trace_remove('write', self.tile_input_controls_cbname[attrname])
                     sv.set(str(getattr(tile, attrname)))
-                    self.tile_input_controls_cbname[attrname] = sv.trace_add("write", setter(tile, attrname, typ, sv, entry))
+                    self.tile_input_controls_cbname[attrname] = sv.trace_add("write", setter(tile, attrname, typ, sv, entry, self.mark_dirty))
                 else:
                     checkbox, bv = self.tile_input_controls[attrname]
                     if attrname in self.tile_input_controls_cbname:
                         bv.trace_remove('write', self.tile_input_controls_cbname[attrname])
                     bv.set(getattr(tile, attrname))
-                    self.tile_input_controls_cbname[attrname] = bv.trace_add("write", boolsetter(tile, attrname, bv))
+                    self.tile_input_controls_cbname[attrname] = bv.trace_add("write", boolsetter(tile, attrname, bv, self.mark_dirty))
 
         def tileset_lb_callback(*args, **kwargs):
             lb_sel = self.tileset_lb.curselection()
             if not lb_sel:
                 return
             tileset_name = self.tileset_lb.get(*lb_sel)
-            self.tiles = self.all_tiles[tileset_name]
+            self.tileset_name = tileset_name
+            self.tiles = self.get_tileset(tileset_name)
+            self.missing = set()
+            self.refresh_missing()
+            self.invalidate_maps()
             self.fill_tile_configurer()
 
         self.tileset_sv = tk.StringVar()
@@ -206,9 +382,17 @@ class App:
                 return
             tileset_name = self.tileset_lb.get(*lb_sel)
             self.tileset_names.remove(tileset_name)
-            del self.all_tiles[tileset_name]
+            self.all_tiles.pop(tileset_name, None)
+            self.dirty_tilesets.discard(tileset_name)
+            for key in [key for key in self.file_indexes if key[0] == tileset_name]:
+                del self.file_indexes[key]
+                self.dirty_indexes.discard(key)
+            if self.store is not None:
+                self.store.delete_tileset(tileset_name)
             self.tileset_lb.delete(lb_sel[0])
+            self.tileset_name = None
             self.tiles = []
+            self.invalidate_maps()
             self.fill_tile_configurer()
         frm_tileset_buttons = tk.Frame(frm_tileset_lb_meta)
         frm_tileset_buttons.grid(row=1, column=0, sticky='n')
@@ -219,11 +403,12 @@ class App:
             if not name:
                 return
             self.tileset_add_entry.delete(0, tk.END)
-            if name in self.all_tiles:
+            if name in self.tileset_names:
                 return
             self.tileset_names.append(name)
             self.tileset_lb.insert(tk.END, name)
             self.all_tiles[name] = []
+            self.mark_dirty(name)
             self.tiles = []
             self.fill_tile_configurer()
             self.tileset_lb.select_set(tk.END)
@@ -235,18 +420,10 @@ class App:
         self.tileset_delete_button = tk.Button(frm_tileset_buttons, text='Delete Tileset', command=tileset_deleter)
         self.tileset_delete_button.grid(row=1, column=0, columnspan=2, sticky='ew')
 
-        self.tile_list_sv = tk.StringVar()
         frm_listbox_meta = tk.Frame(frm_tileconf)
         frm_listbox_meta.grid(row=0, column=1, sticky='n')
-        frm_listbox = tk.Frame(frm_listbox_meta)
-        frm_listbox.grid(row=0, column=0, sticky='ew')
-        self.tile_list_lb = tk.Listbox(frm_listbox, listvariable=self.tile_list_sv, selectmode='single', height=14)
-        self.tile_list_lb.bind('<<ListboxSelect>>', lb_callback)
-        self.tile_list_lb.pack(side='left',fill='y')
-        self.tile_list_sb = tk.Scrollbar(frm_listbox)
-        self.tile_list_sb.pack(side='left', fill='y')
-        self.tile_list_lb.config(yscrollcommand=self.tile_list_sb.set)
-        self.tile_list_sb.config(command=self.tile_list_lb.yview)
+        self.tile_browser = TileBrowser(frm_listbox_meta, on_select=lb_callback, is_missing=lambda t: t.path in self.missing)
+        self.tile_browser.frame.grid(row=0, column=0, sticky='ew')
 
         frm_listbox_buttons = tk.Frame(frm_listbox_meta)
         frm_listbox_buttons.grid(row=1, column=0, sticky='ew')
@@ -263,6 +440,10 @@ class App:
         btn_delete_tile.grid(row=2, column=0, sticky='ew')
         self.btn_delete_tile = btn_delete_tile
 
+        btn_replace_image = tk.Button(text='Replace Image', master=frm_listbox_buttons, command=self.replace_image)
+        btn_replace_image.grid(row=3, column=0, sticky='ew')
+        self.btn_replace_image = btn_replace_image
+
 
         self.tile_list_canvas = tk.Canvas(frm_tileconf, width=250, height=250,border=1)
         self.tile_list_canvas.grid(row=0, column=2, sticky='n')
@@ -288,9 +469,32 @@ class App:
                 checkbox.grid(row=n, column=1, sticky='w')
                 self.tile_input_controls[attrname] = (checkbox, bv)
 
-    def fill_tile_configurer(self) -> None:
+    def show_preview(self, tile:Tile) -> None:
+        '''
+        Shows the tile scaled to fit the preview canvas, reusing the canvas
+        item.
+        '''
+        width, height = int(self.tile_list_canvas['width']), int(self.tile_list_canvas['height'])
+        try:
+            original = imagecache.get(tile.path, tile.image_key)
+            size = fit_size(original.width, original.height, width, height)
+            img = imagecache.get_scaled(tile.path, size, key=tile.image_key)
+        except OSError:
+            self.clear_preview()
+            return
+        self.preview_tile = ImageTk.PhotoImage(img)
+        if self.preview_item is None:
+            self.preview_item = self.tile_list_canvas.create_image(0, 0, image=self.preview_tile, anchor='nw')
+        else:
+            self.tile_list_canvas.itemconfigure(self.preview_item, image=self.preview_tile)
+
+    def clear_preview(self) -> None:
         self.tile_list_canvas.delete("all")
-        self.tile_list_lb.delete("0", tk.END)
+        self.preview_item = None
+        self.preview_tile = None
+
+    def clear_tile_inputs(self) -> None:
+        self.clear_preview()
         for (text, attrname, typ) in self.tile_labels:
             if isinstance(typ, Constrained):
                 entry, sv = self.tile_input_controls[attrname]
@@ -305,27 +509,27 @@ class App:
                     del self.tile_input_controls_cbname[attrname]
                 bv.set(False)
 
-        for n, t in enumerate(self.tiles):
-            self.tile_list_lb.insert(n+1, t.name)
+    def fill_tile_configurer(self) -> None:
+        self.clear_tile_inputs()
+        self.tile_browser.set_tiles(self.tiles)
 
 
     def del_tile(self) -> None:
-        sel = self.tile_list_lb.curselection()
-        if not sel:
+        index = self.tile_browser.selection
+        if index is None:
             return
-        index = sel[0]
-        assert isinstance(index, int)
-        self.tiles.pop(index)
-        self.fill_tile_configurer()
-        if index < len(self.tiles):
-            self.tile_list_lb.select_set(index)
-            self.tile_list_lb.event_generate("<<ListboxSelect>>")
-            self.tile_list_lb.see(index)
-        else:
-            if self.tiles:
-                self.tile_list_lb.select_set(index-1)
-                self.tile_list_lb.event_generate("<<ListboxSelect>>")
-                self.tile_list_lb.see(index-1)
+        tile = self.tiles.pop(index)
+        # so syncing its folder doesn't bring it back
+        if self.tileset_name is not None:
+            for folder in self.synced_folders(self.tileset_name):
+                if tile.path.startswith(os.path.join(folder, '')):
+                    self.removed(self.tileset_name, folder).add(tile.path)
+                    self.dirty_indexes.add((self.tileset_name, folder))
+        self.mark_dirty()
+        self.clear_tile_inputs()
+        self.tile_browser.delete(index)
+        if self.tiles:
+            self.tile_browser.select(min(index, len(self.tiles)-1))
 
 
     def add_tile(self) -> None:
@@ -340,10 +544,48 @@ class App:
             tkinter.messagebox.showerror(title='Unable to add tile', message='Unable to add tile: {}'.format(e))
             return
         self.tiles.append(tile)
-        self.fill_tile_configurer()
-        self.tile_list_lb.select_set(len(self.tiles)-1)
-        self.tile_list_lb.event_generate("<<ListboxSelect>>")
-        self.tile_list_lb.see(len(self.tiles)-1)
+        if self.tileset_name is not None:
+            for folder in self.synced_folders(self.tileset_name):
+                removed = self.removed(self.tileset_name, folder)
+                if tile.path in removed:
+                    removed.discard(tile.path)
+                    self.dirty_indexes.add((self.tileset_name, folder))
+        self.mark_dirty()
+        self.tile_browser.insert(len(self.tiles)-1, tile)
+        self.tile_browser.select(len(self.tiles)-1)
+
+    def replace_image(self) -> None:
+        '''
+        Points the selected tile at a different image (or the same file,
+        edited), and repaints just the cells of the current map that use it.
+        '''
+        index = self.tile_browser.selection
+        if index is None:
+            return
+        tile = self.tiles[index]
+        imagefile = tkinter.filedialog.askopenfilename(
+            title='Choose an image',
+            )
+        if not os.path.isfile(imagefile):
+            return
+        try:
+            new = load_tile(imagefile)
+        except Exception as e:
+            tkinter.messagebox.showerror(title='Unable to replace image', message='Unable to replace image: {}'.format(e))
+            return
+        for old in (tile, new):
+            imagecache.invalidate(old.image_key)
+            self.tile_browser.forget(old)
+            if self.worker.atlas is not None:
+                self.worker.atlas.forget(old.path)
+        tile.path = new.path
+        tile.name = new.name
+        tile.digest = new.digest
+        self.mark_dirty()
+        self.tile_browser.update(index)
+        self.tile_browser.select(index)
+        if self.grid is not None:
+            self.repaint_cells(self.grid.cells_with(tile))
 
     def get_tiles(self, *args, **kwargs) -> None:
         lb_sel = self.tileset_lb.curselection()
@@ -358,14 +600,103 @@ class App:
         if not os.path.isdir(imagefolder):
             return
         if imagefolder:
-            tiles = tiles_from_folders(imagefolder)
-            if tiles:
-                self.tiles = tiles
-            else:
-                return
-            if self.tiles:
-                self.all_tiles[tileset_name] = self.tiles
-                self.fill_tile_configurer()
+            self.btn_choose.configure(state=tk.DISABLED)
+            self.status_sv.set('Importing {}...'.format(imagefolder))
+            self.sync(tileset_name, os.path.abspath(imagefolder), explicit=True)
+
+    def file_index(self, tileset_name:str, folder:str) -> Dict[str, IndexEntry]:
+        key = (tileset_name, folder)
+        if key not in self.file_indexes:
+            self.file_indexes[key] = self.store.load_file_index(tileset_name, folder) if self.store else {}
+        return self.file_indexes[key]
+
+    def removed(self, tileset_name:str, folder:str) -> Set[str]:
+        key = (tileset_name, folder)
+        if key not in self.removed_paths:
+            self.removed_paths[key] = self.store.load_removed(tileset_name, folder) if self.store else set()
+        return self.removed_paths[key]
+
+    def synced_folders(self, tileset_name:str) -> List[str]:
+        folders = set(self.store.synced_folders(tileset_name)) if self.store else set()
+        folders.update(folder for name, folder in self.file_indexes if name == tileset_name)
+        return sorted(folders)
+
+    def sync(self, tileset_name:str, folder:str, explicit:bool=False) -> None:
+        '''
+        Resyncs a folder into the tileset. An explicit sync (Load Tiles)
+        also brings back tiles that were taken out by hand.
+        '''
+        self.syncing.add(tileset_name)
+        self.worker.submit_import(tileset_name, folder, self.file_index(tileset_name, folder), explicit)
+
+    def finish_import(self, tileset_name:str, folder:str, result:SyncResult, explicit:bool) -> None:
+        self.btn_choose.configure(state=tk.NORMAL)
+        self.syncing.discard(tileset_name)
+        self.update_status()
+        # An empty folder is more likely an unplugged drive than a library
+        # with everything deleted.
+        if not result.tiles or tileset_name not in self.tileset_names:
+            return
+        if not explicit and self.file_indexes.get((tileset_name, folder)) and not (result.added or result.changed or result.removed):
+            return
+        if explicit:
+            self.removed(tileset_name, folder).clear()
+        self.file_indexes[tileset_name, folder] = result.file_index
+        self.dirty_indexes.add((tileset_name, folder))
+        # the atlas is keyed by path, so it would keep serving the old image
+        if self.worker.atlas is not None:
+            for path in result.changed:
+                self.worker.atlas.forget(path)
+        # keep the settings of tiles that were already there
+        tiles = merge_tiles(self.get_tileset(tileset_name), result.tiles, folder, self.removed(tileset_name, folder))
+        self.all_tiles[tileset_name] = tiles
+        self.mark_dirty(tileset_name)
+        self.status_sv.set('Synced {}: {} added, {} changed, {} removed'.format(
+            folder, len(result.added), len(result.changed), len(result.removed)))
+        if tileset_name == self.tileset_name:
+            self.tiles = tiles
+            self.refresh_missing()
+            sel = self.tile_browser.selection
+            self.fill_tile_configurer()
+            if sel is not None and sel < len(self.tiles):
+                self.tile_browser.select(sel)
+
+    def refresh_missing(self, watch:bool=False) -> None:
+        '''
+        Has the worker check which of the open tileset's images are
+        missing, so they can be shown in red and left out of maps. With
+        watch, the tileset's folders that are there are then resynced.
+        '''
+        if self.tileset_name is None:
+            return
+        folders = self.synced_folders(self.tileset_name) if watch else []
+        self.worker.submit_missing(self.tileset_name, self.tiles, folders, watch)
+
+    def finish_missing(self, tileset_name:str, missing:Set[str], folders:List[str], watch:bool) -> None:
+        if tileset_name != self.tileset_name:
+            return
+        if missing != self.missing:
+            self.missing = missing
+            self.invalidate_maps()
+            self.color_missing()
+        if watch and tileset_name not in self.syncing:
+            for folder in folders:
+                self.sync(tileset_name, folder)
+
+    def color_missing(self) -> None:
+        self.tile_browser.refresh()
+
+    def watch_folders(self) -> None:
+        '''
+        With Watch Folders on, resyncs the folders the open tileset was
+        imported from every WATCH_POLL_MS, so new, changed and deleted
+        images show up on their own.
+        '''
+        self.master.after(WATCH_POLL_MS, self.watch_folders)
+        name = self.tileset_name
+        if not self.watch_bv.get() or name is None or name in self.syncing:
+            return
+        self.refresh_missing(watch=True)
 
     def make_inputs(self) -> None:
         self.input_labels: List[tk.Label] = []
@@ -387,7 +718,7 @@ class App:
             self.input_labels.append(label)
             sv = tk.StringVar(value=str(getattr(self.config, attrname)))
             entry = tk.Entry(master=frm_form, width = 5, textvariable=sv)
-            sv.trace_add("write", setter(self.config, attrname, type_, sv, entry))
+            sv.trace_add("write", setter(self.config, attrname, type_, sv, entry, self.invalidate_maps))
             self.svs.append(sv)
             label.grid(row=n, column=0, sticky='e')
             entry.grid(row=n, column=1)
@@ -399,35 +730,287 @@ class App:
         btn_new = tk.Button(text='New Map', master=frm_buttons, command=self.generate_grid)
         btn_new.pack(side=tk.LEFT, padx=10, ipadx=10)
         self.btn_new = btn_new
+        btn_best = tk.Button(text='Best of {}'.format(BEST_OF_N), master=frm_buttons, command=self.best_grid)
+        btn_best.pack(side=tk.LEFT, padx=10, ipadx=10)
+        self.btn_best = btn_best
         btn_save = tk.Button(text='Save Map', master=frm_buttons, command=self.save_grid)
         btn_save.pack(side=tk.LEFT, padx=10, ipadx=10)
         self.btn_save = btn_save
+        self.timing_bv = tk.BooleanVar(value=instrument.is_enabled())
+        def toggle_timing(*args, **kwargs):
+            instrument.enable(self.timing_bv.get())
+            self.update_status()
+        chk_timing = tk.Checkbutton(text='Timing', master=frm_buttons, variable=self.timing_bv, command=toggle_timing)
+        chk_timing.pack(side=tk.LEFT, padx=10)
+        self.chk_timing = chk_timing
+        btn_dump = tk.Button(text='Dump Timings', master=frm_buttons, command=self.dump_timings)
+        btn_dump.pack(side=tk.LEFT, padx=10, ipadx=10)
+        self.btn_dump = btn_dump
+        self.watch_bv = tk.BooleanVar(value=False)
+        chk_watch = tk.Checkbutton(text='Watch Folders', master=frm_buttons, variable=self.watch_bv)
+        chk_watch.pack(side=tk.LEFT, padx=10)
+        self.chk_watch = chk_watch
+
+    def update_status(self) -> None:
+        parts = ['cache {:.0%} hits, {} MB'.format(imagecache.hit_rate, imagecache.nbytes >> 20)]
+        if instrument.is_enabled():
+            for name, label, which in STATUS_SPANS:
+                stats = instrument.get(name)
+                if stats is None:
+                    continue
+                if which == 'total':
+                    parts.append('{} {:.0f}ms/{}'.format(label, stats.total*1000, stats.count))
+                else:
+                    parts.append('{} {:.0f}ms'.format(label, stats.last*1000))
+        self.status_sv.set('  |  '.join(parts))
+
+    def dump_timings(self) -> None:
+        savepath = tkinter.filedialog.asksaveasfilename(
+                title='Where to save timings',
+                defaultextension='.json',
+                )
+        if not savepath:
+            return
+        instrument.dump(savepath, {
+            'imagecache': {
+                'hits': imagecache.hits,
+                'misses': imagecache.misses,
+                'hit_rate': imagecache.hit_rate,
+                'nbytes': imagecache.nbytes,
+                'entries': len(imagecache.cache),
+                },
+            })
 
     def generate_grid(self) -> None:
-        if self.tiles:
-            self.grid = self.config.make_grid(self.tiles)
-            self.im = self.config.make_grid_image(self.grid)
-            self.display_grid()
+        if not self.tiles:
+            return
+        self.prefetch_failed = False
+        if self.prefetched:
+            self.show_map(*self.prefetched.popleft())
+        else:
+            self.waiting_for_map = True
+            self.status_sv.set('Rendering...')
+        self.refill_prefetch()
+
+    def best_grid(self) -> None:
+        '''
+        Lays out BEST_OF_N maps, scores them with BEST_SCORERS and shows
+        the best; only that one is rendered.
+        '''
+        if not self.tiles:
+            return
+        self.status_sv.set('Scoring {} layouts...'.format(BEST_OF_N))
+        self.worker.submit_best([t for t in self.tiles if t.path not in self.missing], self.config, BEST_OF_N)
+
+    def show_map(self, grid:Grid, im:Image.Image) -> None:
+        self.grid = grid
+        self.set_image(im)
+        self.update_status()
+
+    def invalidate_maps(self) -> None:
+        '''
+        The tiles or settings changed, so throw away (and stop making) maps
+        made with the old ones, and make new ones once things settle.
+        '''
+        self.worker.cancel()
+        self.prefetched.clear()
+        self.pending_maps = 0
+        self.prefetch_failed = False
+        if self.prefetch_after_id is not None:
+            self.master.after_cancel(self.prefetch_after_id)
+        self.prefetch_after_id = self.master.after(PREFETCH_DELAY_MS, self.refill_prefetch)
+
+    def refill_prefetch(self) -> None:
+        self.prefetch_after_id = None
+        if not self.tiles or self.prefetch_failed:
+            return
+        tiles = [t for t in self.tiles if t.path not in self.missing]
+        wanted = PREFETCH_COUNT + (1 if self.waiting_for_map else 0)
+        while len(self.prefetched) + self.pending_maps < wanted:
+            self.worker.submit_map(tiles, self.config)
+            self.pending_maps += 1
+
+    def poll_worker(self) -> None:
+        while True:
+            try:
+                kind, generation, job, result = self.worker.results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'import':
+                if isinstance(result, Exception):
+                    self.btn_choose.configure(state=tk.NORMAL)
+                    self.syncing.discard(job[2])
+                    tkinter.messagebox.showerror(title='Unable to load tiles', message='Unable to load tiles: {}'.format(result))
+                else:
+                    self.finish_import(job[2], job[3], result, job[5])
+                continue
+            if kind == 'manifests':
+                continue
+            if kind == 'missing':
+                if not isinstance(result, Exception):
+                    self.finish_missing(job[2], result[0], result[1], job[5])
+                continue
+            if kind == 'export':
+                self.finish_export(result)
+                continue
+            if kind == 'best':
+                if generation != self.worker.generation:
+                    continue
+                if isinstance(result, Exception):
+                    self.update_status()
+                    tkinter.messagebox.showerror(title='Unable to make map', message='Unable to make map: {}'.format(result))
+                    continue
+                grid, im, score = result
+                self.show_map(grid, im)
+                self.status_sv.set('Best of {}: score {:.2f}  |  {}'.format(job[4], score, self.status_sv.get()))
+                continue
+            if generation != self.worker.generation:
+                continue
+            self.pending_maps -= 1
+            if isinstance(result, Exception):
+                # Don't keep retrying with settings that don't work.
+                self.prefetch_failed = True
+                if self.waiting_for_map:
+                    self.waiting_for_map = False
+                    self.update_status()
+                    tkinter.messagebox.showerror(title='Unable to make map', message='Unable to make map: {}'.format(result))
+                continue
+            if self.waiting_for_map:
+                self.waiting_for_map = False
+                self.show_map(*result)
+            else:
+                self.prefetched.append(result)
+        self.master.after(WORKER_POLL_MS, self.poll_worker)
+
+    def reroll_at(self, event) -> None:
+        '''
+        Clicking a cell of the map swaps its tile for another that fits.
+        '''
+        if self.grid is None or self.im is None or self.displayed_size is None or not self.tiles:
+            return
+        width, height = self.displayed_size
+        x, y = event.x - 10, event.y - 10
+        if not (0 <= x < width and 0 <= y < height):
+            return
+        row = y * self.grid.height // height
+        col = x * self.grid.width // width
+        tiles = [t for t in self.tiles if t.path not in self.missing]
+        config = self.config
+        try:
+            tile = reroll_choice(self.grid, row, col, tiles, config.lower_blank_percentage,
+                config.upper_blank_percentage, config.special_limit, change=True)
+        except ValueError:
+            return
+        # load it before it goes in the grid, so a file that went away or
+        # won't decode leaves the map as it was
+        tiledim = self.im.height // self.grid.height
+        try:
+            imagecache.get_scaled(tile.path, (tiledim, tiledim), key=tile.image_key)
+        except OSError as e:
+            self.status_sv.set('Unable to load {}: {}'.format(tile.path, e))
+            return
+        self.grid.set_cell(row, col, tile)
+        self.repaint_cells([(row, col)])
+
+    def repaint_cells(self, cells:List[Tuple[int, int]]) -> None:
+        '''
+        Recomposites only the given cells, both in the full size image and in
+        what's on screen, rather than redoing the whole map.
+        '''
+        if self.grid is None or self.im is None or not cells:
+            return
+        update_grid_image(self.im, self.grid, cells)
+        self.pyramid = None
+        if self.displayed is None or self.photo is None:
+            return
+        grid = self.grid
+        tiledim = self.im.height // grid.height
+        width, height = self.displayed.size
+        for row, col in cells:
+            x0, x1 = col*width//grid.width, (col+1)*width//grid.width
+            y0, y1 = row*height//grid.height, (row+1)*height//grid.height
+            if x1 <= x0 or y1 <= y0:
+                continue
+            cell = self.im.crop((col*tiledim, row*tiledim, (col+1)*tiledim, (row+1)*tiledim))
+            self.displayed.paste(cell.resize((x1-x0, y1-y0), Image.Resampling.BICUBIC), (x0, y0))
+        with span('display.photoimage'):
+            self.photo.paste(self.displayed)
+
+    def set_image(self, im:Image.Image) -> None:
+        self.im = im
+        self.pyramid = None
+        self.displayed_size = None
+        self.display_grid()
+
+    def schedule_display(self, *args, **kwargs) -> None:
+        # <Configure> fires continuously while the window is dragged, so only
+        # redraw once it settles.
+        if self.display_after_id is not None:
+            self.master.after_cancel(self.display_after_id)
+        self.display_after_id = self.master.after(DISPLAY_DEBOUNCE_MS, self.display_grid)
 
     def display_grid(self, *args, **kwargs) -> None:
+        self.display_after_id = None
         if self.im:
             width = self.canvas.winfo_width() - 20
             height = self.canvas.winfo_height() - 20
-            resized = resize_image(self.im, width, height)
-            self.photo=ImageTk.PhotoImage(resized)
-            self.canvas.create_image(10, 10, image=self.photo, anchor='nw')
-
-    def save_grid(self, *args, **kwargs) -> None:
-        if self.im:
-            savepath = tkinter.filedialog.asksaveasfilename(
-                    title='Where to save',
-                    defaultextension='.png',
-                    )
-            if not savepath:
+            if width <= 0 or height <= 0:
+                return
+            if fit_size(self.im.width, self.im.height, width, height) == self.displayed_size:
                 return
-            self.im.save(savepath)
-        return
+            if self.pyramid is None:
+                self.pyramid = make_pyramid(self.im)
+            resized = resize_from_pyramid(self.pyramid, width, height)
+            self.displayed_size = resized.size
+            self.displayed = resized
+            with span('display.photoimage'):
+                self.photo=ImageTk.PhotoImage(resized)
+            if self.canvas_image is None:
+                self.canvas_image = self.canvas.create_image(10, 10, image=self.photo, anchor='nw')
+            else:
+                self.canvas.itemconfigure(self.canvas_image, image=self.photo)
 
-app = App(root)
-atexit.register(app.save_tile_data)
-root.mainloop()
+    def save_grid(self, *args, **kwargs) -> None:
+        '''
+        Writes the map in each of EXPORT_FORMATS at a few sizes, on the
+        worker, so the window stays usable while it encodes.
+        '''
+        if self.grid is None:
+            return
+        savepath = tkinter.filedialog.asksaveasfilename(
+                title='Where to save',
+                defaultextension='.png',
+                )
+        if not savepath:
+            return
+        self.btn_save.configure(state=tk.DISABLED)
+        self.status_sv.set('Saving...')
+        self.worker.submit_export(self.grid, os.path.splitext(savepath)[0], self.config.tile_px, EXPORT_FORMATS)
+
+    def finish_export(self, result:Any) -> None:
+        self.btn_save.configure(state=tk.NORMAL)
+        self.update_status()
+        if isinstance(result, Exception):
+            tkinter.messagebox.showerror(title='Unable to save map', message='Unable to save map: {}'.format(result))
+            return
+        saved = [r for r in result if r.error is None]
+        self.status_sv.set('Saved {} files, {:,} KB in {:.1f}s of encoding  |  {}'.format(
+            len(saved), sum(r.nbytes for r in saved) >> 10, sum(r.encode_s for r in saved), self.status_sv.get()))
+        failed = [r for r in result if r.error is not None]
+        if failed:
+            tkinter.messagebox.showwarning(title='Some files not saved', message='\n'.join(
+                '{}: {}'.format(os.path.basename(r.path), r.error) for r in failed))
+
+def main() -> None:
+    # a no-op unless this is a frozen Windows executable, where it stops
+    # process pool workers from starting another app
+    multiprocessing.freeze_support()
+    root = tk.Tk()
+    root.title("make grid")
+    root.geometry('1400x700')
+    app = App(root)
+    atexit.register(app.save_tile_data)
+    root.mainloop()
+
+if __name__ == '__main__':
+    main()
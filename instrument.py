@@ -0,0 +1,98 @@
+'''
+Timing spans around the slow stages (decode, resize, compose, encode,
+display, import).
+
+Off by default, in which case span() hands back a shared do-nothing context
+manager, so leaving the spans in the hot paths costs next to nothing.
+
+    with span('make_grid_image'):
+        ...
+'''
+from typing import Any, ContextManager, Dict, Optional
+import json
+import threading
+import time
+
+class SpanStats:
+    __slots__ = ('count', 'total', 'max', 'last')
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'total_s': self.total,
+            'mean_s': self.total / self.count if self.count else 0.0,
+            'max_s': self.max,
+            'last_s': self.last,
+            }
+
+_enabled = False
+_stats: Dict[str, SpanStats] = {}
+_lock = threading.Lock()
+
+def enable(on:bool=True) -> None:
+    global _enabled
+    _enabled = on
+
+def is_enabled() -> bool:
+    return _enabled
+
+def record(name:str, seconds:float) -> None:
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = SpanStats()
+        stats.count += 1
+        stats.total += seconds
+        stats.last = seconds
+        if seconds > stats.max:
+            stats.max = seconds
+
+class _Span:
+    __slots__ = ('name', 't0')
+    def __init__(self, name:str):
+        self.name = name
+        self.t0 = 0.0
+
+    def __enter__(self) -> None:
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc:Any) -> None:
+        record(self.name, time.perf_counter() - self.t0)
+
+class _NullSpan:
+    __slots__ = ()
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc:Any) -> None:
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+def span(name:str) -> ContextManager[None]:
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+def get(name:str) -> Optional[SpanStats]:
+    return _stats.get(name)
+
+def snapshot() -> Dict[str, Dict[str, float]]:
+    with _lock:
+        return {name: stats.as_dict() for name, stats in sorted(_stats.items())}
+
+def reset() -> None:
+    with _lock:
+        _stats.clear()
+
+def dump(path:str, extra:Optional[Dict[str, Any]]=None) -> None:
+    data: Dict[str, Any] = {'spans': snapshot()}
+    if extra:
+        data.update(extra)
+    with open(path, 'w') as fp:
+        json.dump(data, fp, indent=1)
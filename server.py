@@ -0,0 +1,547 @@
+'''
+Map generation over HTTP, for tools that can't drive the Tk app.
+
+Tilesets, the image cache, atlases and sprite sheets stay loaded between
+requests. Requests that arrive close together are batched: identical
+ones are rendered once, and the rest are grouped by tileset and config
+onto a thread pool. Responses are kept in memory by (tileset, config,
+seed, format), so asking for the same seed again is just a lookup.
+
+    python server.py serve --folder tiles --port 8765
+    curl 'localhost:8765/map?seed=7&height=3' > map.png
+    python server.py loadtest --spawn --folder tiles -n 500 -c 8
+
+GET /map takes tileset (default: the first), seed (default: random, sent
+back as X-Seed), format (png, layout or grid) and any GeneratorConfig
+setting, e.g. tile_px=64. layout is write_tilemap's JSON against the
+sprite sheet from GET /sheet?tile_px=64 (format=json for its index).
+GET /tilesets lists the tilesets and GET /stats the counters.
+'''
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+from grid import GeneratorConfig, RenderCache, SpriteSheet, Tile, TilesetPlan, imagecache, make_sprite_sheet, serialize_grid, tilemap_json, tileset_fingerprint, tiles_from_folders
+from instrument import span
+import argparse
+import http.client
+import io
+import json
+import os
+import queue
+import random
+import statistics
+import threading
+import time
+
+# How long the dispatcher waits for more requests to go with the first.
+BATCH_WINDOW_MS = 5
+BATCH_MAX = 64
+CACHE_BYTES = 256*1024*1024
+MAX_TILE_PX = 1024
+# What each setting may be, as in the Tk app's inputs (tile_px is checked
+# against MAX_TILE_PX instead).
+CONFIG_LIMITS = {
+    'lower_blank_percentage': (0, 100),
+    'upper_blank_percentage': (0, 100),
+    'special_limit':          (0, 3),
+    'middle_size':            (1, 10),
+    'side_size':              (1, 10),
+    'tile_px':                (1, MAX_TILE_PX),
+    'height':                 (1, 4),
+    }
+MAP_FORMATS = {
+    'png': 'image/png',
+    'layout': 'application/json',
+    'grid': 'application/octet-stream',
+    }
+
+class MapRequest(NamedTuple):
+    tileset: str
+    config: Tuple # GeneratorConfig values, in GeneratorConfig.defaults order
+    seed: int
+    fmt: str
+
+class MapResult(NamedTuple):
+    body: bytes
+    cached: bool
+
+def config_values(config:GeneratorConfig) -> Tuple:
+    return tuple(getattr(config, attrname) for attrname, _ in GeneratorConfig.defaults)
+
+def make_config(values:Tuple) -> GeneratorConfig:
+    config = GeneratorConfig()
+    for (attrname, _), val in zip(GeneratorConfig.defaults, values):
+        setattr(config, attrname, val)
+    return config
+
+class ResponseCache:
+    '''
+    LRU of response bodies, bounded by their total size in bytes.
+    '''
+    def __init__(self, max_bytes:int=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.cache: 'OrderedDict[MapRequest, bytes]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key:MapRequest) -> Optional[bytes]:
+        with self.lock:
+            body = self.cache.get(key)
+            if body is not None:
+                self.cache.move_to_end(key)
+            return body
+
+    def put(self, key:MapRequest, body:bytes) -> None:
+        with self.lock:
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self.cache[key] = body
+            self.nbytes += len(body)
+            while self.nbytes > self.max_bytes and len(self.cache) > 1:
+                _, old = self.cache.popitem(last=False)
+                self.nbytes -= len(old)
+
+def check_setting(attrname:str, text:str) -> Any:
+    '''
+    A GeneratorConfig setting parsed from a query parameter. Raises
+    ValueError if it isn't a number or is out of range.
+    '''
+    val = (float if 'percentage' in attrname else int)(text)
+    lo, hi = CONFIG_LIMITS[attrname]
+    if not lo <= val <= hi:
+        raise ValueError('{} should be between {} and {}'.format(attrname, lo, hi))
+    return val
+
+class MapService:
+    '''
+    The service itself, without the HTTP. tilesets maps names to tiles;
+    `config` is what requests start from before their own settings.
+
+    submit() answers from the cache straight away if it can, and hands back
+    the same future for a request that is already being worked on.
+    Otherwise the request is queued for the dispatcher thread, which
+    collects everything that arrives within BATCH_WINDOW_MS of it (up to
+    BATCH_MAX) and groups them by tileset, config and format. Each group is
+    split into as many jobs as there are pool threads, so a burst of one
+    kind of request still uses them all.
+
+    With a render_cache, PNGs are also kept on disk by layout, so they
+    outlive the process and are shared with `grid batch --render-cache`.
+
+    The pool is threads rather than processes so that every job shares one
+    warm image cache; the heavy parts (resampling, compositing, zlib) run
+    in Pillow's C code.
+    '''
+    def __init__(
+            self,
+            tilesets:Dict[str, List[Tile]],
+            config:Optional[GeneratorConfig]=None,
+            workers:Optional[int]=None,
+            use_atlas:bool=True,
+            cache_bytes:int=CACHE_BYTES,
+            render_cache:Optional[RenderCache]=None,
+            ):
+        if not tilesets:
+            raise ValueError('No tilesets to serve')
+        self.tilesets = tilesets
+        self.names = sorted(tilesets)
+        self.plans = {name: TilesetPlan(tiles) for name, tiles in tilesets.items()}
+        self.config = config or GeneratorConfig()
+        self.use_atlas = use_atlas
+        self.cache = ResponseCache(cache_bytes)
+        self.render_cache = render_cache
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='MapService')
+        self.lock = threading.Lock()
+        self.pending: 'queue.Queue[MapRequest]' = queue.Queue()
+        self.inflight: Dict[MapRequest, 'Future[MapResult]'] = {}
+        self.atlases: Dict[Tuple[str, int], 'Future[Any]'] = {}
+        self.sheets: Dict[Tuple[str, int], SpriteSheet] = {}
+        self.stats = {'requests': 0, 'hits': 0, 'coalesced': 0, 'rendered': 0, 'batches': 0, 'jobs': 0}
+        self.dispatcher = threading.Thread(target=self.dispatch, name='MapService.dispatch', daemon=True)
+        self.dispatcher.start()
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=False)
+
+    def tileset_name(self, name:Optional[str]) -> str:
+        '''
+        The tileset a request asks for, by default the first. Raises
+        KeyError if there is no such tileset.
+        '''
+        name = name or self.names[0]
+        if name not in self.tilesets:
+            raise KeyError(name)
+        return name
+
+    def request(self, params:Dict[str, str]) -> MapRequest:
+        '''
+        Builds a MapRequest from query parameters. Raises KeyError for an
+        unknown tileset and ValueError for anything else wrong with them.
+        '''
+        params = dict(params)
+        name = self.tileset_name(params.pop('tileset', None))
+        fmt = params.pop('format', 'png')
+        if fmt not in MAP_FORMATS:
+            raise ValueError('format should be one of {}'.format(', '.join(MAP_FORMATS)))
+        seed = params.pop('seed', None)
+        config = make_config(config_values(self.config))
+        for attrname, _ in GeneratorConfig.defaults:
+            val = params.pop(attrname, None)
+            if val is not None:
+                setattr(config, attrname, check_setting(attrname, val))
+        if params:
+            raise ValueError('Unknown parameters: {}'.format(', '.join(sorted(params))))
+        return MapRequest(name, config_values(config), random.getrandbits(31) if seed is None else int(seed), fmt)
+
+    def submit(self, req:MapRequest) -> 'Future[MapResult]':
+        with self.lock:
+            self.stats['requests'] += 1
+            body = self.cache.get(req)
+            if body is not None:
+                self.stats['hits'] += 1
+                future: 'Future[MapResult]' = Future()
+                future.set_result(MapResult(body, True))
+                return future
+            if req in self.inflight:
+                self.stats['coalesced'] += 1
+                return self.inflight[req]
+            future = self.inflight[req] = Future()
+        self.pending.put(req)
+        return future
+
+    def get(self, req:MapRequest, timeout:Optional[float]=None) -> MapResult:
+        return self.submit(req).result(timeout)
+
+    def dispatch(self) -> None:
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.perf_counter() + BATCH_WINDOW_MS / 1000
+            while len(batch) < BATCH_MAX:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            groups: Dict[Tuple[str, Tuple, str], List[MapRequest]] = {}
+            for req in batch:
+                groups.setdefault((req.tileset, req.config, req.fmt), []).append(req)
+            jobs: List[List[MapRequest]] = []
+            for reqs in groups.values():
+                n = min(len(reqs), self.workers)
+                jobs.extend(reqs[i::n] for i in range(n))
+            with self.lock:
+                self.stats['batches'] += 1
+                self.stats['jobs'] += len(jobs)
+            for reqs in jobs:
+                self.pool.submit(self.run_group, reqs)
+
+    def run_group(self, reqs:List[MapRequest]) -> None:
+        for req in reqs:
+            with self.lock:
+                future = self.inflight[req]
+            try:
+                body = self.render(req)
+            except Exception as e:
+                with self.lock:
+                    del self.inflight[req]
+                future.set_exception(e)
+                continue
+            # cached before it stops being in flight, so there's no gap in
+            # which a duplicate would be rendered again
+            self.cache.put(req, body)
+            with self.lock:
+                self.stats['rendered'] += 1
+                del self.inflight[req]
+            future.set_result(MapResult(body, False))
+
+    def atlas(self, name:str, tile_px:int) -> Any:
+        '''
+        The tileset's atlas at this size. Only the first request for it
+        builds it; the others wait for that.
+        '''
+        key = (name, tile_px)
+        with self.lock:
+            future = self.atlases.get(key)
+            building = future is None
+            if building:
+                future = self.atlases[key] = Future()
+        assert future is not None
+        if building:
+            import atlas as atlas_
+            try:
+                future.set_result(atlas_.load_or_build(self.tilesets[name], tile_px))
+            except Exception as e:
+                # let a later request try again
+                with self.lock:
+                    del self.atlases[key]
+                future.set_exception(e)
+        return future.result()
+
+    def sheet(self, name:str, tile_px:int) -> SpriteSheet:
+        key = (name, tile_px)
+        with self.lock:
+            sheet = self.sheets.get(key)
+        if sheet is None:
+            sheet = make_sprite_sheet(self.tilesets[name], tile_px)
+            with self.lock:
+                sheet = self.sheets.setdefault(key, sheet)
+        return sheet
+
+    def render(self, req:MapRequest) -> bytes:
+        config = make_config(req.config)
+        with span('service.render'):
+            grid = config.make_grid(self.plans[req.tileset], req.seed)
+            if req.fmt == 'grid':
+                return serialize_grid(grid, self.tilesets[req.tileset])
+            if req.fmt == 'layout':
+                layout = tilemap_json(grid, self.sheet(req.tileset, config.tile_px))
+                return json.dumps(layout, separators=(',', ':')).encode()
+            atlas = self.atlas(req.tileset, config.tile_px) if self.use_atlas else None
+            if self.render_cache is not None:
+                path = self.render_cache.render(serialize_grid(grid, self.tilesets[req.tileset]), self.tilesets[req.tileset], config.tile_px, atlas=atlas)
+                with open(path, 'rb') as cached:
+                    return cached.read()
+            img = config.make_grid_image(grid, atlas)
+            fp = io.BytesIO()
+            img.save(fp, 'PNG')
+            return fp.getvalue()
+
+    def status(self) -> Dict[str, Any]:
+        with self.lock:
+            stats: Dict[str, Any] = dict(self.stats)
+        stats['cache_entries'] = len(self.cache.cache)
+        stats['cache_bytes'] = self.cache.nbytes
+        stats['imagecache_hit_rate'] = imagecache.hit_rate
+        stats['tilesets'] = {name: tileset_fingerprint(tiles).hex() for name, tiles in self.tilesets.items()}
+        return stats
+
+class MapRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, so clients don't pay for a connection per map
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as separate writes, which Nagle's algorithm
+    # would hold up waiting for the client's delayed ACK
+    disable_nagle_algorithm = True
+    server: 'MapServer'
+
+    def send_body(self, status:int, body:bytes, content_type:str, headers:Optional[Dict[str, str]]=None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data:Any, status:int=200) -> None:
+        self.send_body(status, json.dumps(data).encode(), 'application/json')
+
+    def do_GET(self) -> None:
+        service = self.server.service
+        url = urlsplit(self.path)
+        params = {key: vals[-1] for key, vals in parse_qs(url.query).items()}
+        if url.path in ('/map', '/sheet'):
+            try:
+                name = service.tileset_name(params.get('tileset'))
+            except KeyError as e:
+                self.send_json({'error': 'No tileset named {}'.format(e)}, 404)
+                return
+        try:
+            if url.path == '/map':
+                req = service.request(params)
+                result = service.get(req)
+                self.send_body(200, result.body, MAP_FORMATS[req.fmt], {
+                    'X-Seed': str(req.seed),
+                    'X-Cache': 'hit' if result.cached else 'miss',
+                    })
+            elif url.path == '/sheet':
+                tile_px = params.get('tile_px')
+                sheet = service.sheet(name, service.config.tile_px if tile_px is None else check_setting('tile_px', tile_px))
+                if params.get('format') == 'json':
+                    self.send_json({'tile_px': sheet.tile_px, 'columns': sheet.columns, 'fingerprint': sheet.fingerprint.hex(), 'names': sheet.names})
+                else:
+                    fp = io.BytesIO()
+                    sheet.image.save(fp, 'PNG')
+                    self.send_body(200, fp.getvalue(), 'image/png')
+            elif url.path == '/tilesets':
+                self.send_json(service.names)
+            elif url.path == '/stats':
+                self.send_json(service.status())
+            else:
+                self.send_json({'error': 'Not found'}, 404)
+        except ValueError as e:
+            self.send_json({'error': str(e)}, 400)
+        except Exception as e:
+            self.send_json({'error': str(e)}, 500)
+
+    def log_message(self, format:str, *args:Any) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class MapServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address:Tuple[str, int], service:MapService, verbose:bool=False):
+        super().__init__(address, MapRequestHandler)
+        self.service = service
+        self.verbose = verbose
+
+class MapClient:
+    '''
+    Minimal client, one keep-alive connection, so not thread safe: give each
+    thread its own.
+    '''
+    def __init__(self, host:str='127.0.0.1', port:int=8765, timeout:float=60):
+        self.conn = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def get(self, path:str, **params:Any) -> Tuple[bytes, Dict[str, str]]:
+        if params:
+            path += '?' + urlencode({k: v for k, v in params.items() if v is not None})
+        self.conn.request('GET', path)
+        resp = self.conn.getresponse()
+        body = resp.read()
+        if resp.status != 200:
+            raise RuntimeError('{} {}: {}'.format(resp.status, resp.reason, body.decode(errors='replace')))
+        return body, dict(resp.getheaders())
+
+    def get_map(self, tileset:Optional[str]=None, seed:Optional[int]=None, format:str='png', **config:Any) -> bytes:
+        return self.get('/map', tileset=tileset, seed=seed, format=format, **config)[0]
+
+    def close(self) -> None:
+        self.conn.close()
+
+def percentile(values:List[float], p:float) -> float:
+    values = sorted(values)
+    return values[min(len(values)-1, int(p / 100 * len(values)))]
+
+def loadtest(
+        host:str,
+        port:int,
+        count:int,
+        concurrency:int,
+        seeds:int,
+        fmt:str='png',
+        **config:Any,
+        ) -> Dict[str, Any]:
+    '''
+    Sends `count` map requests from `concurrency` threads, each a seed
+    drawn from range(seeds), so fewer seeds means more cache hits.
+    '''
+    latencies: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+    counter = iter(range(count))
+    def run() -> None:
+        client = MapClient(host, port)
+        rng = random.Random()
+        try:
+            while True:
+                with lock:
+                    if next(counter, None) is None:
+                        return
+                t0 = time.perf_counter()
+                try:
+                    client.get_map(seed=rng.randrange(seeds), format=fmt, **config)
+                except Exception as e:
+                    with lock:
+                        errors.append(str(e))
+                    client.close()
+                    client = MapClient(host, port)
+                    continue
+                elapsed = time.perf_counter() - t0
+                with lock:
+                    latencies.append(elapsed)
+        finally:
+            client.close()
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - t0
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'wall_s': wall,
+        'rps': len(latencies) / wall if wall else 0.0,
+        'mean_ms': statistics.mean(latencies) * 1000 if latencies else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else 0.0,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else 0.0,
+        'max_ms': max(latencies) * 1000 if latencies else 0.0,
+        }
+
+def load_tilesets(args:argparse.Namespace) -> Tuple[Dict[str, List[Tile]], GeneratorConfig]:
+    if args.folder:
+        return {os.path.basename(os.path.normpath(folder)): tiles_from_folders(folder) for folder in args.folder}, GeneratorConfig()
+    import tiledata
+    if args.tiledata:
+        store = tiledata.TileStore(args.tiledata)
+    else:
+        store = tiledata.TileStore(tiledata.DATAPATH, tiledata.LEGACY_DATAPATH)
+    tilesets = {name: store.load_tileset(name) for name in store.tileset_names()}
+    config = store.load_config()
+    store.close()
+    return {name: tiles for name, tiles in tilesets.items() if tiles}, config
+
+def make_server(args:argparse.Namespace, port:int) -> MapServer:
+    tilesets, config = load_tilesets(args)
+    render_cache = RenderCache(args.render_cache) if args.render_cache else None
+    service = MapService(tilesets, config, args.workers, not args.no_atlas, render_cache=render_cache)
+    return MapServer((args.host, port), service, getattr(args, 'verbose', False))
+
+def main(argv:Optional[List[str]]=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='Run the service.')
+    load_parser = subparsers.add_parser('loadtest', help='Measure requests per second and latency.')
+    for p in (serve_parser, load_parser):
+        p.add_argument('--host', default='127.0.0.1')
+        p.add_argument('--port', type=int, default=8765)
+        p.add_argument('--folder', action='append', help='Serve the tiles in this folder (can be repeated) instead of the saved tilesets.')
+        p.add_argument('--tiledata', help='Path to the saved tile data (default: the GUI\'s).')
+        p.add_argument('-j', '--workers', type=int, default=None)
+        p.add_argument('--no-atlas', action='store_true', help='Don\'t use or build the on-disk tile atlas.')
+        p.add_argument('--render-cache', metavar='DIR', help='Also keep rendered PNGs in DIR, by layout.')
+    serve_parser.add_argument('-v', '--verbose', action='store_true', help='Log every request.')
+    load_parser.add_argument('--spawn', action='store_true', help='Start a server in this process (on a free port) and test that.')
+    load_parser.add_argument('-n', '--count', type=int, default=500)
+    load_parser.add_argument('-c', '--concurrency', type=int, default=8)
+    load_parser.add_argument('--seeds', type=int, default=100, help='Seeds are drawn from this many, so smaller means more cache hits (default: %(default)s).')
+    load_parser.add_argument('--format', choices=list(MAP_FORMATS), default='png')
+    load_parser.add_argument('--tile-px', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        server = make_server(args, args.port)
+        print('Serving {} on http://{}:{}/'.format(', '.join(server.service.names), *server.server_address[:2]), flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    spawned: Optional[MapServer] = None
+    host, port = args.host, args.port
+    if args.spawn:
+        spawned = make_server(args, 0)
+        host, port = spawned.server_address[:2]
+        threading.Thread(target=spawned.serve_forever, daemon=True).start()
+    try:
+        result = loadtest(host, port, args.count, args.concurrency, args.seeds, args.format, tile_px=args.tile_px)
+        print(json.dumps(result, indent=1))
+        if spawned is not None:
+            print(json.dumps(spawned.service.status(), indent=1))
+    finally:
+        if spawned is not None:
+            spawned.shutdown()
+            spawned.service.close()
+
+if __name__ == '__main__':
+    main()
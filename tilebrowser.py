@@ -0,0 +1,370 @@
+'''
+Scrollable grid of tile thumbnails for the tile configurer.
+
+Only the rows in view (plus a couple either side) have canvas items, so
+it stays quick with thousands of tiles, and adding, removing or changing
+a tile only redraws what's on screen. Thumbnails are made on a
+background thread, newest requests first, and kept in an LRU by
+image_key; the Tk thread polls for them and makes PhotoImages for the
+ones still in view.
+'''
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from collections import OrderedDict
+from grid import Tile, image_nbytes, tile_layer
+from instrument import span
+from PIL import Image, ImageTk
+import queue
+import threading
+import tkinter as tk
+
+THUMB_PX = 64
+COLUMNS = 3
+PAD = 4
+LABEL_HEIGHT = 14
+LABEL_CHARS = 10
+ROWS_SHOWN = 5
+# Rows drawn past the top and bottom of the view, so a small scroll
+# doesn't show gaps while thumbnails come in.
+OVERSCAN_ROWS = 2
+THUMB_CACHE_BYTES = 64*1024*1024
+POLL_MS = 30
+SELECTED_COLOR = '#cfe0fc'
+MISSING_COLOR = '#cc0000'
+# what a thumbnail that couldn't be made is cached as
+FAILED = Image.new('RGB', (1, 1))
+
+def make_thumbnail(path:str, px:int=THUMB_PX) -> Image.Image:
+    '''
+    The image shrunk to fit in px x px, as RGB or RGBA. JPEGs are decoded
+    at a reduced scale to begin with.
+    '''
+    with Image.open(path) as original:
+        original.draft('RGB', (px, px))
+        img = tile_layer(original)
+        img.thumbnail((px, px), Image.Resampling.BICUBIC)
+        return img
+
+class ThumbnailLoader:
+    '''
+    Makes thumbnails on a background thread. request() queues one; it is
+    dropped without being made if its key has left `wanted` by the time
+    the thread gets to it. Finished keys are put on self.done.
+    '''
+    def __init__(self, px:int=THUMB_PX, max_bytes:int=THUMB_CACHE_BYTES):
+        self.px = px
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.cache: 'OrderedDict[str, Image.Image]' = OrderedDict()
+        self.lock = threading.Lock()
+        # last in, first out, so what was just scrolled to comes first
+        self.jobs: 'queue.LifoQueue[Tuple[str, str]]' = queue.LifoQueue()
+        self.done: 'queue.Queue[str]' = queue.Queue()
+        # replaced wholesale by the Tk thread, never changed in place
+        self.wanted: Set[str] = set()
+        self.thread = threading.Thread(target=self.run, name='ThumbnailLoader', daemon=True)
+        self.thread.start()
+
+    def get(self, key:str) -> Optional[Image.Image]:
+        with self.lock:
+            img = self.cache.get(key)
+            if img is not None:
+                self.cache.move_to_end(key)
+            return img
+
+    def put(self, key:str, img:Image.Image) -> None:
+        with self.lock:
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self.nbytes -= image_nbytes(old)
+            self.cache[key] = img
+            self.nbytes += image_nbytes(img)
+            while self.nbytes > self.max_bytes and len(self.cache) > 1:
+                _, old = self.cache.popitem(last=False)
+                self.nbytes -= image_nbytes(old)
+
+    def forget(self, key:str) -> None:
+        with self.lock:
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self.nbytes -= image_nbytes(old)
+
+    def request(self, key:str, path:str) -> None:
+        self.jobs.put((key, path))
+
+    def run(self) -> None:
+        while True:
+            key, path = self.jobs.get()
+            if key in self.wanted and self.get(key) is None:
+                try:
+                    with span('thumbnail'):
+                        img = make_thumbnail(path, self.px)
+                except Exception:
+                    img = FAILED
+                self.put(key, img)
+            # also for skipped ones, so they can be asked for again
+            self.done.put(key)
+
+class TileBrowser:
+    '''
+    Shows tiles as a grid of thumbnails with their names underneath. Click
+    or use the arrow keys to select one; on_select is called with its
+    index. is_missing says which names to show in red.
+
+    Pack or grid `frame`. set_tiles() replaces the whole list (cheaply);
+    insert(), delete() and update() are for single tiles.
+    '''
+    def __init__(
+            self,
+            master:tk.Misc,
+            on_select:Optional[Callable[[int], None]]=None,
+            is_missing:Optional[Callable[[Tile], bool]]=None,
+            columns:int=COLUMNS,
+            rows:int=ROWS_SHOWN,
+            ):
+        self.on_select = on_select
+        self.is_missing = is_missing
+        self.columns = columns
+        self.cell_w = THUMB_PX + 2*PAD
+        self.cell_h = THUMB_PX + LABEL_HEIGHT + 2*PAD
+        self.tiles: List[Tile] = []
+        self.selection: Optional[int] = None
+        # index -> (background rect, image, label) canvas items, only for
+        # tiles near the view
+        self.items: Dict[int, Tuple[int, int, int]] = {}
+        self.requested: Set[str] = set()
+        self.photos: Dict[str, ImageTk.PhotoImage] = {}
+        self.loader = ThumbnailLoader()
+        # the scrollregion's height and the tiles that have items, as of the
+        # last draw()
+        self.height = 0
+        self.drawn = range(0)
+
+        self.frame = tk.Frame(master)
+        self.canvas = tk.Canvas(
+                self.frame,
+                width=columns*self.cell_w,
+                height=rows*self.cell_h,
+                yscrollincrement=self.cell_h,
+                highlightthickness=1,
+                takefocus=1,
+                )
+        self.scrollbar = tk.Scrollbar(self.frame, command=self.canvas.yview)
+        self.canvas.config(yscrollcommand=self.on_scroll)
+        self.canvas.pack(side='left', fill='y')
+        self.scrollbar.pack(side='left', fill='y')
+        self.canvas.bind('<Configure>', lambda e: self.draw())
+        self.canvas.bind('<Button-1>', self.click)
+        self.canvas.bind('<MouseWheel>', lambda e: self.scroll(-1 if e.delta > 0 else 1))
+        self.canvas.bind('<Button-4>', lambda e: self.scroll(-1))
+        self.canvas.bind('<Button-5>', lambda e: self.scroll(1))
+        for key, step in (('<Left>', -1), ('<Right>', 1), ('<Up>', -columns), ('<Down>', columns)):
+            self.canvas.bind(key, self.mover(step))
+        self.canvas.after(POLL_MS, self.poll)
+
+    def set_tiles(self, tiles:List[Tile]) -> None:
+        self.tiles = tiles
+        self.selection = None
+        self.clear_from(0)
+        self.resize()
+        self.canvas.yview_moveto(0)
+        self.draw()
+
+    def insert(self, index:int, tile:Tile) -> None:
+        '''
+        Call after inserting tile at index in the list; redraws from there on.
+        '''
+        if self.selection is not None and self.selection >= index:
+            self.selection += 1
+        self.clear_from(index)
+        self.resize()
+        self.draw()
+
+    def delete(self, index:int) -> None:
+        '''
+        Call after removing index from the list; redraws from there on.
+        '''
+        if self.selection == index:
+            self.selection = None
+        elif self.selection is not None and self.selection > index:
+            self.selection -= 1
+        self.clear_from(index)
+        self.resize()
+        self.draw()
+
+    def update(self, index:int) -> None:
+        '''
+        Redraws one tile, e.g. after its name or image changed.
+        '''
+        self.clear(index)
+        self.draw()
+
+    def refresh(self) -> None:
+        '''
+        Redraws everything in view, e.g. after which tiles are missing changed.
+        '''
+        self.clear_from(0)
+        self.draw()
+
+    def forget(self, tile:Tile) -> None:
+        '''
+        Drops the thumbnail of tile's image, so it is made again.
+        '''
+        self.loader.forget(tile.image_key)
+        self.photos.pop(tile.image_key, None)
+
+    def select(self, index:Optional[int]) -> None:
+        '''
+        Selects and scrolls to a tile, and calls on_select.
+        '''
+        old, self.selection = self.selection, index
+        for n in (old, index):
+            if n is not None:
+                self.clear(n)
+        if index is None:
+            self.draw()
+            return
+        self.see(index)
+        self.draw()
+        if self.on_select is not None:
+            self.on_select(index)
+
+    def see(self, index:int) -> None:
+        total = self.total_height()
+        if not total:
+            return
+        top = self.canvas.canvasy(0)
+        height = self.canvas.winfo_height()
+        y0 = (index // self.columns) * self.cell_h
+        if y0 < top:
+            self.canvas.yview_moveto(y0 / total)
+        elif y0 + self.cell_h > top + height:
+            self.canvas.yview_moveto((y0 + self.cell_h - height) / total)
+
+    def total_height(self) -> int:
+        rows = -(-len(self.tiles) // self.columns)
+        return rows * self.cell_h
+
+    def resize(self) -> None:
+        '''
+        Fits the scrollregion to the tiles, if their number of rows changed.
+        Setting it calls on_scroll, so draw() mustn't.
+        '''
+        height = self.total_height()
+        if height != self.height:
+            self.height = height
+            self.canvas.config(scrollregion=(0, 0, self.columns*self.cell_w, height))
+
+    def on_scroll(self, first:float, last:float) -> None:
+        self.scrollbar.set(first, last)
+        if self.visible() != self.drawn:
+            self.draw()
+
+    def mover(self, step:int) -> Callable[['tk.Event[tk.Canvas]'], None]:
+        def move(event:'tk.Event[tk.Canvas]') -> None:
+            self.move(step)
+        return move
+
+    def scroll(self, rows:int) -> None:
+        self.canvas.yview_scroll(rows, 'units')
+
+    def move(self, step:int) -> None:
+        if not self.tiles:
+            return
+        index = 0 if self.selection is None else self.selection + step
+        self.select(min(max(index, 0), len(self.tiles) - 1))
+
+    def click(self, event:tk.Event) -> None:
+        self.canvas.focus_set()
+        col = int(self.canvas.canvasx(event.x)) // self.cell_w
+        index = (int(self.canvas.canvasy(event.y)) // self.cell_h) * self.columns + col
+        if 0 <= col < self.columns and 0 <= index < len(self.tiles):
+            self.select(index)
+
+    def clear(self, index:int) -> None:
+        items = self.items.pop(index, None)
+        if items is not None:
+            self.canvas.delete(*items)
+
+    def clear_from(self, index:int) -> None:
+        for n in [n for n in self.items if n >= index]:
+            self.clear(n)
+
+    def visible(self) -> range:
+        height = self.canvas.winfo_height()
+        first_row = max(0, int(self.canvas.canvasy(0)) // self.cell_h - OVERSCAN_ROWS)
+        last_row = int(self.canvas.canvasy(height)) // self.cell_h + OVERSCAN_ROWS
+        return range(first_row * self.columns, min(len(self.tiles), (last_row + 1) * self.columns))
+
+    def draw(self) -> None:
+        '''
+        Makes items for the tiles in view that don't have them, drops them
+        for the ones that have gone out of it, and asks for thumbnails.
+        '''
+        with span('tilebrowser.draw'):
+            visible = self.drawn = self.visible()
+            for n in [n for n in self.items if n not in visible]:
+                self.clear(n)
+            wanted = {self.tiles[n].image_key for n in visible}
+            self.loader.wanted = wanted
+            for key in [key for key in self.photos if key not in wanted]:
+                del self.photos[key]
+            for n in visible:
+                if n not in self.items:
+                    self.items[n] = self.make_items(n)
+
+    def make_items(self, index:int) -> Tuple[int, int, int]:
+        tile = self.tiles[index]
+        row, col = divmod(index, self.columns)
+        x, y = col * self.cell_w, row * self.cell_h
+        selected = index == self.selection
+        rect = self.canvas.create_rectangle(
+                x+1, y+1, x+self.cell_w-1, y+self.cell_h-1,
+                fill=SELECTED_COLOR if selected else '',
+                outline='#808080' if selected else '',
+                )
+        image = self.canvas.create_image(x + self.cell_w//2, y + PAD + THUMB_PX//2, image=self.photo(tile) or '')
+        name = tile.name if len(tile.name) <= LABEL_CHARS else tile.name[:LABEL_CHARS-1] + '…'
+        missing = self.is_missing is not None and self.is_missing(tile)
+        label = self.canvas.create_text(
+                x + self.cell_w//2, y + PAD + THUMB_PX + LABEL_HEIGHT//2,
+                text=name,
+                fill=MISSING_COLOR if missing else 'black',
+                )
+        return rect, image, label
+
+    def photo(self, tile:Tile) -> Optional[ImageTk.PhotoImage]:
+        '''
+        The tile's thumbnail as a PhotoImage if it has been made, otherwise
+        asks for it and returns None.
+        '''
+        key = tile.image_key
+        photo = self.photos.get(key)
+        if photo is not None:
+            return photo
+        img = self.loader.get(key)
+        if img is None:
+            if key not in self.requested:
+                self.requested.add(key)
+                self.loader.request(key, tile.path)
+            return None
+        if img is FAILED:
+            return None
+        photo = self.photos[key] = ImageTk.PhotoImage(img)
+        return photo
+
+    def poll(self) -> None:
+        done = set()
+        while True:
+            try:
+                done.add(self.loader.done.get_nowait())
+            except queue.Empty:
+                break
+        if done:
+            self.requested -= done
+            for n, (_, image, _) in self.items.items():
+                tile = self.tiles[n]
+                if tile.image_key in done:
+                    photo = self.photo(tile)
+                    if photo is not None:
+                        self.canvas.itemconfigure(image, image=photo)
+        self.canvas.after(POLL_MS, self.poll)
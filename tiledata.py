@@ -0,0 +1,241 @@
+from appdirs import user_data_dir
+from typing import AbstractSet, Any, Callable, Dict, List, Optional, Set, Tuple
+from grid import Tile, GeneratorConfig, IndexEntry
+import pickle
+import sqlite3
+import os
+DATADIR = user_data_dir(appname='JeffTiles', appauthor='David')
+DATAPATH = os.path.join(DATADIR, 'tiledata.sqlite3')
+LEGACY_DATAPATH = os.path.join(DATADIR, 'tiledata.pickle')
+
+TILE_FIELDS = ('name', 'path', 'repeatable', 'weight', 'middle', 'side', 'upper', 'biome', 'special', 'is_blank', 'digest')
+BOOL_FIELDS = {'repeatable', 'middle', 'side', 'upper', 'special', 'is_blank'}
+
+class _Unpickler(pickle.Unpickler):
+    # GeneratorConfig used to live in gui.py, which is run as __main__, so
+    # older saves refer to it as __main__.GeneratorConfig.
+    def find_class(self, module:str, name:str) -> Any:
+        if name == 'GeneratorConfig' and module in ('__main__', 'gui'):
+            return GeneratorConfig
+        return super().find_class(module, name)
+
+def load_legacy_tile_data(path:str=LEGACY_DATAPATH) -> Tuple[Dict[str, List[Tile]], GeneratorConfig]:
+    '''
+    Reads the single pickle that older versions saved everything to.
+    '''
+    with open(path, 'rb') as fp:
+        data, config = _Unpickler(fp).load()
+    config.reinit()
+    return data, config
+
+def _migrate_to_1(conn:sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE tilesets(
+            id   INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )''')
+    conn.execute('''
+        CREATE TABLE tiles(
+            tileset_id INTEGER NOT NULL REFERENCES tilesets(id) ON DELETE CASCADE,
+            position   INTEGER NOT NULL,
+            name       TEXT NOT NULL,
+            path       TEXT NOT NULL,
+            repeatable INTEGER NOT NULL,
+            weight     INTEGER NOT NULL,
+            middle     INTEGER NOT NULL,
+            side       INTEGER NOT NULL,
+            upper      INTEGER NOT NULL,
+            biome      TEXT NOT NULL,
+            special    INTEGER NOT NULL,
+            is_blank   INTEGER NOT NULL,
+            PRIMARY KEY(tileset_id, position)
+        )''')
+    conn.execute('''
+        CREATE TABLE config(
+            key   TEXT PRIMARY KEY,
+            value
+        )''')
+
+def _migrate_to_2(conn:sqlite3.Connection) -> None:
+    # content hashes; tiles saved before this get one when their folder is
+    # next imported
+    conn.execute("ALTER TABLE tiles ADD COLUMN digest TEXT NOT NULL DEFAULT ''")
+
+def _migrate_to_3(conn:sqlite3.Connection) -> None:
+    # what each tileset's folders looked like when they were last synced
+    conn.execute('''
+        CREATE TABLE files(
+            tileset_id INTEGER NOT NULL REFERENCES tilesets(id) ON DELETE CASCADE,
+            folder     TEXT NOT NULL,
+            path       TEXT NOT NULL,
+            size       INTEGER NOT NULL,
+            mtime_ns   INTEGER NOT NULL,
+            digest     TEXT NOT NULL,
+            PRIMARY KEY(tileset_id, folder, path)
+        )''')
+
+def _migrate_to_4(conn:sqlite3.Connection) -> None:
+    # tombstones: files taken out of the tileset by hand, which syncing the
+    # folder mustn't bring back. A tombstone for a file that isn't indexed
+    # has size -1.
+    conn.execute('ALTER TABLE files ADD COLUMN removed INTEGER NOT NULL DEFAULT 0')
+
+# MIGRATIONS[n] takes the schema from version n to n+1. To change the data
+# model, append a migration; never edit an old one.
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _migrate_to_1,
+    _migrate_to_2,
+    _migrate_to_3,
+    _migrate_to_4,
+    ]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def _tile_row(tile:Tile) -> Tuple:
+    return tuple(getattr(tile, f) for f in TILE_FIELDS)
+
+def _row_tile(row:Tuple) -> Tile:
+    kwargs: Dict[str, Any] = {f: (bool(v) if f in BOOL_FIELDS else v) for f, v in zip(TILE_FIELDS, row)}
+    return Tile(**kwargs)
+
+class TileStore:
+    '''
+    Tilesets and the generator config, stored as rows in a SQLite database.
+
+    Tilesets are loaded one at a time when asked for, and saving a tileset
+    only writes the tiles that changed, each save in its own transaction.
+    If the database is new and legacy_path names an old pickle, its
+    contents are imported.
+    '''
+    def __init__(self, path:str=DATAPATH, legacy_path:Optional[str]=None):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(path)
+        try:
+            self.conn.execute('PRAGMA foreign_keys = ON')
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise ValueError('{} is from a newer version (data version {}, we support {})'.format(path, version, SCHEMA_VERSION))
+            # The migrations, the legacy import and the new version go in one
+            # transaction, so if any of them fails the next open tries again.
+            # sqlite3 doesn't start one by itself before CREATE or ALTER.
+            with self.conn:
+                self.conn.execute('BEGIN')
+                for migrate in MIGRATIONS[version:]:
+                    migrate(self.conn)
+                if version == 0 and legacy_path is not None and os.path.isfile(legacy_path):
+                    self._import_legacy(legacy_path)
+                # PRAGMA doesn't take parameters
+                self.conn.execute('PRAGMA user_version = {:d}'.format(SCHEMA_VERSION))
+        except BaseException:
+            self.conn.close()
+            raise
+
+    def import_legacy(self, path:str) -> None:
+        with self.conn:
+            self._import_legacy(path)
+
+    def _import_legacy(self, path:str) -> None:
+        data, config = load_legacy_tile_data(path)
+        for name, tiles in data.items():
+            self._write_tileset(name, tiles)
+        self._write_config(config)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def tileset_names(self) -> List[str]:
+        return [name for (name,) in self.conn.execute('SELECT name FROM tilesets ORDER BY name')]
+
+    def load_tileset(self, name:str) -> List[Tile]:
+        rows = self.conn.execute('''
+            SELECT {} FROM tiles JOIN tilesets ON tiles.tileset_id = tilesets.id
+            WHERE tilesets.name = ? ORDER BY position'''.format(', '.join('tiles.'+f for f in TILE_FIELDS)),
+            (name,))
+        return [_row_tile(row) for row in rows]
+
+    def save_tileset(self, name:str, tiles:List[Tile]) -> None:
+        with self.conn:
+            self._write_tileset(name, tiles)
+
+    def _write_tileset(self, name:str, tiles:List[Tile]) -> None:
+        self.conn.execute('INSERT OR IGNORE INTO tilesets(name) VALUES (?)', (name,))
+        (tileset_id,) = self.conn.execute('SELECT id FROM tilesets WHERE name = ?', (name,)).fetchone()
+        old = {
+            row[0]: row[1:] for row in self.conn.execute(
+                'SELECT position, {} FROM tiles WHERE tileset_id = ?'.format(', '.join(TILE_FIELDS)),
+                (tileset_id,))
+            }
+        changed = []
+        for position, tile in enumerate(tiles):
+            row = _tile_row(tile)
+            if old.get(position) != row:
+                changed.append((tileset_id, position) + row)
+        self.conn.executemany('INSERT OR REPLACE INTO tiles(tileset_id, position, {}) VALUES ({})'.format(
+            ', '.join(TILE_FIELDS), ', '.join('?' * (len(TILE_FIELDS) + 2))), changed)
+        self.conn.execute('DELETE FROM tiles WHERE tileset_id = ? AND position >= ?', (tileset_id, len(tiles)))
+
+    def synced_folders(self, name:str) -> List[str]:
+        return [folder for (folder,) in self.conn.execute('''
+            SELECT DISTINCT folder FROM files JOIN tilesets ON files.tileset_id = tilesets.id
+            WHERE tilesets.name = ? ORDER BY folder''', (name,))]
+
+    def _file_rows(self, name:str, folder:str) -> Dict[str, Tuple[int, int, str, int]]:
+        rows = self.conn.execute('''
+            SELECT path, size, mtime_ns, digest, removed FROM files JOIN tilesets ON files.tileset_id = tilesets.id
+            WHERE tilesets.name = ? AND folder = ?''', (name, folder))
+        return {row[0]: row[1:] for row in rows}
+
+    def load_file_index(self, name:str, folder:str) -> Dict[str, IndexEntry]:
+        return {
+            path: IndexEntry(size, mtime_ns, digest)
+            for path, (size, mtime_ns, digest, _) in self._file_rows(name, folder).items()
+            if size >= 0
+            }
+
+    def load_removed(self, name:str, folder:str) -> Set[str]:
+        '''
+        Paths under the folder that were taken out of the tileset by hand.
+        '''
+        return {path for path, row in self._file_rows(name, folder).items() if row[3]}
+
+    def save_file_index(self, name:str, folder:str, index:Dict[str, IndexEntry], removed:AbstractSet[str]=frozenset()) -> None:
+        '''
+        Replaces the index and tombstones for this folder of the tileset.
+        Only the rows that changed are written.
+        '''
+        with self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO tilesets(name) VALUES (?)', (name,))
+            (tileset_id,) = self.conn.execute('SELECT id FROM tilesets WHERE name = ?', (name,)).fetchone()
+            old = self._file_rows(name, folder)
+            new = {path: tuple(entry) + (int(path in removed),) for path, entry in index.items()}
+            for path in removed:
+                if path not in new:
+                    new[path] = (-1, -1, '', 1)
+            self.conn.executemany('''
+                DELETE FROM files WHERE tileset_id = ? AND folder = ? AND path = ?''',
+                [(tileset_id, folder, path) for path in old if path not in new])
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO files(tileset_id, folder, path, size, mtime_ns, digest, removed)
+                VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                [(tileset_id, folder, path) + row for path, row in new.items() if old.get(path) != row])
+
+    def delete_tileset(self, name:str) -> None:
+        with self.conn:
+            self.conn.execute('DELETE FROM tilesets WHERE name = ?', (name,))
+
+    def load_config(self) -> GeneratorConfig:
+        config = GeneratorConfig()
+        names = {attrname for attrname, _ in GeneratorConfig.defaults}
+        for key, value in self.conn.execute('SELECT key, value FROM config'):
+            if key in names:
+                setattr(config, key, value)
+        return config
+
+    def save_config(self, config:GeneratorConfig) -> None:
+        with self.conn:
+            self._write_config(config)
+
+    def _write_config(self, config:GeneratorConfig) -> None:
+        self.conn.executemany('INSERT OR REPLACE INTO config(key, value) VALUES (?, ?)',
+            [(attrname, getattr(config, attrname)) for attrname, _ in GeneratorConfig.defaults])